@@ -0,0 +1,286 @@
+"""
+時間區間彙總（bucket aggregation）
+- bucket_aggregate(): 以 NumPy 向量化計算每個時間區間的 min / max / avg / count
+- RollupStore: 在接收數據時逐筆累加標準區間（1m / 1h / 1d）的彙總，
+  查詢一週與查詢十分鐘的成本相同
+"""
+
+import re
+import time
+import numpy as np
+
+# 標準區間大小（毫秒）與每個裝置在記憶體保留的區間數
+STANDARD_BUCKETS = {
+    '1m': 60 * 1000,
+    '1h': 3600 * 1000,
+    '1d': 86400 * 1000,
+}
+ROLLUP_SLOTS = {
+    '1m': 2 * 1440,   # 2 天
+    '1h': 90 * 24,    # 90 天
+    '1d': 5 * 365,    # 5 年
+}
+
+UNIT_MS = {'s': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 86400 * 1000}
+
+# 區間以本地時間對齊（例如 1d 區間從本地午夜開始）
+BUCKET_OFFSET_MS = time.localtime().tm_gmtoff * 1000
+
+# 彙總結果的欄位
+AGGREGATE_FIELDS = (
+    'count',
+    'temperature_min', 'temperature_max', 'temperature_sum',
+    'humidity_min', 'humidity_max', 'humidity_sum',
+)
+
+
+def parse_bucket(text):
+    """
+    解析區間大小字串（例如 '30s'、'5m'、'1h'、'1d'）
+
+    Returns:
+        int: 區間大小（毫秒）
+    """
+    match = re.fullmatch(r'(\d+)([smhd])', text.strip())
+    if not match or int(match.group(1)) <= 0:
+        raise ValueError(f"無效的區間大小: {text}")
+    return int(match.group(1)) * UNIT_MS[match.group(2)]
+
+
+def bucket_key(timestamp_ms, bucket_ms):
+    """epoch 毫秒所屬的區間編號（可為陣列）"""
+    return (timestamp_ms + BUCKET_OFFSET_MS) // bucket_ms
+
+
+def bucket_start(key, bucket_ms):
+    """區間編號對應的起始 epoch 毫秒（可為陣列）"""
+    return key * bucket_ms - BUCKET_OFFSET_MS
+
+
+def align_down(timestamp_ms, bucket_ms):
+    """對齊到所屬區間的起點"""
+    return bucket_start(bucket_key(timestamp_ms, bucket_ms), bucket_ms)
+
+
+def align_up(timestamp_ms, bucket_ms):
+    """對齊到下一個區間邊界（已在邊界上時不變）"""
+    return align_down(timestamp_ms + bucket_ms - 1, bucket_ms)
+
+
+def empty_aggregate():
+    """回傳沒有任何區間的彙總結果"""
+    result = {'bucket': np.zeros(0, dtype=np.int64), 'count': np.zeros(0, dtype=np.int64)}
+    for field in AGGREGATE_FIELDS[1:]:
+        result[field] = np.zeros(0, dtype=np.float64)
+    return result
+
+
+def _reduce_sorted(keys, count, parts):
+    """
+    對已依 keys 排序的陣列做分組彙總
+
+    Args:
+        keys: 區間編號（已排序）
+        count: 每列代表的筆數
+        parts: {'temperature': (min, max, sum), 'humidity': (min, max, sum)}
+    """
+    if len(keys) == 0:
+        return empty_aggregate()
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    result = {'bucket': keys[starts], 'count': np.add.reduceat(count, starts)}
+    for name, (mins, maxs, sums) in parts.items():
+        result[f'{name}_min'] = np.minimum.reduceat(mins, starts).astype(np.float64)
+        result[f'{name}_max'] = np.maximum.reduceat(maxs, starts).astype(np.float64)
+        result[f'{name}_sum'] = np.add.reduceat(sums, starts)
+    return result
+
+
+def bucket_aggregate(columns, bucket_ms):
+    """
+    將原始數據依時間區間彙總（向量化）
+
+    Args:
+        columns: 欄位集合（timestamp 需已排序）
+        bucket_ms: 區間大小（毫秒）
+
+    Returns:
+        dict: 'bucket'（區間編號）、'count'、各欄位的 min / max / sum
+    """
+    keys = bucket_key(np.asarray(columns['timestamp'], dtype=np.int64), bucket_ms)
+    temperature = np.asarray(columns['temperature'], dtype=np.float64)
+    humidity = np.asarray(columns['humidity'], dtype=np.float64)
+    return _reduce_sorted(keys, np.ones(len(keys), dtype=np.int64), {
+        'temperature': (temperature, temperature, temperature),
+        'humidity': (humidity, humidity, humidity),
+    })
+
+
+def combine_aggregates(results):
+    """合併多個彙總結果（例如多個裝置或多個來源），相同區間會再彙總一次"""
+    results = [r for r in results if len(r['bucket'])]
+    if not results:
+        return empty_aggregate()
+    if len(results) == 1:
+        return results[0]
+    merged = {field: np.concatenate([r[field] for r in results]) for field in results[0]}
+    order = np.argsort(merged['bucket'], kind='stable')
+    merged = {field: values[order] for field, values in merged.items()}
+    return _reduce_sorted(merged['bucket'], merged['count'], {
+        name: (merged[f'{name}_min'], merged[f'{name}_max'], merged[f'{name}_sum'])
+        for name in ('temperature', 'humidity')
+    })
+
+
+def aggregate_to_json(result, bucket_ms, format_timestamps):
+    """
+    將彙總結果轉換為可 JSON 序列化的欄位格式
+
+    Args:
+        result: 彙總結果
+        bucket_ms: 區間大小（毫秒）
+        format_timestamps: 時間格式化函式（epoch 毫秒陣列 → 字串列表）
+    """
+    count = result['count']
+    safe = np.maximum(count, 1)
+    output = {
+        'timestamp': format_timestamps(bucket_start(result['bucket'], bucket_ms)),
+        'count': count.tolist(),
+    }
+    for name in ('temperature', 'humidity'):
+        output[f'{name}_min'] = np.round(result[f'{name}_min'], 2).tolist()
+        output[f'{name}_max'] = np.round(result[f'{name}_max'], 2).tolist()
+        output[f'{name}_avg'] = np.round(result[f'{name}_sum'] / safe, 2).tolist()
+    return output
+
+
+class Rollup:
+    """單一裝置、單一區間大小的環狀彙總陣列（每個區間一格）"""
+
+    def __init__(self, bucket_ms, slots):
+        self.bucket_ms = bucket_ms
+        self.slots = slots
+        self.bucket = np.full(slots, -1, dtype=np.int64)
+        self.count = np.zeros(slots, dtype=np.int64)
+        self.values = {}
+        for name in ('temperature', 'humidity'):
+            self.values[name] = (
+                np.zeros(slots, dtype=np.float32),  # min
+                np.zeros(slots, dtype=np.float32),  # max
+                np.zeros(slots, dtype=np.float64),  # sum
+            )
+
+    def update(self, timestamp_ms, temperature, humidity):
+        """累加一筆數據（O(1)）"""
+        key = bucket_key(timestamp_ms, self.bucket_ms)
+        i = key % self.slots
+        if self.bucket[i] != key:
+            # 新的區間（或覆蓋已超出保留範圍的舊區間）
+            if self.bucket[i] > key:
+                return  # 數據比保留範圍還舊，忽略
+            self.bucket[i] = key
+            self.count[i] = 0
+            for value, (mins, maxs, sums) in ((temperature, self.values['temperature']),
+                                              (humidity, self.values['humidity'])):
+                mins[i] = value
+                maxs[i] = value
+                sums[i] = 0.0
+        self.count[i] += 1
+        for value, (mins, maxs, sums) in ((temperature, self.values['temperature']),
+                                          (humidity, self.values['humidity'])):
+            if value < mins[i]:
+                mins[i] = value
+            if value > maxs[i]:
+                maxs[i] = value
+            sums[i] += value
+
+    def seed(self, result):
+        """以向量化彙總的結果（bucket_aggregate）初始化，只保留最新的 slots 個區間"""
+        keys = result['bucket'][-self.slots:]
+        index = keys % self.slots
+        self.bucket[index] = keys
+        self.count[index] = result['count'][-self.slots:]
+        for name, (mins, maxs, sums) in self.values.items():
+            mins[index] = result[f'{name}_min'][-self.slots:]
+            maxs[index] = result[f'{name}_max'][-self.slots:]
+            sums[index] = result[f'{name}_sum'][-self.slots:]
+
+    def query(self, start_key, end_key):
+        """取得區間編號在 [start_key, end_key) 的彙總結果（依時間排序）"""
+        mask = (self.bucket >= start_key) & (self.bucket < end_key)
+        index = np.flatnonzero(mask)
+        index = index[np.argsort(self.bucket[index])]
+        result = {'bucket': self.bucket[index], 'count': self.count[index]}
+        for name, (mins, maxs, sums) in self.values.items():
+            result[f'{name}_min'] = mins[index].astype(np.float64)
+            result[f'{name}_max'] = maxs[index].astype(np.float64)
+            result[f'{name}_sum'] = sums[index]
+        return result
+
+
+class RollupStore:
+    """
+    每個裝置、每個標準區間大小的增量彙總
+
+    covered_from 記錄開始累加的時間：之後的完整區間可直接由彙總取得，
+    之前的部分需要從原始數據計算。啟動時以 seed() 從記憶體中的歷史數據初始化，
+    重新啟動後不會只涵蓋啟動之後的時間。
+    """
+
+    def __init__(self, buckets=None, slots=None):
+        self.buckets = dict(buckets or STANDARD_BUCKETS)
+        self.slots = dict(slots or ROLLUP_SLOTS)
+        self.rollups = {}
+        self.covered_from = {}
+
+    def _create(self, device, timestamp_ms):
+        rollups = self.rollups[device] = {
+            name: Rollup(bucket_ms, self.slots[name]) for name, bucket_ms in self.buckets.items()
+        }
+        # 第一個區間可能只累加到一部分，從下一個區間開始才算完整
+        self.covered_from[device] = {
+            name: bucket_start(bucket_key(timestamp_ms, bucket_ms) + 1, bucket_ms)
+            for name, bucket_ms in self.buckets.items()
+        }
+        return rollups
+
+    def update(self, device, timestamp_ms, temperature, humidity):
+        """接收一筆數據時呼叫，更新該裝置所有標準區間"""
+        rollups = self.rollups.get(device)
+        if rollups is None:
+            rollups = self._create(device, timestamp_ms)
+        for rollup in rollups.values():
+            rollup.update(timestamp_ms, temperature, humidity)
+
+    def seed(self, device, columns):
+        """
+        以一個裝置的欄位陣列（依時間排序）初始化所有標準區間（向量化計算）
+
+        只在該裝置還沒有彙總時使用；涵蓋範圍從第一筆數據的下一個區間開始
+        """
+        if device in self.rollups or not len(columns['timestamp']):
+            return
+        rollups = self._create(device, int(columns['timestamp'][0]))
+        for name, rollup in rollups.items():
+            rollup.seed(bucket_aggregate(columns, self.buckets[name]))
+
+    def coverage(self, device, name):
+        """
+        回傳該裝置在此區間大小下，可由彙總取得的時間範圍 [start_ms, ∞)
+
+        Returns:
+            int: 起始 epoch 毫秒；沒有彙總時回傳 None
+        """
+        if device not in self.rollups:
+            return None
+        rollup = self.rollups[device][name]
+        oldest_retained = bucket_start(int(rollup.bucket.max()) - rollup.slots + 1, rollup.bucket_ms)
+        return max(self.covered_from[device][name], oldest_retained)
+
+    def query(self, device, name, start_ms, end_ms):
+        """
+        取得該裝置在 [start_ms, end_ms) 的彙總結果
+
+        範圍需對齊區間邊界，且在 coverage() 範圍內
+        """
+        rollup = self.rollups[device][name]
+        return rollup.query(bucket_key(start_ms, rollup.bucket_ms), bucket_key(end_ms, rollup.bucket_ms))
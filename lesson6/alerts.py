@@ -0,0 +1,349 @@
+"""
+警報規則引擎（在接收路徑中逐筆增量評估）
+
+規則種類：
+- threshold：數值超過 above 或低於 below（可設定 clear 遲滯值與持續秒數 for）
+- rate：window 秒內的變化速率超過每分鐘 max_per_minute
+- stuck：數值在 seconds 秒內沒有變化（感測器卡住）
+- heartbeat：超過 timeout 秒沒有收到數據（由背景檢查呼叫 check_heartbeats）
+
+每條規則可用 device（萬用字元，例如 "pico-*"）與 topic（MQTT 過濾字串，例如 "living_room/#"）
+限定範圍。第一次收到某個裝置 / 主題的數據時找出符合的規則並建立狀態，
+之後每筆數據只評估符合的規則，不會重新掃描歷史數據。
+警報只在狀態改變時送出（firing / resolved）。
+
+規則檔（JSON）範例：
+    [
+        {"name": "overheat", "type": "threshold", "field": "temperature", "above": 30, "clear": 29, "for": 10},
+        {"name": "offline", "type": "heartbeat", "timeout": 60, "device": "pico-*"}
+    ]
+"""
+
+import json
+import queue
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from fnmatch import fnmatchcase
+from mqtt_broker import topic_matches, valid_filter
+
+ALERT_FIELDS = ('temperature', 'humidity')
+FIELD_LABELS = {'temperature': '溫度', 'humidity': '濕度'}
+SEVERITIES = ('info', 'warning', 'critical')
+
+
+class AlertState:
+    """一個裝置在一條規則下的評估狀態"""
+
+    __slots__ = ('firing', 'since', 'last_ts', 'last_value', 'window')
+
+    def __init__(self):
+        self.firing = False
+        self.since = None
+        self.last_ts = None
+        self.last_value = None
+        self.window = None
+
+
+class Rule(ABC):
+    """規則的共同設定（名稱、範圍、嚴重程度、訊息格式）；各規則種類實作 evaluate()"""
+
+    kind = None
+    default_message = '{device} {rule}'
+    # 是否以接收時間（而不是數據的時間戳記）評估
+    wall_clock = False
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.device = spec.get('device', '*')
+        self.topic = spec.get('topic')
+        self.severity = spec.get('severity', 'warning')
+        self.message = spec.get('message', self.default_message)
+        self.field = spec.get('field')
+        if self.topic is not None and not valid_filter(self.topic):
+            raise ValueError(f"規則 {self.name} 的 topic 不合法: {self.topic}")
+        if self.severity not in SEVERITIES:
+            raise ValueError(f"規則 {self.name} 的 severity 必須是 {', '.join(SEVERITIES)}")
+        if self.field is not None and self.field not in ALERT_FIELDS:
+            raise ValueError(f"規則 {self.name} 的 field 必須是 {', '.join(ALERT_FIELDS)}")
+
+    def matches(self, device, topic):
+        if not fnmatchcase(device, self.device):
+            return False
+        return self.topic is None or topic_matches(self.topic, topic)
+
+    @abstractmethod
+    def evaluate(self, state, timestamp_ms, reading):
+        """
+        評估一筆數據
+
+        Returns:
+            tuple: (是否觸發, 相關數值)，無法判斷時回傳 None（維持原狀態）
+        """
+
+    def describe(self, device, value):
+        label = FIELD_LABELS.get(self.field, self.field or '')
+        return self.message.format(device=device, rule=self.name, field=label, value=value)
+
+
+class ThresholdRule(Rule):
+    kind = 'threshold'
+    default_message = '{device} {field}超出範圍：{value}'
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        if self.field is None:
+            raise ValueError(f"規則 {self.name} 需要 field")
+        self.above = spec.get('above')
+        self.below = spec.get('below')
+        if self.above is None and self.below is None:
+            raise ValueError(f"規則 {self.name} 需要 above 或 below")
+        # 遲滯：觸發後要回到 clear 以內才解除，避免在門檻附近反覆觸發
+        clear = spec.get('clear')
+        self.clear_above = clear if clear is not None and self.above is not None else self.above
+        self.clear_below = clear if clear is not None and self.below is not None else self.below
+        self.hold_ms = int(spec.get('for', 0) * 1000)
+
+    def evaluate(self, state, timestamp_ms, reading):
+        value = reading.get(self.field)
+        if value is None:
+            return None
+        if state.firing:
+            breach = ((self.clear_above is not None and value > self.clear_above)
+                      or (self.clear_below is not None and value < self.clear_below))
+        else:
+            breach = ((self.above is not None and value > self.above)
+                      or (self.below is not None and value < self.below))
+        if not breach:
+            state.since = None
+            return False, value
+        if state.since is None:
+            state.since = timestamp_ms
+        return timestamp_ms - state.since >= self.hold_ms, value
+
+
+class RateRule(Rule):
+    kind = 'rate'
+    default_message = '{device} {field}變化過快：每分鐘 {value}'
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        if self.field is None or 'max_per_minute' not in spec:
+            raise ValueError(f"規則 {self.name} 需要 field 與 max_per_minute")
+        self.max_per_minute = spec['max_per_minute']
+        self.window_ms = int(spec.get('window', 60) * 1000)
+
+    def evaluate(self, state, timestamp_ms, reading):
+        value = reading.get(self.field)
+        if value is None:
+            return None
+        window = state.window
+        if window is None:
+            window = state.window = deque()
+        window.append((timestamp_ms, value))
+        # 只保留 window 秒內的數據（每筆最多移除一次，平均 O(1)）
+        while timestamp_ms - window[0][0] > self.window_ms:
+            window.popleft()
+        first_ts, first_value = window[0]
+        if timestamp_ms - first_ts < self.window_ms // 2:
+            # 數據涵蓋的時間太短，不做判斷
+            return None
+        rate = (value - first_value) / (timestamp_ms - first_ts) * 60000
+        return abs(rate) > self.max_per_minute, round(rate, 2)
+
+
+class StuckRule(Rule):
+    kind = 'stuck'
+    default_message = '{device} {field}已 {value} 秒沒有變化'
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        if self.field is None:
+            raise ValueError(f"規則 {self.name} 需要 field")
+        self.seconds = spec.get('seconds', 600)
+        self.tolerance = spec.get('tolerance', 0.0)
+
+    def evaluate(self, state, timestamp_ms, reading):
+        value = reading.get(self.field)
+        if value is None:
+            return None
+        if state.last_value is None or abs(value - state.last_value) > self.tolerance:
+            state.last_value = value
+            state.since = timestamp_ms
+        unchanged = (timestamp_ms - state.since) / 1000
+        return unchanged >= self.seconds, round(unchanged)
+
+
+class HeartbeatRule(Rule):
+    kind = 'heartbeat'
+    default_message = '{device} 已 {value} 秒沒有回報'
+    # 和背景檢查的目前時間比較，裝置時鐘偏差或批次上傳的舊數據不應影響是否在線
+    wall_clock = True
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.timeout_ms = int(spec.get('timeout', 60) * 1000)
+
+    def evaluate(self, state, timestamp_ms, reading):
+        # 收到數據即解除
+        state.last_ts = timestamp_ms
+        return False, 0
+
+    def check(self, state, now_ms):
+        silent = now_ms - state.last_ts
+        return silent > self.timeout_ms, round(silent / 1000)
+
+
+RULE_TYPES = {cls.kind: cls for cls in (ThresholdRule, RateRule, StuckRule, HeartbeatRule)}
+
+
+def parse_rules(specs):
+    """將規則設定（dict 列表）轉換為規則物件"""
+    rules = []
+    names = set()
+    for spec in specs:
+        kind = spec.get('type')
+        if kind not in RULE_TYPES:
+            raise ValueError(f"未知的規則種類: {kind}（可用: {', '.join(RULE_TYPES)}）")
+        if 'name' not in spec:
+            raise ValueError(f"規則缺少 name: {spec}")
+        if spec['name'] in names:
+            raise ValueError(f"規則名稱重複: {spec['name']}")
+        names.add(spec['name'])
+        rules.append(RULE_TYPES[kind](spec))
+    return rules
+
+
+def load_rules(path):
+    """讀取規則檔（JSON 陣列）"""
+    with open(path, encoding='utf-8') as f:
+        return parse_rules(json.load(f))
+
+
+class AlertEngine:
+    """
+    增量評估警報規則
+
+    evaluate() 在接收路徑中逐筆呼叫，只評估該裝置 / 主題符合的規則；
+    警報狀態改變時呼叫 on_alert(alert)
+    """
+
+    def __init__(self, rules, on_alert):
+        self.rules = list(rules)
+        self.on_alert = on_alert
+        # (裝置, 主題) → [(規則, 狀態)]：第一次出現時編譯一次
+        self._compiled = {}
+        # (裝置, 規則名稱) → 狀態（同一裝置的不同主題共用）
+        self._states = {}
+        # 需要背景檢查的心跳規則：[(裝置, 規則, 狀態)]
+        self._heartbeats = []
+        # (裝置, 規則名稱) → 目前觸發中的警報
+        self.active = {}
+        self.fired = 0
+        self._lock = threading.Lock()
+
+    def _compile(self, device, topic):
+        evaluators = []
+        for rule in self.rules:
+            if not rule.matches(device, topic):
+                continue
+            key = (device, rule.name)
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = AlertState()
+                if isinstance(rule, HeartbeatRule):
+                    self._heartbeats.append((device, rule, state))
+            evaluators.append((rule, state))
+        self._compiled[(device, topic)] = evaluators
+        return evaluators
+
+    def evaluate(self, device, topic, timestamp_ms, reading, received_ms=None):
+        """
+        評估一筆數據（O(符合的規則數)）
+
+        Args:
+            reading: 欄位名稱 → 數值
+            received_ms: 接收時間（心跳規則使用，省略時同 timestamp_ms）
+        """
+        if received_ms is None:
+            received_ms = timestamp_ms
+        if not self.rules:
+            return
+        with self._lock:
+            evaluators = self._compiled.get((device, topic))
+            if evaluators is None:
+                evaluators = self._compile(device, topic)
+            for rule, state in evaluators:
+                result = rule.evaluate(state, received_ms if rule.wall_clock else timestamp_ms, reading)
+                if result is not None:
+                    self._transition(device, rule, state, timestamp_ms, *result)
+
+    def check_heartbeats(self, now_ms):
+        """檢查心跳規則（背景每秒呼叫一次）"""
+        with self._lock:
+            for device, rule, state in self._heartbeats:
+                firing, value = rule.check(state, now_ms)
+                self._transition(device, rule, state, now_ms, firing, value)
+
+    def _transition(self, device, rule, state, timestamp_ms, firing, value):
+        if firing == state.firing:
+            return
+        state.firing = firing
+        key = (device, rule.name)
+        alert = {
+            'rule': rule.name,
+            'type': rule.kind,
+            'device': device,
+            'state': 'firing' if firing else 'resolved',
+            'severity': rule.severity,
+            'field': rule.field,
+            'value': value,
+            'message': rule.describe(device, value) if firing else f"已解除：{rule.describe(device, value)}",
+            'timestamp': timestamp_ms,
+        }
+        if firing:
+            self.active[key] = alert
+            self.fired += 1
+        else:
+            self.active.pop(key, None)
+        self.on_alert(alert)
+
+    def active_alerts(self):
+        with self._lock:
+            return list(self.active.values())
+
+
+class AlertDispatcher:
+    """
+    背景送出警報（Socket.IO、MQTT 等），接收路徑只放入佇列
+
+    sinks 為 callable 列表，每個警報依序呼叫 sink(alert)
+    """
+
+    def __init__(self, sinks, queue_size=10000):
+        self.sinks = list(sinks)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dispatched = 0
+        self.dropped = 0
+        self._thread = None
+
+    def submit(self, alert):
+        try:
+            self.queue.put_nowait(alert)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='alert-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            alert = self.queue.get()
+            for sink in self.sinks:
+                try:
+                    sink(alert)
+                except Exception as e:
+                    print(f"⚠️  送出警報時發生錯誤: {e}")
+            self.dispatched += 1
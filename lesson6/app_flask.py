@@ -3,77 +3,630 @@ Flask 版本的 MQTT 監控應用程式
 替代 Streamlit，解決 Raspberry Pi 相容性問題
 """
 
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, request
 from flask_socketio import SocketIO
+from werkzeug.datastructures import MultiDict
 import paho.mqtt.client as mqtt
-from datetime import datetime
 import json
+from collections import namedtuple
+from types import MappingProxyType
+from datetime import datetime
 import threading
-import csv
 import os
+import sys
+import time
+import signal
+import subprocess
+import atexit
+import numpy as np
+from batch_writer import BatchedWriter, CsvSink
+from ring_buffer import RingStore, encode_light, decode_light, format_timestamp, format_timestamps, columns_to_json
+from segment_store import SegmentStore, merge_columns
+from sharding import ShardedStore, ShardTail, shard_dirs
+from aggregate import RollupStore, parse_bucket, align_down, align_up, bucket_aggregate, combine_aggregates, aggregate_to_json
+from downsample import downsample
+from broadcaster import Broadcaster
+from ingest import IngestPipeline
+from payload_codec import CodecRegistry, parse_topic_codecs, parse_timestamp_ms, HAS_CBOR2
+from startup_loader import read_csv_tail, save_checkpoint, load_checkpoint
+from metrics import Registry, process_rss_bytes, LATENCY_BUCKETS
+from mqtt_broker import Broker
+from xlsx_export import ExcelMirror, export_to_tempfile, stream_file, XLSX_MIMETYPE
+from response_cache import ResponseCache
+from stats import StatsEngine
+from dedup import DedupIndex, DUPLICATE
+from reorder import ReorderBuffer
+from alerts import AlertEngine, AlertDispatcher, load_rules
+from stream_export import iter_windows, iter_csv, iter_ndjson, gzip_stream, CSV_MIMETYPE, NDJSON_MIMETYPE
 
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
 # MQTT 設定
-MQTT_BROKER = "localhost"
-MQTT_PORT = 1883
+MQTT_BROKER = os.environ.get('MQTT_BROKER', 'localhost')
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 1883))
+# 內建 MQTT broker（EMBEDDED_BROKER=1 時不需要另外安裝 mosquitto，
+# 應用程式以本機訂閱直接接收，不經過 TCP；Pico 等裝置仍連線到 MQTT_PORT）
+EMBEDDED_BROKER = os.environ.get('EMBEDDED_BROKER', '0') == '1'
+EMBEDDED_BROKER_HOST = os.environ.get('EMBEDDED_BROKER_HOST', '0.0.0.0')
 MQTT_TOPIC = "living_room/sensor"
 
-# 全域數據儲存
-sensor_data = []
+# 各主題使用的 payload 編碼（支援 + / # 萬用字元）
+# 可用環境變數 PAYLOAD_CODECS 覆寫，格式：主題=編碼;主題=編碼
+TOPIC_CODECS = {
+    MQTT_TOPIC: 'json',
+    f'{MQTT_TOPIC}/bin/+': 'struct',      # 18 bytes 固定格式，裝置名稱為主題最後一層
+}
+if HAS_CBOR2:
+    TOPIC_CODECS[f'{MQTT_TOPIC}/cbor/+'] = 'cbor'
+if os.environ.get('PAYLOAD_CODECS'):
+    TOPIC_CODECS = parse_topic_codecs(os.environ['PAYLOAD_CODECS'])
+codecs = CodecRegistry(TOPIC_CODECS)
+
+# 歷史數據設定
+# 每個裝置保留的筆數（預設 17280 筆 = 每 5 秒一筆，保留一天），可用環境變數調整
+HISTORY_RETENTION = int(os.environ.get('HISTORY_RETENTION', 17280))
+# /api/history 預設回傳的筆數
+HISTORY_LIMIT = 100
+# 沒有 device 欄位時使用的裝置名稱
+DEFAULT_DEVICE = 'default'
+
+# /api/history 只指定 bucket 時預設查詢的時間長度（毫秒）
+AGGREGATE_DEFAULT_WINDOW = 24 * 3600 * 1000
+
+# 全域數據儲存（每個裝置一個環狀緩衝區）
+sensor_data = RingStore(HISTORY_RETENTION)
+# 標準區間（1m / 1h / 1d）的增量彙總
+rollups = RollupStore()
+# 每個裝置的串流統計（平均、標準差、EWMA、最小 / 最大值、p50 / p95）
+STATS_EWMA_ALPHA = float(os.environ.get('STATS_EWMA_ALPHA', 0.1))
+STATS_QUANTILE_WINDOW = int(os.environ.get('STATS_QUANTILE_WINDOW', 1000))
+stats_engine = StatsEngine(alpha=STATS_EWMA_ALPHA, window=STATS_QUANTILE_WINDOW)
+# QoS 1 重送去重：每個裝置記得最近 DEDUP_WINDOW 個 msg_id（0 表示停用）
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 1024))
+dedup_index = DedupIndex(DEDUP_WINDOW) if DEDUP_WINDOW > 0 else None
+# 使用裝置送出的時間戳記（0 時一律使用接收時間）；超出合理範圍（落後 / 超前接收時間太多）時改用接收時間
+DEVICE_TIMESTAMPS = os.environ.get('DEVICE_TIMESTAMPS', '1') == '1'
+DEVICE_CLOCK_MAX_LAG_MS = int(float(os.environ.get('DEVICE_CLOCK_MAX_LAG', 7 * 24 * 3600)) * 1000)
+DEVICE_CLOCK_MAX_SKEW_MS = int(float(os.environ.get('DEVICE_CLOCK_MAX_SKEW', 60)) * 1000)
+# 每個裝置的重新排序窗口（毫秒，0 表示停用）：數據暫存這麼久後依時間順序寫入
+REORDER_WINDOW_MS = int(os.environ.get('REORDER_WINDOW_MS', 1000))
+REORDER_MAX_ROWS = int(os.environ.get('REORDER_MAX_ROWS', 1000))
+reorder_buffer = ReorderBuffer(REORDER_WINDOW_MS, REORDER_MAX_ROWS) if REORDER_WINDOW_MS > 0 else None
+# 最新數據（timestamp 為 epoch 毫秒，API 輸出時才格式化）
 latest_data = {
     'light_status': '未知',
     'temperature': 0,
     'humidity': 0,
-    'timestamp': None
+    'timestamp': None,
+    'device': None
 }
 mqtt_connected = False
+# 全域遞增的接收序號（每筆數據一個，供 /api/history?since= 增量查詢）
+sequence = 0
+
+# 讀取端使用的不可變快照：接收端每次更新後建立新的快照並整個替換（指定參照是原子操作）。
+# 讀取端只取一次參照，最新數據、序號、筆數與連線狀態一定屬於同一個版本，不需要和接收端競爭鎖；
+# 環狀緩衝區以 until_seq=快照序號 讀取，不會看到快照之後才寫入的數據
+Snapshot = namedtuple('Snapshot', ['seq', 'latest', 'total_records', 'mqtt_connected'])
+snapshot = Snapshot(0, MappingProxyType(latest_data), 0, False)
+
+def publish_snapshot():
+    """發布目前狀態的快照（latest_data 只會被整個替換、不會原地修改，因此不需複製）"""
+    global snapshot
+    snapshot = Snapshot(sequence, MappingProxyType(latest_data), sensor_data.size, mqtt_connected)
+
+# 數據儲存目錄（二進位欄位式儲存，正式的數據來源）
+DATA_DIR = os.environ.get('DATA_DIR', 'data')
+SEGMENT_MAX_ROWS = int(os.environ.get('SEGMENT_MAX_ROWS', 1_000_000))
+# 已關閉區段（前幾天的數據）的壓縮格式：gzip / zstd / none（只記錄 manifest）
+STORE_COMPRESSION = os.environ.get('STORE_COMPRESSION', 'gzip')
+STORE_COMPACT_INTERVAL = float(os.environ.get('STORE_COMPACT_INTERVAL', 3600))
+
+# 水平擴充：INGEST_PROCESSES > 1 時，本行程只提供 API，另外啟動這麼多個接收行程，
+# 以 MQTT 共享訂閱（$share/<SHARE_GROUP>/<主題>）分攤訊息，各自寫入 SHARD_ROOT 下的一個儲存分片
+INGEST_PROCESSES = int(os.environ.get('INGEST_PROCESSES', 1))
+SHARE_GROUP = os.environ.get('SHARE_GROUP', 'iot-monitor')
+SHARD_ROOT = os.environ.get('SHARD_ROOT', f'{DATA_DIR}-shards')
+# API 行程讀取分片新數據的間隔（秒）
+SHARD_POLL_INTERVAL = float(os.environ.get('SHARD_POLL_INTERVAL', 0.5))
+# 接收行程由 API 行程啟動時設定（分片編號）
+SHARD_INDEX = os.environ.get('SHARD_INDEX')
+# single：單一行程；api：只提供 API（讀取分片）；shard：只接收並寫入分片
+INGEST_ROLE = 'shard' if SHARD_INDEX is not None else ('api' if INGEST_PROCESSES > 1 else 'single')
+# broker 分配共享訂閱訊息的方式：sticky（依發布者的 client id 固定分配）/ round_robin（輪流）。
+# 去重與重新排序的狀態在各接收行程內，同一個裝置必須固定送到同一個行程，INGEST_PROCESSES > 1 時只接受 sticky。
+# 內建 broker 以此設定啟動；外部 broker 預設視為 round_robin（mosquitto），
+# 已設定依發布者分配（例如 EMQX 的 hash_clientid）時請設為 sticky
+SHARE_STRATEGY = os.environ.get('SHARE_STRATEGY', 'sticky' if EMBEDDED_BROKER else 'round_robin')
+# 接收行程把自己的指標寫到分片目錄的檔案，API 行程的 /metrics 加上 shard 標籤後一起輸出
+SHARD_METRICS_FILE = 'metrics.prom'
+SHARD_METRICS_INTERVAL = float(os.environ.get('SHARD_METRICS_INTERVAL', 5))
+# 連線 MQTT 時使用 v5（接收行程連線外部 broker 時由 API 行程設定；內建 broker 只支援 3.1.1，同樣接受共享訂閱）
+MQTT_V5 = os.environ.get('MQTT_V5', '0') == '1'
+
+# 警報規則檔（JSON，檔案不存在時不啟用警報）與警報發布的 MQTT 主題（後面加上 /<裝置>）
+ALERT_RULES = os.environ.get('ALERT_RULES', 'alert_rules.json')
+ALERT_TOPIC = os.environ.get('ALERT_TOPIC', 'living_room/alerts')
+# 心跳規則的檢查間隔（秒）
+ALERT_CHECK_INTERVAL = float(os.environ.get('ALERT_CHECK_INTERVAL', 1.0))
+
+# WebSocket 推送設定：每個時間窗口合併推送一次，並限制每秒最多推送次數
+BROADCAST_WINDOW = float(os.environ.get('BROADCAST_WINDOW', 0.25))
+BROADCAST_MAX_RATE = float(os.environ.get('BROADCAST_MAX_RATE', 4))
+
+# 接收管線設定
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 2))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_POLICY = os.environ.get('INGEST_POLICY', 'drop_oldest')  # block / drop_oldest / sample
+INGEST_SAMPLE_EVERY = int(os.environ.get('INGEST_SAMPLE_EVERY', 10))
+# 是否印出每一筆收到的訊息（大量訊息時建議設為 0）
+LOG_MESSAGES = os.environ.get('LOG_MESSAGES', '1') == '1'
+
+# 記憶體狀態檢查點（重新啟動時直接載入）
+CHECKPOINT_FILE = os.path.join(DATA_DIR, 'checkpoint.npz')
+CHECKPOINT_INTERVAL = float(os.environ.get('CHECKPOINT_INTERVAL', 60))
+
+# CSV 檔案路徑（供人工查看的副本，可用 CSV_MIRROR=0 關閉）
+CSV_FILE = os.environ.get('CSV_FILE', 'sensor_data.csv')
+CSV_FIELDNAMES = ['時間戳記', '電燈狀態', '溫度', '濕度']
+CSV_MIRROR = os.environ.get('CSV_MIRROR', '1') == '1'
+# 每天換一個 CSV 檔案（前一天的檔案改名為 sensor_data_YYYY-MM-DD.csv 並以 gzip 壓縮）
+CSV_ROTATE = os.environ.get('CSV_ROTATE', '1') == '1'
+
+# Excel 鏡像（每日一個 xlsx 檔案，供人工查看，可用 EXCEL_MIRROR=0 關閉）
+EXCEL_DIR = os.environ.get('EXCEL_DIR', 'exports')
+EXCEL_MIRROR = os.environ.get('EXCEL_MIRROR', '1') == '1'
+EXCEL_MIRROR_INTERVAL = float(os.environ.get('EXCEL_MIRROR_INTERVAL', 600))
+# /api/export.xlsx 未指定 from 時匯出的時間長度（毫秒）
+EXPORT_DEFAULT_WINDOW = 24 * 3600 * 1000
+
+# 批次寫入設定（可用環境變數調整）
+WRITER_QUEUE_SIZE = int(os.environ.get('WRITER_QUEUE_SIZE', 10000))
+WRITER_BATCH_SIZE = int(os.environ.get('WRITER_BATCH_SIZE', 500))
+WRITER_FLUSH_INTERVAL = float(os.environ.get('WRITER_FLUSH_INTERVAL', 1.0))
+WRITER_FSYNC = os.environ.get('WRITER_FSYNC', 'interval')  # never / batch / interval
+
+# 效能指標（/metrics，Prometheus 文字格式）
+# 裝置名稱與主題來自訊息內容，依裝置 / 主題的指標最多保留這麼多組標籤值，其餘計入 __other__
+METRICS_MAX_LABEL_VALUES = int(os.environ.get('METRICS_MAX_LABEL_VALUES', 100))
+metrics_registry = Registry()
+messages_by_topic = metrics_registry.counter('iot_messages_total', '收到的 MQTT 訊息數（依主題）', ['topic'],
+                                             max_label_values=METRICS_MAX_LABEL_VALUES)
+messages_by_device = metrics_registry.counter('iot_device_messages_total', '處理完成的數據筆數（依裝置）', ['device'],
+                                              max_label_values=METRICS_MAX_LABEL_VALUES)
+decode_errors = metrics_registry.counter('iot_decode_errors_total', '解碼失敗的訊息數')
+decode_seconds = metrics_registry.histogram('iot_decode_seconds', '單筆訊息解碼時間（秒）')
+e2e_latency_seconds = metrics_registry.histogram(
+    'iot_e2e_latency_seconds', '裝置送出（sent_ts）到處理完成的延遲（秒）',
+    buckets=LATENCY_BUCKETS + (5.0, 10.0, 30.0))
+persist_seconds = metrics_registry.histogram('iot_persist_seconds', '每批寫入儲存的時間（秒）', ['sink'])
+persist_rows = metrics_registry.counter('iot_persist_rows_total', '寫入儲存的筆數', ['sink'])
+persist_lost = metrics_registry.counter('iot_persist_lost_total', '沒有寫入儲存的筆數（dropped：佇列已滿；failed：寫入錯誤）', ['sink', 'reason'])
+emit_seconds = metrics_registry.histogram('iot_emit_seconds', '每次 Socket.IO 推送（序列化與送出）的時間（秒）')
+emit_rows = metrics_registry.counter('iot_emit_rows_total', '透過 Socket.IO 推送的筆數')
+csv_bytes = metrics_registry.counter('iot_csv_bytes_written_total', '本次啟動後寫入 CSV 副本的 bytes')
+queue_depth = metrics_registry.gauge('iot_ingest_queue_depth', '接收佇列中等待處理的訊息數')
+ingest_events = metrics_registry.counter('iot_ingest_events_total', '接收佇列的累計計數（依事件）', ['event'])
+http_cache_results = metrics_registry.counter('iot_http_cache_total', '預先序列化回應的使用次數（served / not_modified）', ['result'])
+duplicates_total = metrics_registry.counter('iot_duplicates_total', '依 msg_id 判定為重送而丟棄的訊息數', ['device'],
+                                            max_label_values=METRICS_MAX_LABEL_VALUES)
+timestamp_sources = metrics_registry.counter('iot_timestamps_total', '數據時間的來源（device / received / rejected）', ['source'])
+commit_errors = metrics_registry.counter('iot_commit_errors_total', '寫入時發生錯誤而略過的數據筆數')
+reorder_events = metrics_registry.counter('iot_reorder_events_total', '重新排序緩衝區的累計計數（reordered / late）', ['event'])
+reorder_held = metrics_registry.gauge('iot_reorder_held', '重新排序緩衝區目前暫存的筆數')
+sequence_events = metrics_registry.counter('iot_sequence_events_total', '所有裝置合計的序號事件數（reordered / resets）', ['event'])
+sequence_missing = metrics_registry.gauge('iot_sequence_missing', '所有裝置合計目前遺失的序號數（晚到時減少）')
+alerts_total = metrics_registry.counter('iot_alerts_total', '警報狀態改變的次數', ['rule', 'state'])
+ingest_processes_alive = metrics_registry.gauge('iot_ingest_processes', '執行中的接收行程數（INGEST_PROCESSES > 1 時）')
+socketio_clients = metrics_registry.gauge('iot_socketio_clients', '目前連線的 Socket.IO 客戶端數')
+metrics_registry.gauge('iot_process_rss_bytes', '行程常駐記憶體（bytes）').set_function(process_rss_bytes)
+
+# 預先序列化的 /api/latest 與 /api/history 回應（同一個版本只序列化一次）
+response_cache = ResponseCache(lambda payload: app.json.dumps(payload).encode('utf-8'))
+
+def observe_persist(sink):
+    """建立背景寫入器的 on_batch 回調（記錄每批寫入時間）"""
+    seconds = persist_seconds.labels(sink=sink)
+    rows = persist_rows.labels(sink=sink)
+
+    def on_batch(count, elapsed):
+        seconds.observe(elapsed)
+        rows.inc(count)
+
+    return on_batch
+
+# 背景寫入器（MQTT 執行緒不直接碰觸 SD 卡）
+store = SegmentStore(DATA_DIR, max_segment_rows=SEGMENT_MAX_ROWS)
+store_writer = BatchedWriter(
+    store,
+    queue_size=WRITER_QUEUE_SIZE,
+    batch_size=WRITER_BATCH_SIZE,
+    flush_interval=WRITER_FLUSH_INTERVAL,
+    fsync=WRITER_FSYNC,
+    name='segment-writer',
+    on_batch=observe_persist('segment')
+)
+csv_writer = BatchedWriter(
+    CsvSink(CSV_FILE, CSV_FIELDNAMES, rotate=CSV_ROTATE, timestamp_column=0),
+    queue_size=WRITER_QUEUE_SIZE,
+    batch_size=WRITER_BATCH_SIZE,
+    flush_interval=WRITER_FLUSH_INTERVAL,
+    fsync=WRITER_FSYNC,
+    name='csv-writer',
+    on_batch=observe_persist('csv')
+)
+csv_bytes.set_function(lambda: csv_writer.sink.bytes_written)
+for sink, writer in (('segment', store_writer), ('csv', csv_writer)):
+    for reason in ('dropped', 'failed'):
+        persist_lost.labels(sink=sink, reason=reason).set_function(lambda writer=writer, reason=reason: getattr(writer, reason))
 
-# CSV 檔案路徑
-CSV_FILE = 'sensor_data.csv'
+# API 行程不寫入儲存：讀取時合併自己的目錄（切換為多行程前的數據）與所有分片，
+# 並追蹤分片新寫入的數據來更新記憶體中的緩衝區、彙總、統計、警報與推送
+shard_tail = None
+if INGEST_ROLE == 'api':
+    store = ShardedStore([store] + [SegmentStore(path, max_segment_rows=SEGMENT_MAX_ROWS)
+                                    for path in shard_dirs(SHARD_ROOT, INGEST_PROCESSES)])
+    shard_tail = ShardTail(store.stores)
+if reorder_buffer is not None:
+    reorder_held.set_function(lambda: reorder_buffer.held)
+    for event in ('reordered', 'late'):
+        reorder_events.labels(event=event).set_function(lambda event=event: getattr(reorder_buffer, event))
+if dedup_index is not None:
+    sequence_missing.set_function(lambda: dedup_index.totals()['missing'])
+    for event in ('reordered', 'resets'):
+        sequence_events.labels(event=event).set_function(lambda event=event: dedup_index.totals()[event])
 
 def load_from_csv():
-    """從 CSV 檔案載入歷史數據"""
-    global sensor_data
+    """
+    從 CSV 檔案載入歷史數據
+
+    從檔案尾端往前讀取，只解析最後 HISTORY_RETENTION 筆，
+    不論 CSV 檔案多大，啟動時間與記憶體都固定
+    """
+    global latest_data, sequence
     if os.path.exists(CSV_FILE):
         try:
-            with open(CSV_FILE, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                loaded_data = []
-                for row in reader:
-                    data_dict = {
-                        'timestamp': row['時間戳記'],
-                        'light_status': row['電燈狀態'],
-                        'temperature': float(row['溫度']),
-                        'humidity': float(row['濕度'])
-                    }
-                    loaded_data.append(data_dict)
-                
-                # 只保留最近 100 筆
-                sensor_data = loaded_data[-100:]
-                
-                # 更新最新數據
-                if sensor_data:
-                    global latest_data
-                    latest_data = sensor_data[-1].copy()
-                
-                print(f"✅ 已載入 {len(sensor_data)} 筆歷史數據")
+            rows = read_csv_tail(CSV_FILE, HISTORY_RETENTION)
+            timestamp_ms = None
+            for row in rows:
+                timestamp_ms = int(datetime.strptime(row['時間戳記'], '%Y-%m-%d %H:%M:%S').timestamp() * 1000)
+                sequence += 1
+                sensor_data.append(
+                    row.get('裝置') or DEFAULT_DEVICE,
+                    timestamp_ms,
+                    float(row['溫度']),
+                    float(row['濕度']),
+                    encode_light(row['電燈狀態']),
+                    sequence
+                )
+            
+            # 更新最新數據
+            if rows:
+                last_row = rows[-1]
+                latest_data = {
+                    'light_status': last_row['電燈狀態'],
+                    'temperature': float(last_row['溫度']),
+                    'humidity': float(last_row['濕度']),
+                    'timestamp': timestamp_ms,
+                    'device': last_row.get('裝置') or DEFAULT_DEVICE
+                }
+            
+            print(f"✅ 已載入 {len(sensor_data)} 筆歷史數據")
         except Exception as e:
             print(f"⚠️  載入 CSV 檔案時發生錯誤: {e}")
 
+def load_history():
+    """
+    從數據儲存載入歷史數據到記憶體
+
+    1. 有檢查點時先還原檢查點，再從儲存補上檢查點之後的數據
+    2. 沒有檢查點時，每個裝置只讀取最近 HISTORY_RETENTION 筆（memmap 切片）
+    3. 儲存尚無數據時退回讀取舊的 CSV 檔案
+    """
+    global latest_data, sequence
+    try:
+        checkpoint_latest = load_checkpoint(CHECKPOINT_FILE, sensor_data)
+    except Exception as e:
+        print(f"⚠️  載入檢查點時發生錯誤，改為從儲存載入: {e}")
+        sensor_data.buffers.clear()
+        checkpoint_latest = None
+    if checkpoint_latest is not None:
+        latest_data = checkpoint_latest
+        sequence = sensor_data.last_seq()
+        print(f"✅ 已從檢查點載入 {len(sensor_data)} 筆歷史數據")
+
+    devices = store.devices()
+    if not devices:
+        if checkpoint_latest is None:
+            load_from_csv()
+        return
+
+    latest_ts = None
+    for device in devices:
+        buffer = sensor_data.buffer(device)
+        last = buffer.last()
+        if last is None:
+            columns = store.tail(device, HISTORY_RETENTION)
+        else:
+            # 只補上檢查點之後寫入的數據
+            columns = store.read(device, start_ms=int(buffer.timestamp[last]) + 1)
+            columns = {name: values[-HISTORY_RETENTION:] for name, values in columns.items()}
+        count = len(columns['timestamp'])
+        buffer.extend(
+            columns['timestamp'],
+            columns['temperature'],
+            columns['humidity'],
+            columns['light'],
+            np.arange(sequence + 1, sequence + count + 1, dtype=np.int64)
+        )
+        sequence += count
+        if count and (latest_ts is None or columns['timestamp'][-1] > latest_ts):
+            latest_ts = int(columns['timestamp'][-1])
+            latest_data = {
+                'light_status': decode_light(columns['light'][-1:])[0],
+                'temperature': round(float(columns['temperature'][-1]), 2),
+                'humidity': round(float(columns['humidity'][-1]), 2),
+                'timestamp': latest_ts,
+                'device': device
+            }
+    print(f"✅ 已從 {DATA_DIR}/ 載入 {len(sensor_data)} 筆歷史數據（{len(devices)} 個裝置）")
+
+def seed_stats():
+    """以記憶體中的歷史數據初始化串流統計（向量化計算，不逐筆更新）"""
+    for device in sensor_data.devices():
+        stats_engine.seed(device, sensor_data.recent(None, device))
+
+def seed_rollups():
+    """以記憶體中的歷史數據初始化 1m / 1h / 1d 彙總（向量化計算；接收行程不使用彙總）"""
+    if INGEST_ROLE == 'shard':
+        return
+    for device in sensor_data.devices():
+        rollups.seed(device, sensor_data.recent(None, device))
+
+def seed_reorder():
+    """以記憶體中各裝置最新的時間設定重新排序緩衝區（重新啟動後不會寫入比已儲存數據還舊的數據）"""
+    if reorder_buffer is None:
+        return
+    for device in sensor_data.devices():
+        timestamps = sensor_data.recent(1, device)['timestamp']
+        if len(timestamps):
+            reorder_buffer.seed(device, int(timestamps[-1]))
+
+def write_checkpoint():
+    """將目前的快照寫入檢查點（不持有 ingest_lock，寫檔期間不會阻塞接收端）"""
+    current = snapshot
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        save_checkpoint(CHECKPOINT_FILE, sensor_data, dict(current.latest), until_seq=current.seq)
+    except Exception as e:
+        print(f"⚠️  寫入檢查點時發生錯誤: {e}")
+
+def checkpoint_loop():
+    """每隔 CHECKPOINT_INTERVAL 秒寫入一次檢查點"""
+    while True:
+        time.sleep(CHECKPOINT_INTERVAL)
+        write_checkpoint()
+
+def compact_loop():
+    """每隔 STORE_COMPACT_INTERVAL 秒壓縮已關閉的區段"""
+    codec = None if STORE_COMPRESSION == 'none' else STORE_COMPRESSION
+    while True:
+        try:
+            count = store.compact(codec)
+            if count:
+                print(f"🗜️  已壓縮 {count} 個區段")
+        except Exception as e:
+            print(f"⚠️  壓縮區段時發生錯誤: {e}")
+        time.sleep(STORE_COMPACT_INTERVAL)
+
+def read_history(limit, device=None, until_seq=None):
+    """
+    讀取最近 limit 筆歷史數據
+
+    優先使用記憶體中的環狀緩衝區；要求的筆數超過緩衝區容量時，
+    較舊的部分從數據儲存讀取
+
+    Args:
+        until_seq: 只取接收序號小於等於此值的數據（快照的版本）
+
+    Returns:
+        dict: 欄位名稱對應 NumPy 陣列（依時間由舊到新）
+    """
+    devices = [device] if device is not None else sensor_data.devices()
+    parts = []
+    for name in devices:
+        recent = sensor_data.recent(limit, name, until_seq)
+        missing = limit - len(recent['timestamp'])
+        if missing > 0 and len(recent['timestamp']) == HISTORY_RETENTION:
+            older = store.read(name, end_ms=int(recent['timestamp'][0]))
+            older = {key: values[-missing:] for key, values in older.items()}
+            recent = merge_columns([older, recent])
+        parts.append(recent)
+    columns = merge_columns(parts)
+    return {key: values[-limit:] for key, values in columns.items()}
+
+def read_range(start_ms, end_ms, device=None, until_seq=None):
+    """
+    讀取 [start_ms, end_ms) 時間範圍內的原始數據
+
+    範圍在環狀緩衝區內時直接切片；較舊的部分從數據儲存讀取
+
+    Args:
+        until_seq: 只取接收序號小於等於此值的記憶體數據（對應某個快照的版本）
+
+    Returns:
+        dict: 欄位名稱對應 NumPy 陣列（依時間由舊到新）
+    """
+    devices = [device] if device is not None else sensor_data.devices()
+    parts = []
+    for name in devices:
+        recent = sensor_data.recent(None, name, until_seq=until_seq)
+        timestamps = recent['timestamp']
+        lo = int(np.searchsorted(timestamps, start_ms, 'left'))
+        hi = int(np.searchsorted(timestamps, end_ms, 'left'))
+        parts.append({key: values[lo:hi] for key, values in recent.items()})
+        # 緩衝區已滿且範圍起點比緩衝區還舊：較舊的部分從儲存讀取
+        if len(timestamps) == HISTORY_RETENTION and start_ms < timestamps[0]:
+            parts.append(store.read(name, start_ms, min(end_ms, int(timestamps[0]))))
+    return merge_columns(parts)
+
+def read_aggregate(start_ms, end_ms, bucket, device=None, until_seq=None):
+    """
+    依時間區間彙總 [start_ms, end_ms) 的數據
+
+    標準區間（1m / 1h / 1d）已累加的部分直接取自增量彙總，
+    其餘部分（開始累加之前的數據或非標準區間）以向量化方式從原始數據計算（until_seq 同 read_range）
+
+    Returns:
+        tuple: (彙總結果, 區間大小毫秒)
+    """
+    bucket_ms = parse_bucket(bucket)
+    # 對齊區間邊界，每個區間都是完整的
+    start = align_down(start_ms, bucket_ms)
+    end = align_up(end_ms, bucket_ms)
+
+    devices = [device] if device is not None else sensor_data.devices()
+    results = []
+    for name in devices:
+        split = end
+        if rollups.buckets.get(bucket) == bucket_ms:
+            covered = rollups.coverage(name, bucket)
+            if covered is not None:
+                split = min(max(start, covered), end)
+                results.append(rollups.query(name, bucket, split, end))
+        if split > start:
+            results.append(bucket_aggregate(read_range(start, split, name, until_seq), bucket_ms))
+    return combine_aggregates(results), bucket_ms
+
+def parse_time(value):
+    """
+    解析查詢參數中的時間
+
+    支援 epoch 毫秒（整數）或 ISO 格式本地時間（例如 2025-12-01 08:00:00）
+
+    Returns:
+        int: epoch 毫秒
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+def parse_export_range():
+    """
+    解析匯出 API 的 from / to 參數
+
+    Returns:
+        tuple: (start_ms, end_ms)
+    """
+    end_ms = parse_time(request.args['to']) if 'to' in request.args else int(time.time() * 1000) + 1
+    if 'from' in request.args:
+        start_ms = parse_time(request.args['from'])
+    else:
+        start_ms = end_ms - EXPORT_DEFAULT_WINDOW
+    if start_ms >= end_ms:
+        raise ValueError("from 必須早於 to")
+    return start_ms, end_ms
+
+def first_timestamp(device=None):
+    """最早一筆數據的時間（匯出時略過更早的空白時間窗口）"""
+    firsts = [store.first_timestamp(device)]
+    for name in ([device] if device is not None else sensor_data.devices()):
+        timestamps = sensor_data.recent(None, name)['timestamp']
+        if len(timestamps):
+            firsts.append(int(timestamps[0]))
+    firsts = [t for t in firsts if t is not None]
+    return min(firsts) if firsts else None
+
+# 定期把新數據鏡像到每日的 xlsx 檔案
+excel_mirror = ExcelMirror(read_range, EXCEL_DIR, EXCEL_MIRROR_INTERVAL, changed=lambda: snapshot.seq,
+                           read_since=lambda seq, until_seq: sensor_data.since(seq, until_seq=until_seq))
+
 def save_to_csv(data):
-    """儲存數據到 CSV 檔案"""
-    file_exists = os.path.exists(CSV_FILE)
-    
-    with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
-        fieldnames = ['時間戳記', '電燈狀態', '溫度', '濕度']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        
-        if not file_exists:
-            writer.writeheader()
-        
-        writer.writerow(data)
+    """
+    儲存數據到 CSV 檔案
+
+    只把數據放入背景寫入器的佇列（不阻塞），實際寫入由背景執行緒批次完成
+    """
+    # 佇列已滿時丟棄，由寫入器計數並在背景印出丟棄筆數
+    csv_writer.write([data[name] for name in CSV_FIELDNAMES])
+
+def build_broadcast(rows):
+    """
+    將一個時間窗口內累積的數據組成一個推送事件
+
+    Args:
+        rows: [(device, timestamp_ms, temperature, humidity, light_status, seq), ...]
+    """
+    devices, timestamps, temperatures, humidities, light_statuses, seqs = zip(*rows)
+    return {
+        'rows': {
+            'timestamp': format_timestamps(np.array(timestamps, dtype=np.int64)),
+            'temperature': list(temperatures),
+            'humidity': list(humidities),
+            'light_status': list(light_statuses),
+            'device': list(devices)
+        },
+        'first_seq': seqs[0],
+        'cursor': seqs[-1],
+        'latest': latest_payload(snapshot)
+    }
+
+# 合併推送到前端（不在 MQTT 執行緒中序列化或推送）
+broadcaster = Broadcaster(
+    socketio,
+    build_broadcast,
+    window=BROADCAST_WINDOW,
+    max_rate=BROADCAST_MAX_RATE,
+    on_emit=lambda count, elapsed: (emit_seconds.observe(elapsed), emit_rows.inc(count), warm_response_cache())
+)
+
+def format_alert(alert):
+    """警報的對外格式（時間轉為本地時間字串）"""
+    return {**alert, 'timestamp': format_timestamp(alert['timestamp'])}
+
+def emit_alert(alert):
+    """透過 Socket.IO 推送警報"""
+    socketio.emit('alert', format_alert(alert))
+
+def publish_alert(alert):
+    """發布警報到 MQTT（ALERT_TOPIC/<裝置>）"""
+    topic = f"{ALERT_TOPIC}/{alert['device']}"
+    payload = json.dumps(format_alert(alert), ensure_ascii=False)
+    if broker is not None:
+        broker.publish(topic, payload, qos=1)
+    elif mqtt_connected:
+        mqtt_client.publish(topic, payload, qos=1)
+
+def on_alert(alert):
+    """警報狀態改變（在接收路徑中呼叫，只計數並放入送出佇列）"""
+    alerts_total.labels(rule=alert['rule'], state=alert['state']).inc()
+    alert_dispatcher.submit(alert)
+
+def load_alert_rules():
+    if not os.path.exists(ALERT_RULES):
+        return []
+    try:
+        rules = load_rules(ALERT_RULES)
+        print(f"✅ 已載入 {len(rules)} 條警報規則（{ALERT_RULES}）")
+        return rules
+    except (OSError, ValueError) as e:
+        print(f"⚠️  載入警報規則時發生錯誤，不啟用警報: {e}")
+        return []
+
+# 警報：規則在接收路徑中逐筆增量評估，送出（Socket.IO / MQTT）在背景執行緒
+alert_dispatcher = AlertDispatcher([emit_alert, publish_alert])
+alert_engine = AlertEngine(load_alert_rules(), on_alert)
+
+def alert_check_loop():
+    """每隔 ALERT_CHECK_INTERVAL 秒檢查心跳規則"""
+    while True:
+        time.sleep(ALERT_CHECK_INTERVAL)
+        try:
+            alert_engine.check_heartbeats(int(time.time() * 1000))
+        except Exception as e:
+            print(f"⚠️  檢查心跳規則時發生錯誤: {e}")
 
 def on_connect(client, userdata, flags, reason_code, properties):
     """MQTT 連線回調"""
@@ -84,104 +637,734 @@ def on_connect(client, userdata, flags, reason_code, properties):
     else:
         print(f"✅ MQTT 連線成功")
         mqtt_connected = True
-        client.subscribe(MQTT_TOPIC, qos=1)
-        print(f"✅ 已訂閱主題: {MQTT_TOPIC}")
+        topics = codecs.topics()
+        if INGEST_ROLE == 'shard':
+            # 同一群組的接收行程共用訂閱，每則訊息只會送給其中一個
+            topics = [f'$share/{SHARE_GROUP}/{topic}' for topic in topics]
+        if INGEST_ROLE == 'api':
+            # 數據由接收行程訂閱，API 行程的連線只用來發布警報
+            print(f"✅ 數據由 {INGEST_PROCESSES} 個接收行程訂閱（共享訂閱群組 {SHARE_GROUP}）")
+        else:
+            client.subscribe([(topic, 1) for topic in topics])
+            print(f"✅ 已訂閱主題: {', '.join(topics)}")
+    with ingest_lock:
+        publish_snapshot()
 
-def on_message(client, userdata, message):
-    """MQTT 訊息回調"""
-    global latest_data, sensor_data
+def process_message(item):
+    """
+    處理一筆 MQTT 訊息（在接收管線的工作執行緒中執行）
+
+    解析與時間戳記轉換在鎖外進行；去重、重新排序與更新共用狀態（序號、緩衝區、彙總、
+    寫入與推送佇列）時持有 ingest_lock，確保序號與寫入順序一致
+
+    Args:
+        item: (topic, payload bytes, 接收時間 epoch 毫秒)
+    """
+    topic, raw_payload, received_ms = item
     
+    # 依主題選擇的 codec 解碼，並對應到統一的欄位名稱
+    messages_by_topic.labels(topic=topic).inc()
+    started = time.perf_counter()
     try:
-        payload = message.payload.decode('utf-8')
-        print(f"📨 收到訊息: {payload}")
-        
-        # 解析 JSON
-        data_dict = json.loads(payload)
-        
-        # 提取數據
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        temperature = data_dict.get('temperature', data_dict.get('temp', 0))
-        humidity = data_dict.get('humidity', data_dict.get('humi', 0))
-        light_status = data_dict.get('light_status', data_dict.get('light', '未知'))
-        
-        # 更新最新數據
-        latest_data = {
-            'light_status': light_status,
-            'temperature': temperature,
-            'humidity': humidity,
-            'timestamp': timestamp
-        }
-        
-        # 儲存到列表
-        sensor_data.append(latest_data.copy())
-        
-        # 只保留最近 100 筆
-        if len(sensor_data) > 100:
-            sensor_data.pop(0)
+        reading = codecs.decode(topic, raw_payload)
+    except Exception:
+        decode_errors.inc()
+        raise
+    decode_seconds.observe(time.perf_counter() - started)
+    if LOG_MESSAGES:
+        print(f"📨 收到訊息 [{topic}]: {reading}")
+    
+    # 提取數據（時間一律以 epoch 毫秒處理，字串只在 API 輸出時才格式化）
+    timestamp_ms = resolve_timestamp(reading, received_ms)
+    device = reading['device'] or DEFAULT_DEVICE
+    light_status = reading['light_status'] or '未知'
+    msg_id = reading['msg_id']
+    row = (device, topic, timestamp_ms, received_ms, reading['temperature'], reading['humidity'],
+           light_status, encode_light(light_status))
+    
+    with ingest_lock:
+        # QoS 1 重送的訊息在寫入任何狀態之前丟棄（JSON 的 msg_id 0 也是有效序號）
+        if (dedup_index is not None and isinstance(msg_id, (int, float))
+                and dedup_index.check(device, int(msg_id)) == DUPLICATE):
+            duplicates_total.labels(device=device).inc()
+            return
         
-        # 儲存到 CSV
+        # 依裝置時間排序後才寫入（環狀緩衝區與數據儲存都以時間二分搜尋）
+        if reorder_buffer is None:
+            rows = (row,)
+        else:
+            rows = reorder_buffer.push(device, timestamp_ms, received_ms, row)
+            if rows is None:
+                # 比已寫入的數據還舊，無法插入正確位置
+                return
+        commit_rows(rows)
+    messages_by_device.labels(device=device).inc()
+    
+    # 訊息帶有送出時間時（例如 loadgen.py）記錄端到端延遲；struct 格式以時間戳記欄位代替
+    # （和時間戳記一樣接受 epoch 秒 / 毫秒與 ISO 8601 字串）
+    sent_ms = parse_timestamp_ms(reading['sent_ts'] if reading['sent_ts'] is not None else reading['timestamp'])
+    if sent_ms is not None:
+        e2e_latency_seconds.observe(max(0.0, time.time() - sent_ms / 1000))
+
+def commit_rows(rows):
+    """
+    依序寫入一批已排序的數據並發布快照（呼叫端持有 ingest_lock）
+
+    重新排序緩衝區一次可能輸出多筆，其中一筆失敗時記錄後繼續寫入其他筆，不會遺失同一批的數據
+    """
+    for row in rows:
+        try:
+            commit_row(row)
+        except Exception as e:
+            commit_errors.inc()
+            print(f"⚠️  寫入數據時發生錯誤（{row[0]} {format_timestamp(row[2])}）: {e}")
+    if rows:
+        publish_snapshot()
+
+def commit_row(row):
+    """
+    寫入一筆已排序的數據（呼叫端持有 ingest_lock）
+
+    Args:
+        row: (device, topic, timestamp_ms, received_ms, temperature, humidity, light_status, light_code)
+    """
+    global latest_data, sequence
+    device, topic, timestamp_ms, received_ms, temperature, humidity, light_status, light_code = row
+    
+    # 更新最新數據
+    latest_data = {
+        'light_status': light_status,
+        'temperature': temperature,
+        'humidity': humidity,
+        'timestamp': timestamp_ms,
+        'device': device
+    }
+    
+    # 儲存到該裝置的環狀緩衝區（O(1)，超過保留筆數時自動覆蓋最舊的數據）
+    sequence += 1
+    sensor_data.append(device, timestamp_ms, temperature, humidity, light_code, sequence)
+    
+    # 寫入數據儲存（背景批次寫入；API 行程的數據來自分片，已經寫入過）
+    if INGEST_ROLE != 'api':
+        store_writer.write((device, timestamp_ms, temperature, humidity, light_code))
+    
+    # 儲存到 CSV 副本（時間在 CSV 寫入執行緒中整批格式化）
+    if CSV_MIRROR:
         csv_data = {
-            '時間戳記': timestamp,
+            '時間戳記': timestamp_ms,
             '電燈狀態': light_status,
             '溫度': temperature,
             '濕度': humidity
         }
         save_to_csv(csv_data)
+    
+    # 透過 WebSocket 推送到前端（由背景工作合併後推送）
+    if INGEST_ROLE != 'shard':
+        broadcaster.publish((device, timestamp_ms, temperature, humidity, light_status, sequence))
         
-        # 透過 WebSocket 推送到前端
-        socketio.emit('new_data', latest_data)
-        
-    except Exception as e:
-        print(f"處理訊息錯誤: {e}")
+        # 彙總、統計與警報最後更新，失敗時數據仍已寫入緩衝區、儲存與推送
+        # （接收行程只寫入分片，這些由 API 行程讀取分片後處理）
+        rollups.update(device, timestamp_ms, temperature, humidity)
+        stats_engine.update(device, timestamp_ms, (temperature, humidity))
+        if alert_engine.rules:
+            alert_engine.evaluate(device, topic, timestamp_ms, {'temperature': temperature, 'humidity': humidity},
+                                  received_ms=received_ms)
+
+def resolve_timestamp(reading, received_ms):
+    """
+    決定一筆數據的時間（epoch 毫秒）
+
+    裝置有送出時間戳記（timestamp，沒有時用 sent_ts）且在合理範圍內時使用裝置時間，
+    批次或延遲上傳的數據才會落在正確的時間；沒有或不合理（例如 Pico 尚未校時）時使用接收時間
+    """
+    if not DEVICE_TIMESTAMPS:
+        return received_ms
+    value = reading['timestamp'] if reading['timestamp'] is not None else reading['sent_ts']
+    if value is None:
+        timestamp_sources.labels(source='received').inc()
+        return received_ms
+    device_ms = parse_timestamp_ms(value)
+    if device_ms is None or not (received_ms - DEVICE_CLOCK_MAX_LAG_MS <= device_ms
+                                 <= received_ms + DEVICE_CLOCK_MAX_SKEW_MS):
+        timestamp_sources.labels(source='rejected').inc()
+        return received_ms
+    timestamp_sources.labels(source='device').inc()
+    return device_ms
+
+def flush_reorder(now_ms=None):
+    """輸出重新排序緩衝區中已到期的數據（now_ms 為 None 時全部輸出）"""
+    with ingest_lock:
+        rows = reorder_buffer.drain() if now_ms is None else reorder_buffer.release(now_ms)
+        commit_rows(rows)
+
+def reorder_loop():
+    """定期輸出到期的數據（裝置停止傳送時，暫存的數據也會在 REORDER_WINDOW_MS 後寫入）"""
+    interval = max(0.05, REORDER_WINDOW_MS / 4000)
+    while True:
+        time.sleep(interval)
+        try:
+            flush_reorder(int(time.time() * 1000))
+        except Exception as e:
+            print(f"⚠️  輸出重新排序緩衝區時發生錯誤: {e}")
+
+# 接收管線：on_message 只放入佇列，由工作執行緒呼叫 process_message
+ingest_lock = threading.Lock()
+pipeline = IngestPipeline(
+    process_message,
+    workers=INGEST_WORKERS,
+    queue_size=INGEST_QUEUE_SIZE,
+    policy=INGEST_POLICY,
+    sample_every=INGEST_SAMPLE_EVERY
+)
+queue_depth.set_function(pipeline.depth)
+for event in ('accepted', 'blocked', 'dropped_oldest', 'sampled_out', 'dropped'):
+    ingest_events.labels(event=event).set_function(
+        lambda event=event: sum(getattr(queue, event) for queue in pipeline.queues))
+ingest_events.labels(event='processed').set_function(lambda: pipeline.processed)
+ingest_events.labels(event='errors').set_function(lambda: pipeline.errors)
+
+def on_message(client, userdata, message):
+    """MQTT 訊息回調（只放入接收佇列，不做任何解析或 I/O；依裝置分配工作執行緒）"""
+    pipeline.submit(codecs.partition_key(message.topic, message.payload),
+                    (message.topic, message.payload, int(time.time() * 1000)))
 
 # 啟動 MQTT 客戶端
-mqtt_client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+mqtt_client = mqtt.Client(
+    callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+    client_id=f'{SHARE_GROUP}-{SHARD_INDEX}' if INGEST_ROLE == 'shard' else '',
+    protocol=mqtt.MQTTv5 if MQTT_V5 else mqtt.MQTTv311
+)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
 
 def start_mqtt():
     """在背景執行緒中啟動 MQTT"""
     try:
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        mqtt_client.loop_forever()
+        if INGEST_ROLE == 'shard':
+            # 接收行程可能比 broker 先啟動，連線失敗時持續重試
+            mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+            mqtt_client.loop_forever(retry_first_connection=True)
+        else:
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            mqtt_client.loop_forever()
     except Exception as e:
         print(f"MQTT 錯誤: {e}")
 
-# 啟動前先載入歷史數據
-print("📂 載入歷史數據...")
-load_from_csv()
+# 內建 broker（只在 EMBEDDED_BROKER=1 時啟動）
+broker = None
+
+def on_local_message(topic, payload, qos, retain):
+    """內建 broker 的本機訂閱回調（只放入接收佇列）"""
+    pipeline.submit(codecs.partition_key(topic, payload), (topic, payload, int(time.time() * 1000)))
+
+def start_embedded_broker():
+    """啟動內建 broker，並以本機訂閱接收所有 codec 主題"""
+    global broker, mqtt_connected
+    broker = Broker(EMBEDDED_BROKER_HOST, MQTT_PORT, share_strategy=SHARE_STRATEGY).start()
+    topics = codecs.topics()
+    if INGEST_ROLE != 'api':
+        for topic in topics:
+            broker.subscribe_local(topic, on_local_message)
+    mqtt_connected = True
+    with ingest_lock:
+        publish_snapshot()
+    print(f"✅ 內建 MQTT broker 已啟動於 {EMBEDDED_BROKER_HOST}:{broker.port}")
+    if INGEST_ROLE != 'api':
+        print(f"✅ 已訂閱主題: {', '.join(topics)}")
+
+# 接收行程（INGEST_PROCESSES > 1 時由 API 行程啟動與監控）
+ingest_processes = []
+ingest_stopping = threading.Event()
+ingest_processes_alive.set_function(lambda: sum(process.poll() is None for process in ingest_processes))
+
+def spawn_ingest_process(index):
+    """以同一個程式啟動一個接收行程（由環境變數指定分片，不提供 API、不寫 CSV / Excel、不評估警報）"""
+    env = dict(
+        os.environ,
+        SHARD_INDEX=str(index),
+        DATA_DIR=shard_dirs(SHARD_ROOT, INGEST_PROCESSES)[index],
+        CSV_MIRROR='0',
+        EXCEL_MIRROR='0',
+        ALERT_RULES='',
+        EMBEDDED_BROKER='0',
+        # 內建 broker 只支援 MQTT 3.1.1；外部 broker 使用 v5 的共享訂閱
+        MQTT_V5='0' if EMBEDDED_BROKER else os.environ.get('MQTT_V5', '1'),
+    )
+    if EMBEDDED_BROKER:
+        env['MQTT_BROKER'] = '127.0.0.1'
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+def supervise_ingest_processes():
+    """接收行程異常結束時重新啟動"""
+    while not ingest_stopping.wait(1.0):
+        for index, process in enumerate(ingest_processes):
+            if process.poll() is not None and not ingest_stopping.is_set():
+                print(f"⚠️  接收行程 {index} 已結束（代碼 {process.returncode}），重新啟動")
+                ingest_processes[index] = spawn_ingest_process(index)
+
+def stop_ingest_processes():
+    """結束所有接收行程（SIGTERM，接收行程會寫入剩餘數據與檢查點）"""
+    ingest_stopping.set()
+    for process in ingest_processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in ingest_processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def start_ingest_processes():
+    for index in range(INGEST_PROCESSES):
+        ingest_processes.append(spawn_ingest_process(index))
+    threading.Thread(target=supervise_ingest_processes, name='ingest-supervisor', daemon=True).start()
+    print(f"✅ 已啟動 {INGEST_PROCESSES} 個接收行程（共享訂閱群組 {SHARE_GROUP}，分片目錄 {SHARD_ROOT}/）")
+
+def check_share_strategy():
+    """INGEST_PROCESSES > 1 時確認 broker 依發布者分配共享訂閱（輪流分配會把同一個裝置拆到多個行程）"""
+    if SHARE_STRATEGY != 'sticky':
+        raise SystemExit(
+            f"❌ INGEST_PROCESSES={INGEST_PROCESSES} 需要 broker 依發布者固定分配共享訂閱"
+            f"（SHARE_STRATEGY=sticky，目前為 {SHARE_STRATEGY}）：輪流分配時同一個裝置的訊息會分散到多個接收行程，"
+            f"各行程的去重與重新排序只看到部分數據。請使用內建 broker（EMBEDDED_BROKER=1），"
+            f"或將外部 broker 設定為依 client id 分配（例如 EMQX 的 hash_clientid）後設定 SHARE_STRATEGY=sticky")
+
+def shard_metrics():
+    """讀取各接收行程寫出的指標（超過 3 個寫出間隔沒有更新的視為已停止，不輸出）"""
+    now = time.time()
+    results = []
+    for index, path in enumerate(shard_dirs(SHARD_ROOT, INGEST_PROCESSES)):
+        try:
+            path = os.path.join(path, SHARD_METRICS_FILE)
+            if now - os.path.getmtime(path) > 3 * SHARD_METRICS_INTERVAL:
+                continue
+            with open(path, encoding='utf-8') as f:
+                results.append((f'shard="{index:02d}"', f.read()))
+        except OSError:
+            continue
+    return results
+
+def shard_metrics_loop():
+    """每隔 SHARD_METRICS_INTERVAL 秒把本行程的指標寫到分片目錄（接收行程）"""
+    path = os.path.join(DATA_DIR, SHARD_METRICS_FILE)
+    while True:
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            metrics_registry.write(path)
+        except Exception as e:
+            print(f"⚠️  寫入指標檔案時發生錯誤: {e}")
+        time.sleep(SHARD_METRICS_INTERVAL)
+
+def follow_shards():
+    """
+    讀取分片新寫入的數據（API 行程）
+
+    各分片的數據經過重新排序緩衝區後交給 commit_row，
+    更新記憶體中的緩衝區、彙總、統計、警報與推送（不再寫入儲存）
+
+    Returns:
+        int: 讀到的筆數
+    """
+    received_ms = int(time.time() * 1000)
+    total = 0
+    for device, columns in shard_tail.poll().items():
+        count = len(columns['timestamp'])
+        rows = zip(
+            columns['timestamp'].tolist(),
+            np.round(columns['temperature'].astype(np.float64), 2).tolist(),
+            np.round(columns['humidity'].astype(np.float64), 2).tolist(),
+            decode_light(columns['light']),
+            columns['light'].tolist(),
+        )
+        with ingest_lock:
+            released = []
+            for timestamp_ms, temperature, humidity, light_status, light_code in rows:
+                # 儲存中沒有主題，限定 topic 的警報規則不適用
+                row = (device, '', timestamp_ms, received_ms, temperature, humidity, light_status, light_code)
+                if reorder_buffer is None:
+                    released.append(row)
+                else:
+                    released.extend(reorder_buffer.push(device, timestamp_ms, received_ms, row) or ())
+            commit_rows(released)
+        messages_by_device.labels(device=device).inc(count)
+        total += count
+    return total
+
+def follow_shards_loop():
+    """每隔 SHARD_POLL_INTERVAL 秒讀取分片新寫入的數據"""
+    while True:
+        time.sleep(SHARD_POLL_INTERVAL)
+        try:
+            follow_shards()
+        except Exception as e:
+            print(f"⚠️  讀取分片數據時發生錯誤: {e}")
+
+def start_services(connect_mqtt=True):
+    """
+    載入歷史數據並啟動背景服務（寫入器、檢查點、推送、接收管線、MQTT）
+
+    只在直接執行時呼叫；benchmark 等工具匯入本模組後可自行決定是否連線 MQTT
+
+    Args:
+        connect_mqtt: 是否在背景執行緒中連線 MQTT broker
+    """
+    if INGEST_ROLE == 'api':
+        check_share_strategy()
+
+    # 啟動前先載入歷史數據
+    print("📂 載入歷史數據...")
+    load_history()
+    seed_stats()
+    seed_rollups()
+    seed_reorder()
+    sensor_data.recount()
+    publish_snapshot()
+
+    # 啟動背景寫入器，程式結束時寫入剩餘數據並寫入檢查點
+    # （atexit 依註冊的相反順序執行：先關閉寫入器，最後寫入檢查點）
+    atexit.register(write_checkpoint)
+    if INGEST_ROLE != 'api':
+        store_writer.start()
+        atexit.register(store_writer.close)
+    if CSV_MIRROR:
+        csv_writer.start()
+        atexit.register(csv_writer.close)
+    threading.Thread(target=checkpoint_loop, name='checkpoint', daemon=True).start()
+    if INGEST_ROLE != 'api':
+        # 分片由各自的接收行程壓縮
+        threading.Thread(target=compact_loop, name='store-compact', daemon=True).start()
+    if alert_engine.rules:
+        alert_dispatcher.start()
+        threading.Thread(target=alert_check_loop, name='alert-check', daemon=True).start()
+    if EXCEL_MIRROR:
+        excel_mirror.start()
+    if INGEST_ROLE != 'shard':
+        broadcaster.start()
+    if reorder_buffer is not None:
+        threading.Thread(target=reorder_loop, name='reorder', daemon=True).start()
+        # 接收管線關閉後、寫入器關閉前輸出暫存的數據
+        atexit.register(flush_reorder)
+    # 接收管線最先關閉（atexit 反向執行），剩餘訊息會先交給寫入器
+    pipeline.start()
+    atexit.register(pipeline.close)
 
-# 在背景執行緒中啟動 MQTT
-mqtt_thread = threading.Thread(target=start_mqtt, daemon=True)
-mqtt_thread.start()
+    # 使用內建 broker 時直接本機訂閱，否則在背景執行緒中連線 MQTT broker
+    if EMBEDDED_BROKER:
+        start_embedded_broker()
+        atexit.register(broker.stop)
+    elif connect_mqtt:
+        threading.Thread(target=start_mqtt, name='mqtt', daemon=True).start()
+
+    if INGEST_ROLE == 'shard':
+        threading.Thread(target=shard_metrics_loop, name='shard-metrics', daemon=True).start()
+    if INGEST_ROLE == 'api':
+        metrics_registry.add_collector(shard_metrics)
+        # 記憶體中已有的數據之後才開始追蹤分片；接收行程在 broker 啟動後才啟動，並最先結束
+        for device in sensor_data.devices():
+            buffer = sensor_data.buffer(device)
+            last = buffer.last()
+            if last is not None:
+                shard_tail.start_after(device, buffer.timestamp[last])
+        threading.Thread(target=follow_shards_loop, name='shard-follower', daemon=True).start()
+        start_ingest_processes()
+        atexit.register(stop_ingest_processes)
 
 @app.route('/')
 def index():
     """主頁"""
     return render_template('index.html')
 
+@socketio.on('connect')
+def on_socketio_connect():
+    """Socket.IO 客戶端連線"""
+    socketio_clients.inc()
+
+@socketio.on('disconnect')
+def on_socketio_disconnect(*args):
+    """Socket.IO 客戶端離線"""
+    socketio_clients.dec()
+
+@app.route('/metrics')
+def get_metrics():
+    """效能指標（Prometheus 文字格式）"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+def cached_json(key, version, build):
+    """
+    回應預先序列化的 JSON
+
+    同一個版本只序列化（及 gzip）一次；ETag 為啟動識別碼加上版本，用戶端帶 If-None-Match 時回應 304
+    """
+    entry = response_cache.get(key, version, build)
+    use_gzip = entry.gzipped is not None and 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = entry.etag + ('-gz' if use_gzip else '')
+    if request.if_none_match.contains(etag):
+        http_cache_results.labels(result='not_modified').inc()
+        response = Response(status=304)
+    else:
+        http_cache_results.labels(result='served').inc()
+        response = Response(entry.gzipped if use_gzip else entry.body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def latest_version(snap):
+    return (snap.seq, int(snap.mqtt_connected))
+
+def latest_payload(snap):
+    return {
+        **snap.latest,
+        'timestamp': format_timestamp(snap.latest['timestamp']),
+        'mqtt_connected': snap.mqtt_connected,
+        'total_records': snap.total_records
+    }
+
+def history_cache_key(args):
+    """
+    只和數據版本有關的查詢才使用預先序列化的回應（None 表示不快取）
+
+    未指定 to 的查詢讀到所有已接收的數據為止（見 build_history），同一個 cursor 的結果相同
+    """
+    if 'since' in args or ('bucket' in args and 'from' not in args):
+        # since 每次不同；未指定 from 的彙總查詢會隨目前時間移動
+        return None
+    return ('history', tuple(sorted(args.items(multi=True))))
+
+def warm_response_cache():
+    """推送後預先產生 /api/latest 與正在被輪詢的歷史查詢（在推送執行緒中執行，最多每秒數次）"""
+    snap = snapshot
+    cursor = snap.seq
+    response_cache.put(('latest',), latest_version(snap), lambda: latest_payload(snap))
+    for key in response_cache.polled():
+        if key[0] == 'history':
+            args = MultiDict(key[1])
+            response_cache.put(key, cursor, lambda: build_history(args, cursor))
+
 @app.route('/api/latest')
 def get_latest():
-    """取得最新數據 API"""
-    return jsonify({
-        **latest_data,
-        'mqtt_connected': mqtt_connected,
-        'total_records': len(sensor_data)
-    })
+    """取得最新數據 API（只讀取快照，不和接收端競爭鎖）"""
+    snap = snapshot
+    return cached_json(('latest',), latest_version(snap), lambda: latest_payload(snap))
 
 @app.route('/api/history')
 def get_history():
-    """取得歷史數據 API"""
-    return jsonify(sensor_data)
+    """
+    取得歷史數據 API
+
+    查詢參數:
+        device: 裝置名稱（省略時合併所有裝置）
+        limit: 回傳筆數（預設 HISTORY_LIMIT，未指定時間範圍時使用）
+        from, to: 時間範圍（epoch 毫秒或 ISO 格式本地時間）
+        bucket: 區間大小（例如 1m、1h、1d），回傳每個區間的 min / max / avg / count
+        max_points: 原始數據最多回傳的點數（圖表用，超過時降採樣）
+        downsample: 降採樣方式，lttb（預設）或 minmax
+        since: 接收序號，只回傳之後新增的數據（沒有新數據時回傳 304）
+
+    回傳欄位格式：{'timestamp': [...], 'temperature': [...], ..., 'cursor': 目前序號}
+    原始數據回應中的 cursor 可作為下一次查詢的 since
+    """
+    since = request.args.get('since', type=int)
+    # 整個請求都以同一個快照的序號為準
+    cursor = snapshot.seq
+    if since is not None and since == cursor:
+        # 沒有新數據
+        return '', 304
+    try:
+        key = history_cache_key(request.args)
+        if key is not None:
+            return cached_json(key, cursor, lambda: build_history(request.args, cursor))
+        return jsonify(build_history(request.args, cursor))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+def build_history(args, cursor):
+    """
+    依查詢參數產生 /api/history 的回應內容
+
+    Args:
+        args: 查詢參數（MultiDict）
+        cursor: 快照的接收序號（只回傳序號小於等於此值的記憶體數據）
+    """
+    device = args.get('device')
+    bucket = args.get('bucket')
+    max_points = args.get('max_points', 0, type=int)
+    mode = args.get('downsample', 'lttb')
+    since = args.get('since', type=int)
+    reset = False
+    if since is not None and since < cursor:
+        columns = sensor_data.since(since, device, until_seq=cursor)
+    else:
+        # 沒有 since，或 since 比目前序號還大（伺服器重新啟動過）：回傳完整視窗
+        reset = since is not None
+        now_ms = int(time.time() * 1000) + 1
+        # 未指定 to 時包含所有已接收的數據：裝置時間最多比接收時間快 DEVICE_CLOCK_MAX_SKEW_MS，
+        # 結果只由 cursor 決定（快取的回應不會因為時間經過而漏掉稍微超前的數據）
+        end_ms = parse_time(args['to']) if 'to' in args else now_ms + DEVICE_CLOCK_MAX_SKEW_MS
+        if 'from' in args:
+            start_ms = parse_time(args['from'])
+        elif bucket:
+            start_ms = now_ms - AGGREGATE_DEFAULT_WINDOW
+        else:
+            start_ms = None
+
+        if bucket:
+            result, bucket_ms = read_aggregate(start_ms, end_ms, bucket, device, until_seq=cursor)
+            return aggregate_to_json(result, bucket_ms, format_timestamps)
+        if start_ms is not None or 'to' in args:
+            columns = read_range(start_ms or 0, end_ms, device, until_seq=cursor)
+        else:
+            limit = args.get('limit', HISTORY_LIMIT, type=int)
+            columns = read_history(limit, device, until_seq=cursor)
+    if max_points:
+        columns = downsample(columns, max_points, mode)
+
+    payload = columns_to_json(columns)
+    payload['cursor'] = cursor
+    payload['reset'] = reset
+    return payload
+
+@app.route('/api/stats')
+def get_stats():
+    """
+    取得串流統計 API（接收時逐筆更新，不掃描歷史數據）
+
+    查詢參數:
+        device: 裝置名稱（省略時回傳所有裝置）
+
+    回傳格式：{裝置: {'temperature': {count, mean, std, min, max, ewma, p50, p95}, 'humidity': {...},
+                      'sequence': {last_msg_id, received, duplicates, missing, reordered, resets}, 'updated': 時間}}
+    count / mean / std / min / max 為啟動以來（含啟動時載入的歷史數據），p50 / p95 為最近 STATS_QUANTILE_WINDOW 筆；
+    sequence 為依 msg_id 統計的重送 / 遺失 / 亂序（訊息沒有 msg_id 或停用去重時省略）
+    """
+    device = request.args.get('device')
+
+    def build():
+        # 統計與序號狀態以 seqlock 讀取，不需要和接收端競爭 ingest_lock
+        result = stats_engine.to_json(device, format_timestamp)
+        if dedup_index is not None:
+            for name, sequence_stats in dedup_index.to_json(device).items():
+                if name in result:
+                    result[name]['sequence'] = sequence_stats
+        return result
+
+    # 版本取自已發布的快照（重送的訊息不會增加接收序號，版本另外加上重送筆數）；
+    # 內容在版本之後讀取，只會比版本新，不會讓用戶端以舊版本的 ETag 得到 304
+    duplicates = dedup_index.duplicates if dedup_index is not None else 0
+    return cached_json(('stats', device), (snapshot.seq, duplicates), build)
+
+@app.route('/api/alerts')
+def get_alerts():
+    """取得目前觸發中的警報"""
+    alerts = sorted(alert_engine.active_alerts(), key=lambda alert: alert['timestamp'])
+    return jsonify({
+        'active': [format_alert(alert) for alert in alerts],
+        'rules': [{'name': rule.name, 'type': rule.kind, 'severity': rule.severity} for rule in alert_engine.rules]
+    })
+
+@app.route('/api/export.xlsx')
+def export_xlsx():
+    """
+    匯出 Excel 檔案
+
+    查詢參數:
+        from, to: 時間範圍（epoch 毫秒或 ISO 格式本地時間，預設最近 24 小時）
+        device: 裝置名稱（省略時匯出所有裝置）
+
+    數據依時間窗口分段從儲存讀取，以 openpyxl 唯寫模式寫入暫存檔後分段送出，
+    記憶體用量與筆數無關
+    """
+    try:
+        start_ms, end_ms = parse_export_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    device = request.args.get('device')
+    start_ms = max(start_ms, first_timestamp(device) or end_ms)
+    tmp, _ = export_to_tempfile(read_range, start_ms, end_ms, device)
+    filename = f"sensor_data_{datetime.fromtimestamp(start_ms / 1000):%Y%m%d%H%M}.xlsx"
+    return Response(
+        stream_file(tmp),
+        mimetype=XLSX_MIMETYPE,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+def stream_export_response(formatter, mimetype, extension):
+    """
+    以產生器串流回應匯出數據（CSV / NDJSON 共用）
+
+    gzip=1 時即時壓縮；未指定時依 Accept-Encoding 決定
+    """
+    try:
+        start_ms, end_ms = parse_export_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    device = request.args.get('device')
+    start_ms = max(start_ms, first_timestamp(device) or end_ms)
+    body = formatter(iter_windows(read_range, start_ms, end_ms, device))
+    filename = f"sensor_data_{datetime.fromtimestamp(start_ms / 1000):%Y%m%d%H%M}.{extension}"
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'Vary': 'Accept-Encoding'}
+    if 'gzip' in request.args:
+        use_gzip = request.args['gzip'].lower() in ('1', 'true', 'yes')
+    else:
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if use_gzip:
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype=mimetype, headers=headers)
+
+@app.route('/api/export.csv')
+def export_csv():
+    """
+    串流匯出 CSV
+
+    查詢參數:
+        from, to: 時間範圍（epoch 毫秒或 ISO 格式本地時間，預設最近 24 小時）
+        device: 裝置名稱（省略時匯出所有裝置）
+        gzip: 1 = 壓縮、0 = 不壓縮（省略時依 Accept-Encoding）
+
+    數據依時間窗口分段讀取並立即送出，不會在記憶體中組出整個結果
+    """
+    return stream_export_response(iter_csv, CSV_MIMETYPE, 'csv')
+
+@app.route('/api/export.ndjson')
+def export_ndjson():
+    """
+    串流匯出 NDJSON（每列一個 JSON 物件，查詢參數同 /api/export.csv）
+    """
+    return stream_export_response(iter_ndjson, NDJSON_MIMETYPE, 'ndjson')
+
+def exit_on_sigterm(signum, frame):
+    """SIGTERM 轉換為正常結束；之後的 SIGTERM 忽略（systemd 會同時通知接收行程，避免中斷寫入檢查點）"""
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    sys.exit(0)
+
+if __name__ == '__main__' and INGEST_ROLE == 'shard':
+    # 接收行程：只接收並寫入分片，不提供 API
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    print(f"🚚 接收行程 {SHARD_INDEX} 已啟動（分片 {DATA_DIR}/）")
+    start_services()
+    while True:
+        time.sleep(3600)
 
 if __name__ == '__main__':
     print("=" * 60)
     print(" Flask MQTT 監控應用程式")
     print("=" * 60)
     print(f" 啟動中...")
-    print(f" MQTT Broker: {MQTT_BROKER}:{MQTT_PORT}")
-    print(f" MQTT Topic: {MQTT_TOPIC}")
-    print(f" CSV 檔案: {CSV_FILE}")
+    print(f" MQTT Broker: {f'內建（port {MQTT_PORT}）' if EMBEDDED_BROKER else f'{MQTT_BROKER}:{MQTT_PORT}'}")
+    print(f" MQTT Topic: {', '.join(f'{t} ({c})' for t, c in TOPIC_CODECS.items())}")
+    print(f" 數據目錄: {DATA_DIR}/")
+    print(f" CSV 檔案: {CSV_FILE if CSV_MIRROR else '（未啟用）'}")
+    print(f" Excel 鏡像: {f'{EXCEL_DIR}/（每 {EXCEL_MIRROR_INTERVAL:g} 秒）' if EXCEL_MIRROR else '（未啟用）'}")
+    print(f" 每個裝置保留筆數: {HISTORY_RETENTION}")
+    if INGEST_ROLE == 'api':
+        print(f" 接收行程: {INGEST_PROCESSES}（$share/{SHARE_GROUP}/...，{SHARE_STRATEGY}，分片目錄 {SHARD_ROOT}/）")
     print("=" * 60)
     
+    # systemd 停止服務時送出 SIGTERM，轉換為正常結束以執行 atexit（寫入剩餘數據與檢查點）
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    
+    start_services()
     socketio.run(app, host='0.0.0.0', port=8080, debug=False, allow_unsafe_werkzeug=True)
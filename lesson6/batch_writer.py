@@ -0,0 +1,278 @@
+"""
+背景批次寫入（write-behind）
+MQTT 執行緒只把資料放入佇列，由背景執行緒保持檔案開啟並批次寫入
+"""
+
+import csv
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+from ring_buffer import format_timestamps
+
+# fsync 策略
+FSYNC_NEVER = 'never'        # 只 flush 到作業系統，由系統決定何時寫入 SD 卡
+FSYNC_BATCH = 'batch'        # 每批寫入後都 fsync（最安全，最慢）
+FSYNC_INTERVAL = 'interval'  # 每隔 fsync_interval 秒 fsync 一次（group commit）
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_INTERVAL)
+
+
+def gzip_file(path):
+    """把檔案壓縮成 path.gz 後刪除原檔"""
+    with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(path + '.gz.tmp', path + '.gz')
+    os.remove(path)
+
+
+class CsvSink:
+    """
+    把批次數據附加到 CSV 檔案的寫入目標
+
+    rotate=True 時每天一個檔案：寫入時的本地日期改變時，
+    目前的檔案改名為 <檔名>_<日期>.csv 並在背景以 gzip 壓縮，新的一天寫入原檔名。
+    換檔依寫入（接收）的日期，而不是數據的時間戳記：裝置時間可能是前一天（延遲上傳、時鐘錯誤），
+    依數據日期換檔會讓混合兩天的批次來回換檔
+    """
+
+    def __init__(self, path, fieldnames, rotate=False, compress=True, timestamp_column=None):
+        """
+        Args:
+            path: CSV 檔案路徑
+            fieldnames: 欄位名稱（新檔案時寫入標題列）
+            rotate: 是否每天換一個檔案
+            compress: 換檔後是否壓縮前一天的檔案
+            timestamp_column: 內容為 epoch 毫秒的欄位位置，寫入時才整批格式化為本地時間字串
+        """
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.rotate = rotate
+        self.compress = compress
+        self.timestamp_column = timestamp_column
+        self._file = None
+        self._writer = None
+        self._day = None
+        self._rotated_bytes = 0
+        self.bytes_written = 0
+
+    def open(self):
+        """開啟檔案（新檔案或空檔案時寫入標題列）"""
+        need_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if self.rotate and not need_header:
+            # 既有檔案的日期以最後修改時間為準
+            self._day = time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(self.path)))
+        self._file = open(self.path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._start = self._file.tell()
+        if need_header:
+            self._writer.writerow(self.fieldnames)
+            self._file.flush()
+
+    def rotated_path(self, day):
+        stem, extension = os.path.splitext(self.path)
+        return f"{stem}_{day}{extension}"
+
+    def _rotate(self, day):
+        """關閉目前的檔案並改名，再開啟新的一天的檔案"""
+        self._file.flush()
+        self._rotated_bytes += self._file.tell() - self._start
+        self._file.close()
+        if self._day is not None:
+            target = self.rotated_path(self._day)
+            # 同一天重複換檔時（例如時鐘被調回）附加序號，不覆蓋
+            index = 1
+            while os.path.exists(target) or os.path.exists(target + '.gz'):
+                target = self.rotated_path(f"{self._day}.{index}")
+                index += 1
+            os.replace(self.path, target)
+            if self.compress:
+                threading.Thread(target=gzip_file, args=(target,), name='csv-gzip', daemon=True).start()
+        self._day = day
+        self.open()
+
+    def write_batch(self, batch):
+        """寫入一批數據（每筆為 list，順序同 fieldnames）"""
+        column = self.timestamp_column
+        if column is not None:
+            strings = format_timestamps([row[column] for row in batch])
+            batch = [row[:column] + [text] + row[column + 1:] for row, text in zip(batch, strings)]
+        if self.rotate:
+            day = time.strftime('%Y-%m-%d')
+            if self._day is None:
+                # 新檔案的第一批：只記錄日期
+                self._day = day
+            elif day != self._day:
+                self._rotate(day)
+        self._writer.writerows(batch)
+
+    def flush(self, fsync=False):
+        """將緩衝寫入作業系統，必要時 fsync 到儲存裝置"""
+        self._file.flush()
+        self.bytes_written = self._rotated_bytes + self._file.tell() - self._start
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """關閉檔案"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class BatchedWriter:
+    """
+    批次寫入的背景寫入器
+
+    - write() 不會阻塞：佇列滿時丟棄該筆並計數，由背景執行緒每批最多印出一次丟棄的筆數
+    - 背景執行緒保持寫入目標開啟，累積到 batch_size 筆或超過
+      flush_interval 秒時一次寫入；寫入失敗時記錄該批筆數後繼續，執行緒不會結束
+
+    寫入目標（sink）需提供 open()、write_batch(batch)、flush(fsync)、close()
+    """
+
+    def __init__(self, sink, queue_size=10000, batch_size=500,
+                 flush_interval=1.0, fsync=FSYNC_INTERVAL, fsync_interval=5.0, name='batch-writer',
+                 on_batch=None):
+        """
+        Args:
+            sink: 寫入目標
+            queue_size: 佇列最大筆數
+            batch_size: 每批最多寫入筆數
+            flush_interval: 最長等待秒數，超過即寫入目前累積的數據
+            fsync: fsync 策略（never / batch / interval）
+            fsync_interval: fsync 策略為 interval 時的間隔秒數
+            name: 背景執行緒名稱
+            on_batch: 每批寫入後呼叫 on_batch(筆數, 秒數)，供指標統計使用
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"未知的 fsync 策略: {fsync}")
+        self.sink = sink
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.on_batch = on_batch
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rows_written = 0
+        self.batches_written = 0
+        self.dropped = 0
+        # 寫入失敗的筆數
+        self.failed = 0
+        # 開啟寫入目標失敗時的錯誤訊息（成功開啟後為 None）
+        self.open_error = None
+        self._reported_dropped = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """啟動背景寫入執行緒"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def write(self, row):
+        """
+        放入一筆數據
+
+        Returns:
+            bool: 是否成功放入佇列（佇列滿時回傳 False）
+        """
+        try:
+            self.queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=5.0):
+        """停止背景執行緒並寫入剩餘數據"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _collect(self):
+        """從佇列取出一批數據（最多等待 flush_interval 秒）"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            # 已有數據時，把佇列中現有的數據一次取完
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+        return batch
+
+    def _report_dropped(self):
+        """印出上次之後佇列已滿而丟棄的筆數（不在 write() 中逐筆印出）"""
+        dropped = self.dropped
+        if dropped > self._reported_dropped:
+            print(f"⚠️  [{self.name}] 寫入佇列已滿，丟棄 {dropped - self._reported_dropped} 筆（累計 {dropped} 筆）")
+            self._reported_dropped = dropped
+
+    def _open_sink(self):
+        """開啟寫入目標；失敗時記錄錯誤並回傳 False（之後每批重試，相同的錯誤只印出一次）"""
+        try:
+            self.sink.open()
+        except Exception as e:
+            if str(e) != self.open_error:
+                print(f"❌ [{self.name}] 無法開啟寫入目標: {e}")
+            self.open_error = str(e)
+            return False
+        if self.open_error is not None:
+            print(f"✅ [{self.name}] 寫入目標已開啟")
+            self.open_error = None
+        return True
+
+    def _run(self):
+        """背景寫入迴圈"""
+        # 開啟失敗（例如 SD 卡尚未掛載）時執行緒不結束，每批重試開啟，無法寫入的數據計入 failed
+        opened = self._open_sink()
+        last_fsync = time.monotonic()
+        try:
+            while not (self._stop.is_set() and self.queue.empty()):
+                batch = self._collect()
+                self._report_dropped()
+                if not batch:
+                    continue
+                if not opened:
+                    opened = self._open_sink()
+                    if not opened:
+                        self.failed += len(batch)
+                        continue
+                try:
+                    started = time.perf_counter()
+                    self.sink.write_batch(batch)
+                    now = time.monotonic()
+                    do_fsync = self.fsync == FSYNC_BATCH or (
+                        self.fsync == FSYNC_INTERVAL and now - last_fsync >= self.fsync_interval)
+                    self.sink.flush(fsync=do_fsync)
+                    if do_fsync:
+                        last_fsync = now
+                    self.rows_written += len(batch)
+                    self.batches_written += 1
+                    if self.on_batch is not None:
+                        self.on_batch(len(batch), time.perf_counter() - started)
+                except Exception as e:
+                    # 任何寫入錯誤（磁碟、數據格式）都只影響這一批，寫入執行緒繼續處理之後的數據
+                    self.failed += len(batch)
+                    print(f"⚠️  [{self.name}] 寫入 {len(batch)} 筆時發生錯誤（累計失敗 {self.failed} 筆）: {e}")
+        finally:
+            if opened:
+                try:
+                    self.sink.flush(fsync=self.fsync != FSYNC_NEVER)
+                finally:
+                    self.sink.close()
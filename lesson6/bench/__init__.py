@@ -0,0 +1,10 @@
+"""
+接收路徑效能測試（benchmark）
+
+以固定速率把訊息送進 app_flask 真正的 on_message → 接收管線 → 儲存 → 推送路徑，
+量測吞吐量、端到端延遲與記憶體成長，並輸出 JSON 結果供比較
+
+使用方式（在 lesson6 目錄下）：
+    python -m bench --rates 1000,5000,20000 --duration 10 --output results.json
+    python -m bench --rates 5000 --baseline results.json   # 與先前結果比較，退步時回傳 1
+"""
@@ -0,0 +1,123 @@
+"""
+benchmark 命令列入口：python -m bench --help
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='app_flask 接收路徑 benchmark')
+    parser.add_argument('--rates', default='1000,5000,20000',
+                        help='每秒訊息數，以逗號分隔（預設 1000,5000,20000）')
+    parser.add_argument('--duration', type=float, default=5.0, help='每個速率送出的秒數')
+    parser.add_argument('--devices', type=int, default=10, help='模擬的裝置數量')
+    parser.add_argument('--codec', default='json', choices=('json', 'struct', 'cbor'), help='payload 編碼')
+    parser.add_argument('--transport', default='fake', choices=('fake', 'broker', 'mqtt'),
+                        help='fake：直接呼叫 on_message；broker：經過內建 broker 的本機訂閱；'
+                             'mqtt：透過 MQTT broker（TCP）')
+    parser.add_argument('--broker', default='localhost:1883', help='--transport mqtt 使用的 broker')
+    parser.add_argument('--embedded-broker', action='store_true',
+                        help='--transport mqtt 時在本行程啟動內建 broker（127.0.0.1，自動選擇 port），不需要外部 broker')
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1), help='--transport mqtt 的 QoS')
+    parser.add_argument('--clients', type=int, default=1, help='連線的 Socket.IO 測試客戶端數')
+    parser.add_argument('--data-dir', help='數據目錄（預設使用暫存目錄，結束後刪除）')
+    parser.add_argument('--output', help='結果 JSON 檔案路徑')
+    parser.add_argument('--baseline', help='基準結果 JSON，退步超過 --tolerance 時回傳 1')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='容許的退步比例（預設 0.2）')
+    return parser.parse_args()
+
+
+def configure_environment(args, data_dir):
+    """在匯入 app_flask 之前設定環境變數（數據寫到暫存目錄，不影響正式數據）"""
+    host, _, port = args.broker.partition(':')
+    if args.transport == 'broker':
+        # 應用程式自己啟動內建 broker（只監聽本機，自動選擇 port）
+        os.environ.update({'EMBEDDED_BROKER': '1', 'EMBEDDED_BROKER_HOST': '127.0.0.1'})
+        port = '0'
+    else:
+        os.environ['EMBEDDED_BROKER'] = '0'
+    os.environ.update({
+        'DATA_DIR': data_dir,
+        'CSV_FILE': os.path.join(data_dir, 'sensor_data.csv'),
+        'LOG_MESSAGES': '0',
+        'CHECKPOINT_INTERVAL': '3600',
+        'MQTT_BROKER': host,
+        'MQTT_PORT': port or '1883',
+    })
+
+
+def main():
+    args = parse_args()
+    # 讓 lesson6 目錄下的模組可以匯入
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    embedded = None
+    if args.transport == 'mqtt' and args.embedded_broker:
+        from mqtt_broker import Broker
+        embedded = Broker('127.0.0.1', 0).start()
+        args.broker = f'127.0.0.1:{embedded.port}'
+
+    with tempfile.TemporaryDirectory(prefix='bench-') as tmp:
+        configure_environment(args, args.data_dir or tmp)
+
+        import app_flask
+        from bench import ingest_bench
+        from bench.transport import FakeTransport, BrokerTransport, MqttTransport
+
+        app_flask.start_services(connect_mqtt=args.transport == 'mqtt')
+        clients = ingest_bench.attach_socketio_clients(app_flask, args.clients)
+        if args.transport == 'mqtt':
+            host, _, port = args.broker.partition(':')
+            transport = MqttTransport(app_flask, host, int(port or 1883), qos=args.qos)
+        elif args.transport == 'broker':
+            transport = BrokerTransport(app_flask)
+        else:
+            transport = FakeTransport(app_flask)
+        transport.start()
+
+        runs = []
+        try:
+            for rate in [int(r) for r in args.rates.split(',') if r.strip()]:
+                print(f"🚀 {rate} msg/s × {args.duration} 秒（{args.codec}, {transport.name}）...")
+                result = ingest_bench.run_rate(app_flask, transport, rate, args.duration,
+                                               devices=args.devices, codec=args.codec)
+                runs.append(result)
+                for client in clients:
+                    client.get_received()
+                print(f"   吞吐量 {result['throughput']} msg/s，"
+                      f"p50 {result['latency_p50_ms']} ms，p99 {result['latency_p99_ms']} ms，"
+                      f"丟棄 {result['dropped']}，記憶體 {result['rss_growth_bytes'] / 1e6:+.1f} MB")
+        finally:
+            transport.stop()
+            app_flask.pipeline.close()
+            app_flask.store_writer.close()
+            app_flask.csv_writer.close()
+            if app_flask.broker is not None:
+                app_flask.broker.stop()
+            if embedded is not None:
+                embedded.stop()
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}
+    results = ingest_bench.collect_results(runs, config)
+    if args.output:
+        ingest_bench.save_results(args.output, results)
+        print(f"✅ 結果已寫入 {args.output}")
+    else:
+        import json
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        regressions = ingest_bench.compare(results, ingest_bench.load_results(args.baseline), args.tolerance)
+        for line in regressions:
+            print(f"❌ 退步: {line}")
+        if regressions:
+            return 1
+        print("✅ 與基準結果相比沒有明顯退步")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""
+接收路徑 benchmark
+
+以開放迴路（open-loop）方式依排定時間送出訊息：送出時間不受處理速度影響，
+處理跟不上時延遲與丟棄數會如實反映出來
+"""
+
+import gc
+import json
+import platform
+import time
+import numpy as np
+from metrics import process_rss_bytes
+from payload_codec import get_codec
+
+# 結果 JSON 的格式版本
+RESULT_VERSION = 1
+
+# 與基準結果比較的項目：(欄位, 數值越大越好)
+COMPARED_FIELDS = (
+    ('throughput', True),
+    ('latency_p50_ms', False),
+    ('latency_p99_ms', False),
+)
+
+
+def make_messages(count, devices, codec_name, base_topic):
+    """
+    預先產生測試訊息（避免產生訊息的成本計入量測）
+
+    每筆訊息的 msg_id 不同，payload 內容因此不重複，可用來對應送出時間
+
+    Returns:
+        list: [(topic, payload bytes), ...]
+    """
+    codec = get_codec(codec_name)
+    rng = np.random.default_rng(0)
+    temperatures = np.round(20 + rng.uniform(-5, 10, count), 2)
+    humidities = np.round(50 + rng.uniform(-10, 20, count), 2)
+    messages = []
+    for i in range(count):
+        device = f'bench-{i % devices}'
+        data = {
+            'temperature': float(temperatures[i]),
+            'humidity': float(humidities[i]),
+            'light_status': '開' if i % 2 == 0 else '關',
+            'message_id': i + 1,
+            'msg_id': i + 1,
+        }
+        if codec_name == 'struct':
+            # struct 格式不含裝置名稱，裝置名稱放在主題最後一層
+            topic = f'{base_topic}/bin/{device}'
+        elif codec_name == 'cbor':
+            topic = f'{base_topic}/cbor/{device}'
+            data['device'] = device
+        else:
+            topic = base_topic
+            data['device'] = device
+        messages.append((topic, codec.encode(data)))
+    return messages
+
+
+def send_open_loop(transport, messages, rate, sent_at):
+    """
+    依排定時間送出訊息（第 i 筆在 start + i / rate 送出）
+
+    落後排程時會連續送出，不會因此降低整體速率
+
+    Returns:
+        float: 實際送出所花的秒數
+    """
+    start = time.perf_counter()
+    total = len(messages)
+    i = 0
+    while i < total:
+        now = time.perf_counter()
+        due = min(total, int((now - start) * rate) + 1)
+        if due <= i:
+            time.sleep(min(0.001, (i / rate) - (now - start)))
+            continue
+        while i < due:
+            topic, payload = messages[i]
+            sent_at[i] = time.perf_counter()
+            transport.publish(topic, payload)
+            i += 1
+    return time.perf_counter() - start
+
+
+def submitted(stats):
+    """送進接收管線的訊息總數（含取樣略過與佇列滿時丟棄的）"""
+    return stats['accepted'] + stats['sampled_out'] + stats['dropped']
+
+
+def wait_idle(app, expected, timeout):
+    """
+    等待接收管線處理完畢（每筆訊息都已處理或丟棄），且寫入器佇列清空
+
+    Returns:
+        float: 送出結束後等待的秒數
+    """
+    start = time.perf_counter()
+    deadline = start + timeout
+    while time.perf_counter() < deadline:
+        stats = app.pipeline.stats()
+        handled = stats['processed'] + stats['errors'] + stats['dropped_oldest']
+        if stats['depth'] == 0 and handled + stats['sampled_out'] + stats['dropped'] >= expected \
+                and app.store_writer.queue.empty() and app.csv_writer.queue.empty():
+            break
+        time.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def percentiles_ms(seconds):
+    """回傳 p50 / p90 / p99 / max（毫秒）"""
+    if len(seconds) == 0:
+        return {'latency_p50_ms': None, 'latency_p90_ms': None, 'latency_p99_ms': None, 'latency_max_ms': None}
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+    return {
+        'latency_p50_ms': round(float(p50), 3),
+        'latency_p90_ms': round(float(p90), 3),
+        'latency_p99_ms': round(float(p99), 3),
+        'latency_max_ms': round(float(seconds.max() * 1000), 3),
+    }
+
+
+def run_rate(app, transport, rate, duration, devices=10, codec='json', drain_timeout=30.0):
+    """
+    以固定速率執行一次 benchmark
+
+    端到端延遲：從送出訊息到接收管線處理完成（已放入環狀緩衝區、彙總、寫入與推送佇列）
+
+    Returns:
+        dict: 量測結果
+    """
+    count = max(1, int(rate * duration))
+    messages = make_messages(count, devices, codec, app.MQTT_TOPIC)
+    index = {payload: i for i, (_, payload) in enumerate(messages)}
+    sent_at = np.zeros(count)
+    done_at = np.zeros(count)
+
+    def on_done(item):
+        i = index.get(item[1])
+        if i is not None:
+            done_at[i] = time.perf_counter()
+
+    # 每次執行的 msg_id 都從 1 開始，清除上一次的去重狀態
+    if app.dedup_index is not None:
+        app.dedup_index.reset()
+    before = app.pipeline.stats()
+    rows_before = app.store_writer.rows_written
+    emitted_before = app.broadcaster.emitted
+    gc.collect()
+    rss_before = process_rss_bytes()
+
+    app.pipeline.on_done = on_done
+    try:
+        send_seconds = send_open_loop(transport, messages, rate, sent_at)
+        drain_seconds = wait_idle(app, submitted(before) + count, drain_timeout)
+    finally:
+        app.pipeline.on_done = None
+    # 重新排序緩衝區暫存的數據全部輸出，寫入與推送筆數才會完整
+    if app.reorder_buffer is not None:
+        app.flush_reorder()
+    # 推送在背景工作中進行，等待最後一個時間窗口
+    time.sleep(app.broadcaster.interval * 2)
+
+    after = app.pipeline.stats()
+    completed = done_at > 0
+    latencies = (done_at - sent_at)[completed]
+    elapsed = (done_at[completed].max() - sent_at[0]) if completed.any() else send_seconds
+    result = {
+        'rate': rate,
+        'duration': duration,
+        'devices': devices,
+        'codec': codec,
+        'transport': transport.name,
+        'sent': count,
+        'offered_rate': round(count / send_seconds, 1),
+        'processed': int(completed.sum()),
+        'throughput': round(float(completed.sum()) / elapsed, 1) if elapsed > 0 else None,
+        'dropped': sum(after[key] - before[key] for key in ('dropped_oldest', 'sampled_out', 'dropped')),
+        'errors': after['errors'] - before['errors'],
+        'drain_seconds': round(drain_seconds, 3),
+        'rows_persisted': app.store_writer.rows_written - rows_before,
+        'emits': app.broadcaster.emitted - emitted_before,
+        'rss_before_bytes': rss_before,
+        'rss_after_bytes': process_rss_bytes(),
+    }
+    result['rss_growth_bytes'] = result['rss_after_bytes'] - rss_before
+    result.update(percentiles_ms(latencies))
+    return result
+
+
+def collect_results(runs, config):
+    """組成結果 JSON"""
+    return {
+        'version': RESULT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': config,
+        'runs': runs,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    與基準結果比較（依 rate 對應）
+
+    Args:
+        tolerance: 容許的退步比例（0.2 = 20%）
+
+    Returns:
+        list: 退步項目的說明文字
+    """
+    baseline_runs = {(run['rate'], run['codec'], run['transport']): run for run in baseline.get('runs', [])}
+    regressions = []
+    for run in results['runs']:
+        base = baseline_runs.get((run['rate'], run['codec'], run['transport']))
+        if base is None:
+            continue
+        for field, higher_is_better in COMPARED_FIELDS:
+            new, old = run.get(field), base.get(field)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"rate={run['rate']} {field}: {old} → {new} ({change:+.0%})")
+    return regressions
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def attach_socketio_clients(app, count):
+    """
+    連線 count 個 Socket.IO 測試客戶端，讓推送包含實際的扇出（fan-out）成本
+
+    Returns:
+        list: 測試客戶端
+    """
+    return [app.socketio.test_client(app.app) for _ in range(count)]
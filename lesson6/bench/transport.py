@@ -0,0 +1,86 @@
+"""
+benchmark 的訊息傳送方式
+
+- FakeTransport: 不經過網路，直接以 paho 的 MQTTMessage 呼叫 on_message（量測應用程式本身）
+- BrokerTransport: 發布到應用程式內建 broker（broker 路由 + 本機訂閱，不經過 TCP）
+- MqttTransport: 透過真正的 MQTT broker 發布（包含 broker 與網路的成本）
+"""
+
+import time
+import paho.mqtt.client as mqtt
+
+
+class FakeTransport:
+    """模擬 paho 的網路執行緒：直接呼叫應用程式的 on_message"""
+
+    name = 'fake'
+
+    def __init__(self, app):
+        self.app = app
+
+    def start(self):
+        pass
+
+    def publish(self, topic, payload):
+        message = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        message.payload = payload
+        self.app.on_message(self.app.mqtt_client, None, message)
+
+    def stop(self):
+        pass
+
+
+class BrokerTransport:
+    """發布到應用程式的內建 broker（EMBEDDED_BROKER=1）"""
+
+    name = 'broker'
+
+    def __init__(self, app):
+        self.app = app
+
+    def start(self):
+        if self.app.broker is None:
+            raise RuntimeError("應用程式沒有啟動內建 broker")
+
+    def publish(self, topic, payload):
+        self.app.broker.publish(topic, payload)
+
+    def stop(self):
+        pass
+
+
+class MqttTransport:
+    """透過 MQTT broker 發布訊息（應用程式需已連線並訂閱）"""
+
+    name = 'mqtt'
+
+    def __init__(self, app, host, port, qos=0, timeout=10.0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.timeout = timeout
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+                                  client_id='bench-publisher')
+        # 發布端不限制待送訊息數，速率由 benchmark 控制
+        self.client.max_queued_messages_set(0)
+        self.client.max_inflight_messages_set(1000)
+
+    def start(self):
+        """連線 broker，並等待應用程式完成訂閱"""
+        self.client.connect(self.host, self.port, 60)
+        self.client.loop_start()
+        deadline = time.monotonic() + self.timeout
+        while not self.app.mqtt_connected:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"應用程式無法連線 MQTT broker {self.host}:{self.port}")
+            time.sleep(0.05)
+        # 等待 SUBSCRIBE 完成
+        time.sleep(0.5)
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, payload, qos=self.qos)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
@@ -0,0 +1,81 @@
+"""
+合併與限速的 Socket.IO 推送
+接收執行緒只把數據放入待推送列表；背景工作每個時間窗口把累積的數據
+合併成一個事件推送，每個窗口只序列化一次，與裝置數量無關
+"""
+
+import collections
+import threading
+import time
+
+
+class Broadcaster:
+    """
+    以時間窗口合併推送的 Socket.IO 廣播器
+
+    - publish() 只把數據加入待推送列表（O(1)，不做序列化）
+    - 背景工作每隔 max(window, 1 / max_rate) 秒推送一次累積的數據
+    - 待推送列表超過 max_pending 筆時丟棄最舊的數據（前端會以增量查詢補齊）
+    """
+
+    def __init__(self, socketio, build_payload, event='new_data',
+                 window=0.25, max_rate=4.0, max_pending=1000, on_emit=None):
+        """
+        Args:
+            socketio: flask_socketio.SocketIO
+            build_payload: 將待推送的數據列表轉換為事件內容的函式
+            event: 事件名稱
+            window: 合併的時間窗口（秒）
+            max_rate: 每秒最多推送次數
+            max_pending: 待推送列表最多筆數
+            on_emit: 每次推送後呼叫 on_emit(筆數, 秒數)，供指標統計使用
+        """
+        self.socketio = socketio
+        self.build_payload = build_payload
+        self.event = event
+        self.on_emit = on_emit
+        self.interval = max(window, 1.0 / max_rate if max_rate > 0 else window)
+
+        self._pending = collections.deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+        self._started = False
+
+        self.published = 0
+        self.emitted = 0
+        self.dropped = 0
+
+    def publish(self, row):
+        """加入一筆待推送的數據"""
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append(row)
+            self.published += 1
+
+    def start(self):
+        """啟動背景推送工作"""
+        if not self._started:
+            self._started = True
+            self.socketio.start_background_task(self._run)
+
+    def flush(self):
+        """推送目前累積的數據（沒有數據時不推送）"""
+        with self._lock:
+            if not self._pending:
+                return
+            rows = list(self._pending)
+            self._pending.clear()
+        started = time.perf_counter()
+        self.socketio.emit(self.event, self.build_payload(rows))
+        self.emitted += 1
+        if self.on_emit is not None:
+            self.on_emit(len(rows), time.perf_counter() - started)
+
+    def _run(self):
+        """背景推送迴圈"""
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️  推送數據時發生錯誤: {e}")
@@ -0,0 +1,160 @@
+"""
+以訊息序號（msg_id）去除重複訊息，並統計每個裝置的遺失與亂序
+
+QoS 1 在重新連線後可能重送同一筆訊息；每個裝置只保留「目前最大序號」與其之前
+WINDOW 個序號的位元圖（sliding bitmap，與 IPsec 防重送視窗相同），
+記憶體固定，不需要查詢完整歷史
+
+- 序號大於最大值：接受，中間跳過的序號計為遺失（之後補到時扣回）；
+  一次跳過超過視窗大小不可能是遺失，視為重設
+- 序號在視窗內：位元已設定為重複（丟棄），否則為亂序到達（接受）
+- 以下情況視為裝置重新開機（Pico 的序號從 1 重新開始），重設狀態並接受：
+  - 序號比視窗還舊，或已收過且落後超過 RESTART_GAP（重送只會是最近的幾筆，不會落後這麼多）
+  - 已收過的小序號（不超過 RESTART_GAP，且不到最大值的一半）：新的序列剛開始，
+    例如送出 30 筆後重新開機、或測試程式以同樣的序號再執行一次
+
+統計的讀取端不加鎖：check() 前後各遞增一次版本號（seqlock，與 ring_buffer 相同）
+"""
+
+from ring_buffer import seqlock_read
+
+# 預設視窗大小（每個裝置記得最近多少個序號）
+DEDUP_WINDOW = 1024
+# 已收過的序號落後超過此值時視為重新開機，而不是重送
+RESTART_GAP = 64
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+
+
+class DeviceSequence:
+    """單一裝置的序號狀態與統計"""
+
+    __slots__ = ('highest', 'bitmap', 'received', 'duplicates', 'missing', 'reordered', 'resets')
+
+    def __init__(self):
+        self.highest = None
+        # 第 i 個位元代表序號 highest - i 是否已收到
+        self.bitmap = 0
+        self.received = 0
+        self.duplicates = 0
+        self.missing = 0
+        self.reordered = 0
+        self.resets = 0
+
+    def to_json(self):
+        return {
+            'last_msg_id': self.highest,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'missing': self.missing,
+            'reordered': self.reordered,
+            'resets': self.resets,
+        }
+
+
+class DedupIndex:
+    """
+    每個裝置一個滑動位元圖的去重索引
+
+    check() 不是執行緒安全的，呼叫端需持有鎖（app_flask 在 ingest_lock 內呼叫）；
+    totals() / to_json() 不需要加鎖
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, restart_gap=RESTART_GAP):
+        if window <= 0:
+            raise ValueError("window 必須大於 0")
+        self.window = window
+        self.restart_gap = restart_gap
+        self.mask = (1 << window) - 1
+        self.devices = {}
+        self.duplicates = 0
+        # seqlock 版本號：check() 執行中為奇數
+        self.version = 0
+
+    def check(self, device, msg_id):
+        """
+        檢查一筆訊息
+
+        Returns:
+            str: ACCEPTED 或 DUPLICATE
+        """
+        self.version += 1
+        try:
+            return self._check(device, msg_id)
+        finally:
+            self.version += 1
+
+    def _check(self, device, msg_id):
+        state = self.devices.get(device)
+        if state is None:
+            state = DeviceSequence()
+            # 複製後替換，讀取端迭代中的對應表不會改變
+            self.devices = {**self.devices, device: state}
+
+        highest = state.highest
+        if highest is None:
+            state.highest = msg_id
+            state.bitmap = 1
+        elif msg_id > highest:
+            shift = msg_id - highest
+            if shift >= self.window:
+                # 不合理的跳躍（錯誤的序號或重設），不計為遺失，也避免位移出巨大的整數
+                self._restart(state, msg_id)
+            else:
+                state.missing += shift - 1
+                state.bitmap = ((state.bitmap << shift) | 1) & self.mask
+                state.highest = msg_id
+        else:
+            behind = highest - msg_id
+            bit = 1 << behind if behind < self.window else 0
+            if not bit or (state.bitmap & bit and self._restarted(msg_id, behind, highest)):
+                self._restart(state, msg_id)
+            elif state.bitmap & bit:
+                state.duplicates += 1
+                self.duplicates += 1
+                return DUPLICATE
+            else:
+                # 之前被計為遺失的序號晚到了
+                state.bitmap |= bit
+                state.missing -= 1
+                state.reordered += 1
+        state.received += 1
+        return ACCEPTED
+
+    def _restarted(self, msg_id, behind, highest):
+        """已收過的序號是否代表裝置重新開機（而不是重送）"""
+        if behind >= self.restart_gap:
+            return True
+        return msg_id <= self.restart_gap and msg_id * 2 <= highest
+
+    @staticmethod
+    def _restart(state, msg_id):
+        # 裝置重新開機，序號重新開始
+        state.resets += 1
+        state.highest = msg_id
+        state.bitmap = 1
+
+    def reset(self):
+        """清除所有裝置的狀態"""
+        self.devices = {}
+        self.duplicates = 0
+
+    def totals(self):
+        """所有裝置合計的統計"""
+        return seqlock_read(self, self._totals, self.devices)
+
+    @staticmethod
+    def _totals(devices):
+        totals = {'duplicates': 0, 'missing': 0, 'reordered': 0, 'resets': 0}
+        for state in devices.values():
+            totals['duplicates'] += state.duplicates
+            totals['missing'] += state.missing
+            totals['reordered'] += state.reordered
+            totals['resets'] += state.resets
+        return totals
+
+    def to_json(self, device=None):
+        devices = self.devices
+        names = [device] if device is not None else sorted(devices)
+        return seqlock_read(self, lambda: {name: devices[name].to_json() for name in names if name in devices})
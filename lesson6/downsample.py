@@ -0,0 +1,108 @@
+"""
+圖表用的視覺降採樣
+- LTTB（Largest-Triangle-Three-Buckets）：保留視覺形狀的降採樣
+- min/max：每個像素區間保留最小值與最大值，峰值與低谷一定會保留
+"""
+
+import numpy as np
+
+DOWNSAMPLE_MODES = ('lttb', 'minmax')
+
+
+def lttb_indices(x, y, n):
+    """
+    以 LTTB 演算法選出 n 個點的索引
+
+    每個區間選出與「前一個選中點」及「下一個區間平均點」所構成三角形面積最大的點，
+    每個區間內的面積以向量化方式一次計算。
+
+    Args:
+        x: X 軸數值（已排序）
+        y: Y 軸數值
+        n: 要保留的點數（至少 3）
+
+    Returns:
+        numpy.ndarray: 選中點的索引（已排序）
+    """
+    length = len(x)
+    if n >= length or n < 3:
+        return np.arange(length)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # 第一個與最後一個點固定保留，中間切成 n - 2 個區間
+    edges = np.linspace(1, length - 1, n - 1).astype(np.intp)
+    # 每個區間的平均點（供前一個區間計算三角形時使用）
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:length - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:length - 1], edges[:-1]) / counts
+
+    selected = np.empty(n, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = length - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 1 < n - 2:
+            cx, cy = avg_x[i + 1], avg_y[i + 1]
+        else:
+            cx, cy = x[-1], y[-1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax_indices(y, n):
+    """
+    將數據切成 n // 2 個區間，每個區間保留最小值與最大值的索引
+
+    Args:
+        y: Y 軸數值
+        n: 要保留的點數上限
+
+    Returns:
+        numpy.ndarray: 選中點的索引（已排序）
+    """
+    length = len(y)
+    buckets = max(1, n // 2)
+    if n >= length:
+        return np.arange(length)
+    bucket_id = np.arange(length) * buckets // length
+    # 依 (區間, 數值) 排序後，每個區間的第一個為最小值、最後一個為最大值
+    order = np.lexsort((np.asarray(y), bucket_id))
+    starts = np.searchsorted(bucket_id[order], np.arange(buckets), 'left')
+    ends = np.searchsorted(bucket_id[order], np.arange(buckets), 'right') - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+def downsample(columns, max_points, mode='lttb', series=('temperature', 'humidity')):
+    """
+    將欄位集合降採樣到約 max_points 個點
+
+    每個數列各自選點後取聯集，確保每個數列的峰值與低谷都保留
+
+    Args:
+        columns: 欄位集合（timestamp 需已排序）
+        max_points: 最多回傳的點數
+        mode: 'lttb' 或 'minmax'
+        series: 要保留形狀的數列欄位
+
+    Returns:
+        dict: 降採樣後的欄位集合
+    """
+    if mode not in DOWNSAMPLE_MODES:
+        raise ValueError(f"未知的降採樣方式: {mode}")
+    length = len(columns['timestamp'])
+    if max_points <= 0 or length <= max_points:
+        return columns
+
+    per_series = max(3, max_points // len(series))
+    parts = []
+    for name in series:
+        if mode == 'lttb':
+            parts.append(lttb_indices(columns['timestamp'], columns[name], per_series))
+        else:
+            parts.append(minmax_indices(columns[name], per_series))
+    index = np.unique(np.concatenate(parts))
+    return {key: values[index] for key, values in columns.items()}
@@ -1,11 +1,33 @@
 """
 生成測試數據檔案
 同時建立 CSV 和 Excel 格式
+
+不加參數執行時與以前相同：生成 50 筆數據到 sensor_data.csv 與 sensor_data.xlsx。
+加上參數時以 NumPy 向量化方式大量生成多個裝置的數據（可達數千萬筆），
+依時間分段產生並逐段寫出，記憶體用量與總筆數無關：
+
+    # 10 個裝置、一年、每 5 秒一筆（約 6300 萬筆）寫入二進位儲存
+    python generate_test_data.py --devices 10 --days 365 --interval 5 --format store --output data
+
+    # 指定總筆數，輸出 CSV 或 Parquet（需要 pyarrow）；
+    # 多裝置的 CSV 多一個「裝置」欄位，預設寫到 sensor_data_devices.csv，不會混入應用程式的 sensor_data.csv
+    python generate_test_data.py --devices 3 --rows 1000000 --format csv --output big.csv
+    python generate_test_data.py --devices 3 --rows 1000000 --format parquet --output big.parquet
+
+模擬內容：
+- 溫度與濕度的日變化（下午最熱、濕度與溫度反向）與季節變化，加上緩慢漂移與雜訊
+- 電燈作息（早上短暫開燈、傍晚開燈到深夜，每天時間略有不同）
+- 斷線造成的數據缺口，以及感測器讀值異常（極端值）
 """
 
+import argparse
 import csv
+import os
+import sys
+import time
 from datetime import datetime, timedelta
-import random
+import numpy as np
+from ring_buffer import LIGHT_LABELS, encode_light, format_timestamps
 
 # 嘗試導入 openpyxl（用於 Excel）
 try:
@@ -15,9 +37,261 @@ except ImportError:
     HAS_OPENPYXL = False
     print("⚠️  未安裝 openpyxl，將只生成 CSV 檔案")
 
+# 嘗試導入 pyarrow（用於 Parquet）
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+CSV_FIELDNAMES = ['時間戳記', '電燈狀態', '溫度', '濕度']
+# 多裝置的 CSV（多一個「裝置」欄位，和應用程式的 sensor_data.csv 分開）
+MULTI_DEVICE_CSV = 'sensor_data_devices.csv'
+DAY_MS = 86400 * 1000
+HOUR_MS = 3600 * 1000
+
+# 每段生成的總筆數（所有裝置合計）
+DEFAULT_CHUNK_ROWS = 1_000_000
+# 平均每天斷線次數與每次斷線的平均長度（分鐘）
+DEFAULT_GAPS_PER_DAY = 0.5
+GAP_MEAN_MINUTES = 20
+# 讀值異常的比例
+DEFAULT_OUTLIER_RATE = 0.0005
+# 常見的感測器錯誤讀值（DHT 系列讀取失敗時的值）
+SENSOR_ERROR_VALUES = np.array([-40.0, 85.0])
+
+
+def make_profile(device_index, start_ms, end_ms, seed=0, gaps_per_day=DEFAULT_GAPS_PER_DAY):
+    """
+    產生一個裝置的固定參數（基準溫濕度、日變化幅度、每天的開關燈時間、斷線區間）
+
+    同一個裝置的數據只由這些參數與時間決定，分段生成時各段可以獨立計算
+
+    Returns:
+        dict: 裝置參數
+    """
+    rng = np.random.default_rng([seed, device_index])
+    first_day = start_ms // DAY_MS
+    days = int(end_ms // DAY_MS - first_day + 2)
+
+    # 斷線區間（依開始時間排序）
+    gap_count = rng.poisson(gaps_per_day * (end_ms - start_ms) / DAY_MS)
+    gap_starts = np.sort(rng.integers(start_ms, max(start_ms + 1, end_ms), gap_count))
+    gap_ends = gap_starts + (rng.exponential(GAP_MEAN_MINUTES, gap_count) * 60000).astype(np.int64)
+
+    return {
+        'index': device_index,
+        'seed': seed,
+        'base_temperature': rng.uniform(22, 27),
+        'daily_amplitude': rng.uniform(1.5, 4.0),
+        'seasonal_amplitude': rng.uniform(3, 6),
+        'base_humidity': rng.uniform(55, 70),
+        'humidity_coupling': rng.uniform(1.5, 3.0),
+        # 緩慢漂移：數個週期數小時到數天的正弦波
+        'drift_periods_ms': rng.uniform(3, 72, 4) * HOUR_MS,
+        'drift_phases': rng.uniform(0, 2 * np.pi, 4),
+        'drift_amplitudes': rng.uniform(0.1, 0.6, 4),
+        # 每天的開關燈時間（本地時間，小時）
+        'first_day': first_day,
+        'morning_on': rng.normal(6.5, 0.3, days),
+        'morning_off': rng.normal(7.5, 0.3, days),
+        'evening_on': rng.normal(18.5, 0.5, days),
+        'evening_off': rng.normal(23.0, 0.7, days),
+        'gap_starts': gap_starts,
+        'gap_ends': gap_ends,
+    }
+
+
+def generate_device_columns(profile, timestamps_ms, chunk_index=0, outlier_rate=DEFAULT_OUTLIER_RATE,
+                            drop_rate=0.0):
+    """
+    向量化生成一個裝置在指定時間點的數據
+
+    Args:
+        profile: make_profile() 的結果
+        timestamps_ms: epoch 毫秒陣列（依時間排序）
+        chunk_index: 分段編號（決定雜訊的亂數種子，使結果可重現）
+        outlier_rate: 讀值異常的比例
+        drop_rate: 隨機遺失單筆數據的比例
+
+    Returns:
+        dict: timestamp / temperature / humidity / light 陣列（已移除斷線與遺失的時間點）
+    """
+    rng = np.random.default_rng([profile['seed'], profile['index'], chunk_index, 1])
+    timestamps = np.asarray(timestamps_ms, dtype=np.int64)
+
+    # 移除斷線區間內與隨機遺失的時間點
+    keep = np.ones(len(timestamps), dtype=bool)
+    if len(profile['gap_starts']):
+        i = np.searchsorted(profile['gap_starts'], timestamps, 'right') - 1
+        inside = i >= 0
+        inside[inside] = timestamps[inside] < profile['gap_ends'][i[inside]]
+        keep &= ~inside
+    if drop_rate:
+        keep &= rng.random(len(timestamps)) >= drop_rate
+    timestamps = timestamps[keep]
+    n = len(timestamps)
+
+    offset_ms = time.localtime().tm_gmtoff * 1000
+    local_ms = timestamps + offset_ms
+    hours = (local_ms % DAY_MS) / HOUR_MS
+    day_of_year = (local_ms // DAY_MS) % 365
+
+    # 日變化：下午 3 點最熱；季節變化：7 月最熱
+    daily = np.sin(2 * np.pi * (hours - 9) / 24)
+    seasonal = np.cos(2 * np.pi * (day_of_year - 196) / 365)
+    drift = np.zeros(n)
+    for period, phase, amplitude in zip(profile['drift_periods_ms'], profile['drift_phases'],
+                                        profile['drift_amplitudes']):
+        drift += amplitude * np.sin(2 * np.pi * timestamps / period + phase)
+
+    temperature = (profile['base_temperature'] + profile['daily_amplitude'] * daily
+                   + profile['seasonal_amplitude'] * seasonal + drift + rng.normal(0, 0.15, n))
+    humidity = (profile['base_humidity'] - profile['humidity_coupling'] * profile['daily_amplitude'] * daily
+                - 2 * drift + rng.normal(0, 0.8, n))
+    humidity = np.clip(humidity, 5, 99)
+
+    # 讀值異常：感測器錯誤值或突然的尖峰
+    outliers = np.flatnonzero(rng.random(n) < outlier_rate)
+    if len(outliers):
+        spikes = temperature[outliers] + rng.choice([-1, 1], len(outliers)) * rng.uniform(8, 20, len(outliers))
+        errors = rng.choice(SENSOR_ERROR_VALUES, len(outliers))
+        temperature[outliers] = np.where(rng.random(len(outliers)) < 0.5, errors, spikes)
+        humidity[outliers] = np.where(rng.random(len(outliers)) < 0.3, 0.0, humidity[outliers])
+
+    # 電燈作息（依當天的開關燈時間）
+    day = np.clip(local_ms // DAY_MS - profile['first_day'], 0, len(profile['morning_on']) - 1)
+    on = ((hours >= profile['morning_on'][day]) & (hours < profile['morning_off'][day])) | \
+         ((hours >= profile['evening_on'][day]) & (hours < profile['evening_off'][day]))
+    light = np.where(on, encode_light('開'), encode_light('關')).astype(np.uint8)
+
+    return {
+        'timestamp': timestamps,
+        'temperature': np.round(temperature, 2).astype(np.float32),
+        'humidity': np.round(humidity, 2).astype(np.float32),
+        'light': light,
+    }
+
+
+def iter_chunks(devices, start_ms, end_ms, interval_s, chunk_rows=DEFAULT_CHUNK_ROWS, seed=0,
+                gaps_per_day=DEFAULT_GAPS_PER_DAY, outlier_rate=DEFAULT_OUTLIER_RATE, drop_rate=0.0):
+    """
+    依時間分段生成所有裝置的數據
+
+    每段涵蓋一個時間窗口（所有裝置合計約 chunk_rows 筆），
+    每個裝置的取樣時間帶有少量抖動，且各裝置的起始時間錯開
+
+    Yields:
+        dict: 裝置名稱 → 欄位陣列（一個時間窗口）
+    """
+    interval_ms = int(interval_s * 1000)
+    names = [f'device-{i + 1:03d}' for i in range(devices)]
+    profiles = [make_profile(i, start_ms, end_ms, seed, gaps_per_day) for i in range(devices)]
+    window_ms = max(interval_ms, chunk_rows // max(1, devices) * interval_ms)
+    jitter_ms = interval_ms // 10
+
+    for chunk_index, window_start in enumerate(range(start_ms, end_ms, window_ms)):
+        window_end = min(window_start + window_ms, end_ms)
+        chunk = {}
+        for name, profile in zip(names, profiles):
+            # 各裝置的取樣時間錯開，並加上少量抖動（不超過間隔的 10%，仍維持時間順序）
+            phase = start_ms + (profile['index'] * interval_ms) // max(1, devices)
+            first = phase + -(-(window_start - phase) // interval_ms) * interval_ms
+            timestamps = np.arange(first, window_end, interval_ms, dtype=np.int64)
+            if jitter_ms:
+                rng = np.random.default_rng([seed, profile['index'], chunk_index, 2])
+                timestamps += rng.integers(0, jitter_ms, len(timestamps))
+            chunk[name] = generate_device_columns(profile, timestamps, chunk_index, outlier_rate, drop_rate)
+        yield chunk
+
+
+def merge_chunk(chunk):
+    """將一個時間窗口內所有裝置的數據依時間合併（CSV / Parquet 依時間排序輸出）"""
+    parts = [dict(columns, device=np.full(len(columns['timestamp']), name, dtype=object))
+             for name, columns in chunk.items()]
+    merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    order = np.argsort(merged['timestamp'], kind='stable')
+    return {key: values[order] for key, values in merged.items()}
+
+
+def write_csv_chunks(chunks, path, with_device=True):
+    """逐段寫入 CSV（有多個裝置時加上「裝置」欄位）"""
+    total = 0
+    labels = np.array(LIGHT_LABELS, dtype=object)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDNAMES + (['裝置'] if with_device else []))
+        for chunk in chunks:
+            columns = merge_chunk(chunk)
+            fields = [
+                format_timestamps(columns['timestamp']),
+                labels[columns['light']],
+                np.char.mod('%.2f', columns['temperature']),
+                np.char.mod('%.2f', columns['humidity']),
+            ]
+            if with_device:
+                fields.append(columns['device'])
+            writer.writerows(zip(*fields))
+            total += len(columns['timestamp'])
+            print(f"   已寫入 {total:,} 筆", end='\r')
+    print()
+    return total
+
+
+def write_store_chunks(chunks, root):
+    """逐段寫入二進位欄位式儲存（每個裝置直接寫入欄位陣列）"""
+    from segment_store import SegmentStore
+    store = SegmentStore(root)
+    store.open()
+    total = 0
+    try:
+        for chunk in chunks:
+            for name, columns in chunk.items():
+                store.write_columns(name, columns)
+                total += len(columns['timestamp'])
+            store.flush()
+            print(f"   已寫入 {total:,} 筆", end='\r')
+        store.flush(fsync=True)
+    finally:
+        store.close()
+    print()
+    return total
+
+
+def write_parquet_chunks(chunks, path):
+    """逐段寫入 Parquet（每段一個 row group，需要 pyarrow）"""
+    if not HAS_PYARROW:
+        raise RuntimeError("輸出 Parquet 需要安裝 pyarrow")
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('ms', tz='UTC')),
+        ('device', pa.dictionary(pa.int32(), pa.string())),
+        ('temperature', pa.float32()),
+        ('humidity', pa.float32()),
+        ('light_status', pa.dictionary(pa.int8(), pa.string())),
+    ])
+    total = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for chunk in chunks:
+            columns = merge_chunk(chunk)
+            table = pa.table({
+                'timestamp': pa.array(columns['timestamp'], pa.timestamp('ms', tz='UTC')),
+                'device': pa.array(columns['device'].astype(str)).dictionary_encode(),
+                'temperature': columns['temperature'],
+                'humidity': columns['humidity'],
+                'light_status': pa.DictionaryArray.from_arrays(
+                    pa.array(columns['light'].astype(np.int8)), pa.array(LIGHT_LABELS)),
+            }, schema=schema)
+            writer.write_table(table)
+            total += len(columns['timestamp'])
+            print(f"   已寫入 {total:,} 筆", end='\r')
+    print()
+    return total
+
+
 def generate_test_data(count=50):
     """
-    生成測試數據
+    生成測試數據（單一裝置，每 5 分鐘一筆，供 CSV / Excel 範例檔使用）
     
     Args:
         count: 要生成的數據筆數
@@ -25,47 +299,26 @@ def generate_test_data(count=50):
     Returns:
         list: 包含測試數據的列表
     """
-    data = []
-    base_time = datetime.now() - timedelta(hours=count//2)  # 從幾小時前開始
-    
-    # 基礎溫度和濕度（會有變化）
-    base_temp = 25.0
-    base_humi = 60.0
-    
-    for i in range(count):
-        # 計算時間（每筆數據間隔幾分鐘）
-        timestamp = base_time + timedelta(minutes=i * 5)
-        timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # 生成溫度（帶有隨機波動）
-        temp_variation = random.uniform(-3, 3)
-        temperature = round(base_temp + temp_variation + (i % 10) * 0.5, 2)
-        
-        # 生成濕度（帶有隨機波動）
-        humi_variation = random.uniform(-5, 5)
-        humidity = round(base_humi + humi_variation + (i % 8) * 0.8, 2)
-        
-        # 電燈狀態（模擬白天關、晚上開）
-        hour = timestamp.hour
-        if 6 <= hour <= 18:
-            light_status = "關" if random.random() > 0.3 else "開"
-        else:
-            light_status = "開" if random.random() > 0.3 else "關"
-        
-        data.append({
-            '時間戳記': timestamp_str,
-            '電燈狀態': light_status,
-            '溫度': temperature,
-            '濕度': humidity
-        })
-    
-    return data
+    interval_ms = 5 * 60 * 1000
+    start_ms = int((datetime.now() - timedelta(hours=count // 2)).timestamp() * 1000)
+    timestamps = start_ms + np.arange(count, dtype=np.int64) * interval_ms
+    profile = make_profile(0, start_ms, int(timestamps[-1]) + 1, seed=int(time.time()), gaps_per_day=0)
+    columns = generate_device_columns(profile, timestamps, outlier_rate=0)
+
+    return [
+        {'時間戳記': timestamp, '電燈狀態': LIGHT_LABELS[light], '溫度': float(temperature), '濕度': float(humidity)}
+        for timestamp, light, temperature, humidity in zip(
+            format_timestamps(columns['timestamp']),
+            columns['light'],
+            np.round(columns['temperature'].astype(np.float64), 2),
+            np.round(columns['humidity'].astype(np.float64), 2)
+        )
+    ]
 
 def save_to_csv(data, filename='sensor_data.csv'):
     """儲存為 CSV 檔案"""
     with open(filename, 'w', newline='', encoding='utf-8') as f:
-        fieldnames = ['時間戳記', '電燈狀態', '溫度', '濕度']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
         writer.writerows(data)
     print(f"✅ CSV 檔案已建立: {filename}")
@@ -111,6 +364,53 @@ def save_to_excel(data, filename='sensor_data.xlsx'):
     print(f"✅ Excel 檔案已建立: {filename}")
     print(f"   包含 {len(data)} 筆數據")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='大量生成多裝置測試數據')
+    parser.add_argument('--devices', type=int, default=1, help='裝置數量')
+    parser.add_argument('--days', type=float, default=1, help='數據涵蓋的天數（到現在為止）')
+    parser.add_argument('--rows', type=int, help='總筆數（所有裝置合計，指定時取代 --days）')
+    parser.add_argument('--interval', type=float, default=5, help='每個裝置的取樣間隔（秒）')
+    parser.add_argument('--format', default='csv', choices=('csv', 'store', 'parquet'), help='輸出格式')
+    parser.add_argument('--output', help=f'輸出路徑（預設 sensor_data.csv（多裝置為 {MULTI_DEVICE_CSV}）/ data / sensor_data.parquet）')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS, help='每段生成的筆數')
+    parser.add_argument('--gaps-per-day', type=float, default=DEFAULT_GAPS_PER_DAY, help='每個裝置平均每天斷線次數')
+    parser.add_argument('--outlier-rate', type=float, default=DEFAULT_OUTLIER_RATE, help='讀值異常的比例')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='隨機遺失單筆數據的比例')
+    parser.add_argument('--seed', type=int, default=0, help='隨機種子（相同參數與種子產生相同數據）')
+    return parser.parse_args()
+
+def bulk_main():
+    """大量生成模式（有命令列參數時）"""
+    args = parse_args()
+    interval_ms = int(args.interval * 1000)
+    if args.rows:
+        span_ms = args.rows * interval_ms // max(1, args.devices)
+    else:
+        span_ms = int(args.days * DAY_MS)
+    end_ms = int(time.time() * 1000) // 1000 * 1000
+    start_ms = end_ms - span_ms
+    default_outputs = {'csv': 'sensor_data.csv', 'store': 'data', 'parquet': 'sensor_data.parquet'}
+    if args.devices > 1:
+        # 多裝置的 CSV 多一個「裝置」欄位，不能寫入應用程式的 4 欄 CSV 副本（sensor_data.csv）
+        default_outputs['csv'] = MULTI_DEVICE_CSV
+        if args.format == 'csv' and args.output and os.path.basename(args.output) == 'sensor_data.csv':
+            sys.exit(f"❌ 多裝置的 CSV 含「裝置」欄位，請輸出到其他檔案（例如 {MULTI_DEVICE_CSV}）")
+    output = args.output or default_outputs[args.format]
+    
+    print(f"📊 生成 {args.devices} 個裝置、約 {span_ms // interval_ms * args.devices:,} 筆數據"
+          f"（每 {args.interval:g} 秒一筆，{span_ms / DAY_MS:.1f} 天）→ {output}（{args.format}）")
+    chunks = iter_chunks(args.devices, start_ms, end_ms, args.interval, args.chunk_rows, args.seed,
+                         args.gaps_per_day, args.outlier_rate, args.drop_rate)
+    started = time.perf_counter()
+    if args.format == 'csv':
+        total = write_csv_chunks(chunks, output, with_device=args.devices > 1)
+    elif args.format == 'store':
+        total = write_store_chunks(chunks, output)
+    else:
+        total = write_parquet_chunks(chunks, output)
+    elapsed = time.perf_counter() - started
+    print(f"✅ 完成：{total:,} 筆，{elapsed:.1f} 秒（{total / max(elapsed, 1e-9):,.0f} 筆/秒）")
+
 def main():
     """主程式"""
     print("=" * 60)
@@ -152,10 +452,14 @@ def main():
     print("   3. 或直接重新整理網頁")
     print()
     print("💡 提示:")
-    print("   - 修改腳本中的 count 參數可生成更多數據")
+    print("   - 加上參數可大量生成多裝置數據，例如：")
+    print("     python generate_test_data.py --devices 10 --days 365 --format store --output data")
     print("   - 兩個檔案的內容相同，僅格式不同")
     print("=" * 60)
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        bulk_main()
+    else:
+        main()
 
@@ -0,0 +1,190 @@
+"""
+接收管線：有界佇列 + 工作執行緒
+MQTT 的 on_message 只把原始訊息放入佇列，解析、儲存、推送由工作執行緒完成，
+一個裝置寫入變慢不會拖住 paho 的網路執行緒
+"""
+
+import collections
+import threading
+import zlib
+
+# 佇列滿時的處理策略
+POLICY_BLOCK = 'block'              # 等待佇列有空位（對 broker 形成背壓）
+POLICY_DROP_OLDEST = 'drop_oldest'  # 丟棄佇列中最舊的訊息
+POLICY_SAMPLE = 'sample'            # 佇列超過一半時只保留每 N 筆中的 1 筆，滿了就丟棄新訊息
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SAMPLE)
+
+
+class BoundedQueue:
+    """支援多種滿載策略的有界佇列"""
+
+    def __init__(self, maxsize, policy=POLICY_DROP_OLDEST, sample_every=10):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的佇列策略: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_every = sample_every
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._sample_counter = 0
+        self._closed = False
+
+        # 各策略的計數
+        self.accepted = 0
+        self.blocked = 0         # block：需要等待的次數
+        self.dropped_oldest = 0  # drop_oldest：被丟棄的舊訊息數
+        self.sampled_out = 0     # sample：取樣時略過的訊息數
+        self.dropped = 0         # sample：佇列已滿而丟棄的新訊息數
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        放入一筆訊息
+
+        Returns:
+            bool: 是否放入佇列
+        """
+        with self._lock:
+            if self.policy == POLICY_BLOCK:
+                if len(self._items) >= self.maxsize:
+                    self.blocked += 1
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+            elif self.policy == POLICY_DROP_OLDEST:
+                if len(self._items) >= self.maxsize:
+                    self._items.popleft()
+                    self.dropped_oldest += 1
+            else:
+                if len(self._items) >= self.maxsize:
+                    self.dropped += 1
+                    return False
+                if len(self._items) >= self.maxsize // 2:
+                    self._sample_counter += 1
+                    if self._sample_counter % self.sample_every:
+                        self.sampled_out += 1
+                        return False
+            self._items.append(item)
+            self.accepted += 1
+            self._not_empty.notify()
+            return True
+
+    def get(self):
+        """取出一筆訊息（佇列為空時等待）；佇列關閉且為空時回傳 None"""
+        with self._lock:
+            while not self._items:
+                if self._closed:
+                    return None
+                self._not_empty.wait()
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def close(self):
+        """關閉佇列，喚醒所有等待中的執行緒"""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class IngestPipeline:
+    """
+    以分區佇列 + 工作執行緒處理接收的訊息
+
+    訊息依 key（例如裝置名稱）的雜湊分配到固定的工作執行緒，
+    同一個 key 的訊息依接收順序處理。
+    """
+
+    def __init__(self, handler, workers=2, queue_size=10000,
+                 policy=POLICY_DROP_OLDEST, sample_every=10, name='ingest', on_done=None):
+        """
+        Args:
+            handler: 處理單筆訊息的函式
+            workers: 工作執行緒數量
+            queue_size: 每個工作執行緒的佇列大小
+            policy: 佇列滿時的策略（block / drop_oldest / sample）
+            sample_every: sample 策略下每幾筆保留 1 筆
+            name: 執行緒名稱前綴
+            on_done: 每筆訊息處理完成後呼叫 on_done(item)（例如 benchmark 量測延遲）
+        """
+        self.handler = handler
+        self.name = name
+        self.on_done = on_done
+        self.queues = [BoundedQueue(queue_size, policy, sample_every) for _ in range(max(1, workers))]
+        self._threads = []
+        # 各工作執行緒各自的計數（每個元素只由一個執行緒更新，不需要鎖），讀取時加總
+        self._processed = [0] * len(self.queues)
+        self._errors = [0] * len(self.queues)
+
+    @property
+    def processed(self):
+        return sum(self._processed)
+
+    @property
+    def errors(self):
+        return sum(self._errors)
+
+    def submit(self, key, item):
+        """
+        放入一筆訊息（依 key 分配佇列）
+
+        Args:
+            key: 分配用的 key（str 或 bytes）
+
+        Returns:
+            bool: 是否放入佇列
+        """
+        if len(self.queues) == 1:
+            queue = self.queues[0]
+        else:
+            if isinstance(key, str):
+                key = key.encode('utf-8')
+            queue = self.queues[zlib.crc32(key) % len(self.queues)]
+        return queue.put(item)
+
+    def start(self):
+        """啟動工作執行緒"""
+        if self._threads:
+            return
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._run, args=(i, queue), name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self, timeout=5.0):
+        """關閉佇列，處理完剩餘訊息後停止工作執行緒"""
+        for queue in self.queues:
+            queue.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self):
+        """目前所有佇列中等待處理的訊息數"""
+        return sum(len(queue) for queue in self.queues)
+
+    def stats(self):
+        """各策略的計數（所有佇列合計）"""
+        totals = {'depth': self.depth(), 'processed': self.processed, 'errors': self.errors}
+        for field in ('accepted', 'blocked', 'dropped_oldest', 'sampled_out', 'dropped'):
+            totals[field] = sum(getattr(queue, field) for queue in self.queues)
+        return totals
+
+    def _run(self, index, queue):
+        """工作執行緒迴圈"""
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                self.handler(item)
+                self._processed[index] += 1
+                if self.on_done is not None:
+                    self.on_done(item)
+            except Exception as e:
+                self._errors[index] += 1
+                print(f"⚠️  [{self.name}] 處理訊息錯誤: {e}")
@@ -0,0 +1,251 @@
+"""
+MQTT 負載產生器
+以多個行程模擬大量的虛擬 Pico，依排定時間（open-loop）發布感測數據
+
+與 test_mqtt_publish.py（單一客戶端、固定間隔）不同：
+- 每個虛擬 Pico 有自己的發送排程與隨機抖動（jitter），落後排程時立即補送，不會降低速率
+- 每筆訊息帶有送出時間（sent_ts，epoch 毫秒）與遞增序號（msg_id），接收端可計算延遲與遺失
+- 可選擇 QoS 0 / 1 與 payload 編碼（json / struct / cbor）
+
+使用方式：
+    python loadgen.py --clients 1000 --rate 5000 --duration 60
+    python loadgen.py --clients 2000 --rate 20000 --processes 8 --codec struct --qos 1 --output load.json
+"""
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import paho.mqtt.client as mqtt
+from payload_codec import get_codec
+
+# 預設主題（與 app_flask.py 的 MQTT_TOPIC 相同）
+DEFAULT_TOPIC = "living_room/sensor"
+# 所有行程連線完成後才同時開始發送（秒）
+START_DELAY = 2.0
+# 每個行程預設最多的 MQTT 連線數（每條連線一個網路執行緒；虛擬 Pico 較多時共用連線）
+MAX_CONNECTIONS = 100
+
+
+def device_name(index):
+    """虛擬 Pico 的裝置名稱"""
+    return f'pico-{index:05d}'
+
+
+def topic_for(base_topic, codec_name, device):
+    """依編碼決定發布主題（struct / cbor 的裝置名稱放在主題最後一層）"""
+    if codec_name == 'struct':
+        return f'{base_topic}/bin/{device}'
+    if codec_name == 'cbor':
+        return f'{base_topic}/cbor/{device}'
+    return base_topic
+
+
+def connect_clients(host, port, count, prefix, timeout=10.0):
+    """
+    建立 count 個 MQTT 連線並等待全部連線成功
+
+    Returns:
+        list: paho 客戶端
+    """
+    clients = []
+    for i in range(count):
+        client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=f'{prefix}-{i}')
+        client.max_queued_messages_set(0)
+        client.max_inflight_messages_set(1000)
+        client.connect(host, port, 60)
+        client.loop_start()
+        clients.append(client)
+    deadline = time.monotonic() + timeout
+    while not all(client.is_connected() for client in clients):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"無法在 {timeout} 秒內連線 {host}:{port}")
+        time.sleep(0.05)
+    return clients
+
+
+def run_worker(config):
+    """
+    一個行程負責一部分虛擬 Pico
+
+    每個虛擬 Pico 的第 k 筆排定在 start + phase + k × interval × (1 ± jitter) 送出；
+    排程放在 heap 中，每次取出最早到期的一筆
+
+    Returns:
+        dict: 這個行程的統計
+    """
+    device_ids = config['device_ids']
+    rng = random.Random(config['seed'])
+    codec = get_codec(config['codec'])
+    interval = config['interval']
+    jitter = config['jitter']
+
+    connections = max(1, min(config['connections'], len(device_ids)))
+    clients = connect_clients(config['host'], config['port'], connections, f"loadgen-{os.getpid()}")
+
+    devices = [device_name(i) for i in device_ids]
+    topics = [topic_for(config['topic'], config['codec'], device) for device in devices]
+    seqs = [0] * len(devices)
+    temperatures = [rng.uniform(18, 28) for _ in devices]
+    humidities = [rng.uniform(40, 70) for _ in devices]
+    lights = [rng.random() < 0.5 for _ in devices]
+
+    start = config['start_at']
+    end = start + config['duration']
+    # 各虛擬 Pico 的第一筆平均分散在一個間隔內，避免同時送出
+    schedule = [(start + rng.uniform(0, interval), i) for i in range(len(devices))]
+    heapq.heapify(schedule)
+
+    lags = []
+    errors = 0
+    last_info = [None] * connections
+    while time.time() < start:
+        time.sleep(0.001)
+
+    while schedule:
+        due, i = schedule[0]
+        if due >= end:
+            break
+        now = time.time()
+        if due > now:
+            time.sleep(min(due - now, 0.005))
+            continue
+        heapq.heapreplace(schedule, (due + interval * (1 + rng.uniform(-jitter, jitter)), i))
+
+        # 隨機漫步的感測數據
+        seqs[i] += 1
+        temperatures[i] = min(40, max(0, temperatures[i] + rng.uniform(-0.1, 0.1)))
+        humidities[i] = min(100, max(0, humidities[i] + rng.uniform(-0.2, 0.2)))
+        if rng.random() < 0.01:
+            lights[i] = not lights[i]
+        sent_ts = time.time() * 1000
+        data = {
+            'device': devices[i],
+            'temperature': round(temperatures[i], 2),
+            'humidity': round(humidities[i], 2),
+            'light_status': '開' if lights[i] else '關',
+            'msg_id': seqs[i],
+            'sent_ts': sent_ts,
+        }
+        if config['codec'] == 'struct':
+            # struct 格式沒有 sent_ts 欄位，送出時間放在時間戳記欄位
+            data['timestamp'] = int(sent_ts)
+        conn = i % connections
+        result = clients[conn].publish(topics[i], codec.encode(data), qos=config['qos'])
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            errors += 1
+        last_info[conn] = result
+        # 實際送出時間比排定時間晚多少（秒）
+        lags.append(sent_ts / 1000 - due)
+
+    # 等待每條連線最後一筆送出（QoS 1 時等待 broker 確認）
+    for info in last_info:
+        if info is not None and info.rc == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                info.wait_for_publish(10)
+            except (RuntimeError, ValueError):
+                pass
+    # 先全部斷線再停止網路執行緒（逐一 loop_stop 會各自等待 select 逾時）
+    for client in clients:
+        client.disconnect()
+    for client in clients:
+        client.loop_stop()
+
+    return {
+        'sent': sum(seqs),
+        'errors': errors,
+        'last_seq': dict(zip(devices, seqs)),
+        'lags': lags,
+    }
+
+
+def split(items, parts):
+    """把 items 平均分成 parts 份（略過空的）"""
+    return [chunk for chunk in (items[i::parts] for i in range(parts)) if chunk]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MQTT 負載產生器（模擬大量虛擬 Pico）')
+    parser.add_argument('--broker', default='localhost:1883', help='MQTT broker（host:port）')
+    parser.add_argument('--topic', default=DEFAULT_TOPIC, help='基本主題')
+    parser.add_argument('--clients', type=int, default=100, help='虛擬 Pico 數量')
+    parser.add_argument('--rate', type=float, default=1000, help='所有虛擬 Pico 合計每秒訊息數')
+    parser.add_argument('--duration', type=float, default=10, help='發送秒數')
+    parser.add_argument('--jitter', type=float, default=0.1, help='每筆間隔的隨機抖動比例（0 ~ 1）')
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1))
+    parser.add_argument('--codec', default='json', choices=('json', 'struct', 'cbor'))
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='行程數量')
+    parser.add_argument('--connections', type=int, help=f'每個行程的 MQTT 連線數（預設每個虛擬 Pico 一條，最多 {MAX_CONNECTIONS} 條）')
+    parser.add_argument('--seed', type=int, default=0, help='隨機種子')
+    parser.add_argument('--output', help='統計結果 JSON 檔案路徑（含每個裝置最後的序號，供接收端計算遺失）')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    host, _, port = args.broker.partition(':')
+    processes = max(1, min(args.processes, args.clients))
+    # 每個虛擬 Pico 的平均發送間隔
+    interval = args.clients / args.rate
+    start_at = time.time() + START_DELAY + processes * 0.2
+
+    configs = []
+    for n, device_ids in enumerate(split(list(range(args.clients)), processes)):
+        configs.append({
+            'device_ids': device_ids,
+            'host': host,
+            'port': int(port or 1883),
+            'topic': args.topic,
+            'codec': args.codec,
+            'qos': args.qos,
+            'interval': interval,
+            'jitter': min(max(args.jitter, 0.0), 1.0),
+            'duration': args.duration,
+            'connections': args.connections or min(len(device_ids), MAX_CONNECTIONS),
+            'start_at': start_at,
+            'seed': args.seed * 1000 + n,
+        })
+
+    print(f"🚀 {args.clients} 個虛擬 Pico × {processes} 個行程，"
+          f"合計 {args.rate:g} msg/s（每個 {interval:.3f} 秒一筆），持續 {args.duration:g} 秒")
+    print(f"   broker: {host}:{port or 1883}，主題: {args.topic}，編碼: {args.codec}，QoS {args.qos}")
+
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(run_worker, configs)
+
+    sent = sum(r['sent'] for r in results)
+    errors = sum(r['errors'] for r in results)
+    lags = np.concatenate([np.asarray(r['lags']) for r in results]) if sent else np.zeros(1)
+    last_seq = {}
+    for r in results:
+        last_seq.update(r['last_seq'])
+
+    summary = {
+        'broker': args.broker,
+        'clients': args.clients,
+        'processes': processes,
+        'codec': args.codec,
+        'qos': args.qos,
+        'target_rate': args.rate,
+        'duration': args.duration,
+        'sent': sent,
+        'errors': errors,
+        'achieved_rate': round(sent / args.duration, 1),
+        'schedule_lag_p50_ms': round(float(np.percentile(lags, 50) * 1000), 3),
+        'schedule_lag_p99_ms': round(float(np.percentile(lags, 99) * 1000), 3),
+        'last_seq': last_seq,
+    }
+    print(f"✅ 已送出 {sent} 筆（{summary['achieved_rate']} msg/s），錯誤 {errors} 筆")
+    print(f"   排程延遲 p50 {summary['schedule_lag_p50_ms']} ms，p99 {summary['schedule_lag_p99_ms']} ms")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"✅ 統計結果已寫入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
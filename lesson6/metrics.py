@@ -0,0 +1,305 @@
+"""
+內建的 Prometheus 格式指標（不需要額外套件）
+提供 Counter、Gauge、Histogram，並以文字格式（text exposition format）輸出；
+也可併入其他行程寫出的指標文字（例如接收行程），加上標籤區分來源
+"""
+
+import bisect
+import os
+import threading
+
+# 預設的延遲區間（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# 標籤值超過 max_label_values 時使用的標籤值
+OVERFLOW_LABEL = '__other__'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """指標共用部分：名稱、說明、標籤與子指標"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), max_label_values=None):
+        """
+        Args:
+            max_label_values: 最多幾組標籤值（標籤值來自外部數據時設定，例如裝置名稱、主題）；
+                超過後新的標籤值一律計入 OVERFLOW_LABEL，避免時間序列數量無限增加
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_label_values = max_label_values
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        """取得指定標籤值的子指標"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                if self.max_label_values is not None and len(self._children) >= self.max_label_values:
+                    key = (OVERFLOW_LABEL,) * len(self.labelnames)
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self):
+        """回傳 [(名稱後綴, 標籤字串, 數值), ...]"""
+        if not self.labelnames:
+            return self._child_samples(self._default(), ())
+        samples = []
+        for key, child in list(self._children.items()):
+            samples.extend(self._child_samples(child, key))
+        return samples
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function):
+        """設定取值函式（輸出時才呼叫；回傳值必須只增不減，例如其他物件的累計計數）"""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Counter(_Metric):
+    """只會增加的計數"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def _child_samples(self, child, key):
+        return [('', _format_labels(self.labelnames, key), child.get())]
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """設定取值函式（輸出時才呼叫）"""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    """可增可減的數值（可設定取值函式，輸出時才計算）"""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+    def _child_samples(self, child, key):
+        return [('', _format_labels(self.labelnames, key), child.get())]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """數值分佈（固定區間計數）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, max_label_values=None):
+        super().__init__(name, documentation, labelnames, max_label_values)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _child_samples(self, child, key):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+            samples.append(('_bucket', labels, cumulative))
+        labels = _format_labels(self.labelnames, key)
+        samples.append(('_sum', labels, child.sum))
+        samples.append(('_count', labels, cumulative))
+        return samples
+
+
+def parse_families(text):
+    """
+    拆解文字格式的指標
+
+    Returns:
+        dict: 指標名稱 → (HELP / TYPE 列, 樣本列)
+    """
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            name = line.split(' ', 3)[2]
+            current = families.setdefault(name, ([], []))
+            current[0].append(line)
+        elif line and not line.startswith('#') and current is not None:
+            current[1].append(line)
+    return families
+
+
+def add_label(line, label):
+    """為一列樣本加上標籤（label 為 'name="value"' 格式）"""
+    name, sep, rest = line.partition('{')
+    if sep:
+        return f'{name}{{{label},{rest}'
+    name, _, value = line.partition(' ')
+    return f'{name}{{{label}}} {value}'
+
+
+class Registry:
+    """指標集合"""
+
+    def __init__(self):
+        self.metrics = []
+        # 外部指標來源：呼叫後回傳 [(標籤, 指標文字), ...]
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), max_label_values=None):
+        return self.register(Counter(name, documentation, labelnames, max_label_values))
+
+    def gauge(self, name, documentation, labelnames=(), max_label_values=None):
+        return self.register(Gauge(name, documentation, labelnames, max_label_values))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, max_label_values=None):
+        return self.register(Histogram(name, documentation, labelnames, buckets, max_label_values))
+
+    def add_collector(self, function):
+        """
+        加入外部指標來源（例如其他行程寫出的指標檔案）
+
+        function() 回傳 [(標籤, 指標文字), ...]，輸出時每列樣本加上該標籤（例如 'shard="00"'），
+        併入同名的指標之後（同一個指標只有一組 HELP / TYPE）
+        """
+        self.collectors.append(function)
+
+    def render(self):
+        """輸出 Prometheus 文字格式"""
+        external = {}
+        for collector in self.collectors:
+            for label, text in collector():
+                for name, (header, samples) in parse_families(text).items():
+                    family = external.setdefault(name, (header, []))
+                    family[1].extend(add_label(line, label) for line in samples)
+        parts = []
+        for metric in self.metrics:
+            text = metric.render()
+            family = external.pop(metric.name, None)
+            if family is not None and family[1]:
+                text += '\n' + '\n'.join(family[1])
+            parts.append(text)
+        parts.extend('\n'.join(header + samples) for header, samples in external.values())
+        return '\n'.join(parts) + '\n'
+
+    def write(self, path):
+        """將目前的指標寫入檔案（寫入暫存檔後再替換，讀取端不會讀到寫到一半的內容）"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def process_rss_bytes():
+    """目前行程的常駐記憶體（RSS，bytes）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # 非 Linux 系統只能取得最大 RSS（KB）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
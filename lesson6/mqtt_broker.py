@@ -0,0 +1,561 @@
+"""
+輕量的 asyncio MQTT 3.1.1 broker
+單機部署時不需要另外安裝 mosquitto；也可作為測試與 benchmark 的本機 broker
+
+支援：
+- QoS 0 / 1（收到 QoS 2 的訊息會完成 PUBREC / PUBREL / PUBCOMP 交握，轉送時降為 QoS 1）
+- 保留訊息（retained）
+- 萬用字元 + 與 #
+- 遺囑訊息（will）與 keep alive 逾時
+- 同一行程內的本機訂閱（subscribe_local），不經過 TCP
+- 共享訂閱 $share/<群組>/<過濾字串>：同一群組內每則訊息只送給其中一個訂閱者。
+  預設依發布者的 client id 固定分配（sticky），同一個裝置的訊息一定由同一個訂閱者處理；
+  也可設定為輪流分配（round_robin）。共享訂閱不會收到保留訊息
+
+不支援持續性 session：clean session = 0 的連線也視為新的 session
+
+使用方式：
+    python mqtt_broker.py --port 1883
+"""
+
+import asyncio
+import argparse
+import struct
+import hashlib
+import threading
+
+# 控制封包類型
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# CONNACK 回傳碼
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_PROTOCOL = 1
+CONNACK_BAD_CLIENT_ID = 2
+
+PROTOCOL_LEVEL = 4          # MQTT 3.1.1
+MAX_QOS = 1                 # 轉送時的最高 QoS
+# 共享訂閱的前綴與分配方式
+SHARE_PREFIX = '$share/'
+SHARE_STRATEGIES = ('sticky', 'round_robin')
+# 單一連線的寫入緩衝超過此大小時，丟棄送給該連線的 QoS 0 訊息（避免慢速客戶端拖垮 broker）
+MAX_WRITE_BUFFER = 1024 * 1024
+
+
+def topic_matches(topic_filter, topic):
+    """
+    判斷主題是否符合訂閱過濾字串（支援 + 與 #）
+
+    以 $ 開頭的主題不會被以萬用字元開頭的過濾字串比對到
+    """
+    if topic.startswith('$') and topic_filter[:1] in ('+', '#'):
+        return False
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def valid_filter(topic_filter):
+    """檢查訂閱過濾字串是否合法（# 只能在最後一層、萬用字元必須佔滿整層）"""
+    if not topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if '#' in level and (level != '#' or i != len(levels) - 1):
+            return False
+        if '+' in level and level != '+':
+            return False
+    return True
+
+
+def parse_shared(topic_filter):
+    """
+    拆解共享訂閱（$share/<群組>/<過濾字串>）
+
+    Returns:
+        tuple: (群組, 過濾字串)；不是共享訂閱時群組為 None
+    """
+    if not topic_filter.startswith(SHARE_PREFIX):
+        return None, topic_filter
+    group, _, real_filter = topic_filter[len(SHARE_PREFIX):].partition('/')
+    return group, real_filter
+
+
+def valid_subscription(topic_filter):
+    """檢查訂閱字串是否合法（含共享訂閱：群組名稱不可為空或含萬用字元）"""
+    group, real_filter = parse_shared(topic_filter)
+    if group is not None and (not group or '+' in group or '#' in group):
+        return False
+    return valid_filter(real_filter)
+
+
+def encode_length(length):
+    """編碼剩餘長度（variable length encoding）"""
+    result = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        result.append(byte)
+        if not length:
+            return bytes(result)
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type, flags, body=b''):
+    """組成控制封包"""
+    return bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, qos, retain, packet_id=None, dup=False):
+    """組成 PUBLISH 封包"""
+    flags = (dup << 3) | (qos << 1) | int(retain)
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    return packet(PUBLISH, flags, body + payload)
+
+
+class _Reader:
+    """依序讀取封包內容的欄位"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u8(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def u16(self):
+        value = struct.unpack_from('!H', self.data, self.pos)[0]
+        self.pos += 2
+        return value
+
+    def binary(self):
+        length = self.u16()
+        value = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return bytes(value)
+
+    def string(self):
+        return self.binary().decode('utf-8')
+
+    def rest(self):
+        return bytes(self.data[self.pos:])
+
+    def remaining(self):
+        return len(self.data) - self.pos
+
+
+class Session:
+    """一個 TCP 客戶端連線"""
+
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.keepalive = 0
+        self.subscriptions = {}  # 過濾字串 → QoS
+        self.will = None         # (topic, payload, qos, retain)
+        self.inflight = {}       # 封包編號 → (topic, payload)（等待 PUBACK）
+        self.next_packet_id = 1
+        self.dropped = 0
+        self.closed = False
+
+    def send(self, data):
+        if not self.closed:
+            self.writer.write(data)
+
+    def deliver(self, topic, payload, qos, retain=False):
+        """轉送一則訊息給此客戶端"""
+        if self.closed:
+            return
+        if qos == 0 and self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.dropped += 1
+            self.broker.dropped += 1
+            return
+        packet_id = None
+        if qos:
+            packet_id = self.next_packet_id
+            self.next_packet_id = packet_id % 65535 + 1
+            self.inflight[packet_id] = (topic, payload)
+        self.send(publish_packet(topic, payload, qos, retain, packet_id))
+
+    async def read_packet(self):
+        """讀取一個封包，回傳 (類型, 旗標, 內容)"""
+        header = await self.reader.readexactly(1)
+        multiplier, length = 1, 0
+        for _ in range(4):
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        else:
+            raise ValueError("剩餘長度格式錯誤")
+        body = await self.reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def run(self):
+        """處理此連線直到中斷"""
+        clean = False
+        try:
+            packet_type, _, body = await asyncio.wait_for(self.read_packet(), self.broker.connect_timeout)
+            if packet_type != CONNECT or not self.handle_connect(body):
+                return
+            while True:
+                timeout = self.keepalive * 1.5 if self.keepalive else None
+                packet_type, flags, body = await asyncio.wait_for(self.read_packet(), timeout)
+                if packet_type == DISCONNECT:
+                    clean = True
+                    return
+                self.handle(packet_type, flags, body)
+                if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                    await self.writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError,
+                IndexError, struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            self.closed = True
+            self.broker.remove_session(self)
+            if self.will and not clean:
+                self.broker.route(*self.will)
+            self.writer.close()
+
+    def handle_connect(self, body):
+        reader = _Reader(body)
+        protocol = reader.string()
+        level = reader.u8()
+        if protocol != 'MQTT' or level != PROTOCOL_LEVEL:
+            self.send(packet(CONNACK, 0, bytes([0, CONNACK_BAD_PROTOCOL])))
+            return False
+        flags = reader.u8()
+        self.keepalive = reader.u16()
+        self.client_id = reader.string()
+        if not self.client_id:
+            if not flags & 0x02:
+                # 空的 client id 必須搭配 clean session
+                self.send(packet(CONNACK, 0, bytes([0, CONNACK_BAD_CLIENT_ID])))
+                return False
+            self.client_id = f'auto-{id(self):x}'
+        if flags & 0x04:
+            will_topic = reader.string()
+            will_payload = reader.binary()
+            self.will = (will_topic, will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+        # 帳號密碼（不驗證）
+        if flags & 0x80:
+            reader.string()
+        if flags & 0x40:
+            reader.binary()
+        self.broker.add_session(self)
+        self.send(packet(CONNACK, 0, bytes([0, CONNACK_ACCEPTED])))
+        return True
+
+    def handle(self, packet_type, flags, body):
+        reader = _Reader(body)
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic = reader.string()
+            packet_id = reader.u16() if qos else None
+            payload = reader.rest()
+            if qos == 1:
+                self.send(packet(PUBACK, 0, struct.pack('!H', packet_id)))
+            elif qos == 2:
+                self.send(packet(PUBREC, 0, struct.pack('!H', packet_id)))
+            self.broker.route(topic, payload, qos, bool(flags & 0x01), self.client_id)
+        elif packet_type == PUBACK:
+            self.inflight.pop(reader.u16(), None)
+        elif packet_type == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            packet_id = reader.u16()
+            granted = []
+            new_filters = []
+            while reader.remaining():
+                topic_filter = reader.string()
+                qos = min(reader.u8() & 0x03, MAX_QOS)
+                if valid_subscription(topic_filter):
+                    self.subscriptions[topic_filter] = qos
+                    new_filters.append((topic_filter, qos))
+                    granted.append(qos)
+                else:
+                    granted.append(0x80)
+            self.broker.invalidate()
+            self.send(packet(SUBACK, 0, struct.pack('!H', packet_id) + bytes(granted)))
+            for topic_filter, qos in new_filters:
+                if not topic_filter.startswith(SHARE_PREFIX):
+                    self.broker.send_retained(self, topic_filter, qos)
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = reader.u16()
+            while reader.remaining():
+                self.subscriptions.pop(reader.string(), None)
+            self.broker.invalidate()
+            self.send(packet(UNSUBACK, 0, struct.pack('!H', packet_id)))
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP, 0))
+
+
+class Broker:
+    """
+    MQTT broker
+
+    可在自己的 asyncio 事件迴圈中執行（serve_forever），
+    或以 start() 在背景執行緒中執行，與 Flask 應用程式共用同一個行程
+    """
+
+    def __init__(self, host='0.0.0.0', port=1883, connect_timeout=10.0, share_strategy='sticky'):
+        if share_strategy not in SHARE_STRATEGIES:
+            raise ValueError(f"共享訂閱分配方式必須是 {', '.join(SHARE_STRATEGIES)}")
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.share_strategy = share_strategy
+        self._share_turn = 0
+        self._share_hashes = {}   # 發布者 client id → 雜湊值
+        self.sessions = {}        # client id → Session
+        self.local = []           # [(過濾字串, callback)]
+        self.retained = {}        # 主題 → (payload, qos)
+        # 主題 → ([(session 或 callback, qos)], [共享訂閱群組的成員 [(session, qos)]])（訂閱變動時清除）
+        self._routes = {}
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    # ---- 訂閱與轉送（在事件迴圈中執行）----
+
+    def add_session(self, session):
+        old = self.sessions.get(session.client_id)
+        if old is not None:
+            # 同一個 client id 重新連線：關閉舊連線
+            old.will = None
+            old.closed = True
+            old.writer.close()
+        self.sessions[session.client_id] = session
+        self.invalidate()
+
+    def remove_session(self, session):
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+            self.invalidate()
+
+    def invalidate(self):
+        """訂閱變動時清除主題路由快取"""
+        self._routes.clear()
+
+    def _targets(self, topic):
+        """取得訂閱此主題的對象與共享訂閱群組（同一主題之後直接使用快取）"""
+        route = self._routes.get(topic)
+        if route is None:
+            targets = []
+            groups = {}
+            for session in self.sessions.values():
+                qos = None
+                for topic_filter, sub_qos in session.subscriptions.items():
+                    group, real_filter = parse_shared(topic_filter)
+                    if not topic_matches(real_filter, topic):
+                        continue
+                    if group is None:
+                        qos = sub_qos if qos is None else max(qos, sub_qos)
+                    else:
+                        groups.setdefault((group, real_filter), []).append((session, sub_qos))
+                if qos is not None:
+                    targets.append((session, qos))
+            for topic_filter, callback in self.local:
+                if topic_matches(topic_filter, topic):
+                    targets.append((callback, None))
+            # 成員依 client id 排序，sticky 分配的結果才會固定
+            shared = [sorted(members, key=lambda member: member[0].client_id) for members in groups.values()]
+            route = self._routes[topic] = (targets, shared)
+        return route
+
+    def _pick(self, members, sender):
+        """從共享訂閱群組選出一個成員"""
+        if self.share_strategy == 'sticky' and sender is not None:
+            value = self._share_hashes.get(sender)
+            if value is None:
+                # 名稱相近的 client id（pico1、pico2 ...）也要平均分散
+                digest = hashlib.blake2b(sender.encode('utf-8'), digest_size=8).digest()
+                value = self._share_hashes[sender] = int.from_bytes(digest, 'big')
+            return members[value % len(members)]
+        self._share_turn += 1
+        return members[self._share_turn % len(members)]
+
+    def route(self, topic, payload, qos=0, retain=False, sender=None):
+        """
+        轉送訊息給所有符合的訂閱者，必要時更新保留訊息
+
+        Args:
+            sender: 發布者的 client id（共享訂閱依此分配；本機發布為 None）
+        """
+        self.received += 1
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+        targets, shared = self._targets(topic)
+        for target, sub_qos in targets:
+            if sub_qos is None:
+                try:
+                    target(topic, payload, qos, False)
+                except Exception as e:
+                    print(f"⚠️  本機訂閱處理訊息錯誤: {e}")
+            else:
+                target.deliver(topic, payload, min(qos, sub_qos, MAX_QOS))
+            self.delivered += 1
+        for members in shared:
+            session, sub_qos = self._pick(members, sender)
+            session.deliver(topic, payload, min(qos, sub_qos, MAX_QOS))
+            self.delivered += 1
+
+    def send_retained(self, session, topic_filter, qos):
+        for topic, (payload, retained_qos) in list(self.retained.items()):
+            if topic_matches(topic_filter, topic):
+                session.deliver(topic, payload, min(qos, retained_qos), retain=True)
+
+    # ---- 本機（同一行程）介面，可從任何執行緒呼叫 ----
+
+    def subscribe_local(self, topic_filter, callback):
+        """
+        在同一行程內訂閱主題（不經過 TCP）
+
+        callback(topic, payload, qos, retain) 在 broker 的事件迴圈執行緒中呼叫，
+        應盡快返回（例如只放入佇列）
+        """
+        if not valid_filter(topic_filter):
+            raise ValueError(f"訂閱主題格式錯誤: {topic_filter}")
+
+        def add():
+            self.local.append((topic_filter, callback))
+            self.invalidate()
+            for topic, (payload, qos) in list(self.retained.items()):
+                if topic_matches(topic_filter, topic):
+                    callback(topic, payload, qos, True)
+
+        self._call(add)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        """在同一行程內發布訊息"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self._call(self.route, topic, bytes(payload), qos, retain)
+
+    def _call(self, function, *args):
+        if self.loop is None:
+            function(*args)
+        elif self._thread is not None and threading.current_thread() is self._thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    # ---- 啟動與停止 ----
+
+    async def _handle_client(self, reader, writer):
+        await Session(self, reader, writer).run()
+
+    async def start_server(self):
+        """開始接受連線（port 為 0 時自動選擇可用的 port）"""
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self._server
+
+    async def serve_forever(self):
+        server = await self.start_server()
+        async with server:
+            await server.serve_forever()
+
+    def start(self, timeout=5.0):
+        """在背景執行緒中啟動 broker，開始接受連線後才返回"""
+        if self._thread is not None:
+            return self
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start_server())
+            except OSError as e:
+                print(f"❌ MQTT broker 無法啟動: {e}")
+                self._ready.set()
+                return
+            self._ready.set()
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='mqtt-broker', daemon=True)
+        self._thread.start()
+        self._ready.wait(timeout)
+        if self._server is None:
+            raise RuntimeError(f"MQTT broker 無法在 {self.host}:{self.port} 啟動")
+        return self
+
+    def stop(self):
+        """停止背景執行緒中的 broker"""
+        if self.loop is None or self._thread is None:
+            return
+
+        async def shutdown():
+            self._server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(5)
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='輕量 MQTT 3.1.1 broker')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--share-strategy', choices=SHARE_STRATEGIES, default='sticky',
+                        help='共享訂閱的分配方式（sticky：依發布者固定分配；round_robin：輪流）')
+    args = parser.parse_args()
+
+    broker = Broker(args.host, args.port, share_strategy=args.share_strategy)
+    print(f"🚀 MQTT broker 啟動於 {args.host}:{args.port}（按 Ctrl+C 停止）")
+    try:
+        asyncio.run(broker.serve_forever())
+    except KeyboardInterrupt:
+        print("\n👋 已停止")
+
+
+if __name__ == '__main__':
+    main()
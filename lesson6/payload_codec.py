@@ -0,0 +1,345 @@
+"""
+MQTT payload 編碼（codec）
+依主題選擇解碼方式，並把各種欄位名稱對應到統一的數據格式
+
+支援的編碼：
+- json: JSON（有安裝 orjson 時自動使用，較快）
+- cbor: CBOR 二進位格式（需要 cbor2）
+- struct: 固定長度的二進位格式（18 bytes，Pico 可用 struct.pack 產生）
+"""
+
+import json
+import math
+import re
+import struct
+from datetime import datetime
+from paho.mqtt.client import topic_matches_sub
+
+# 嘗試導入 orjson（較快的 JSON 解析）
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# 嘗試導入 cbor2（CBOR 編碼）
+try:
+    import cbor2
+    HAS_CBOR2 = True
+except ImportError:
+    HAS_CBOR2 = False
+
+# 統一後的數據欄位與各欄位可接受的名稱（依優先順序）
+FIELD_ALIASES = {
+    'device': ('device',),
+    'temperature': ('temperature', 'temp'),
+    'humidity': ('humidity', 'humi'),
+    'light_status': ('light_status', 'light'),
+    'msg_id': ('message_id', 'msg_id'),
+    'timestamp': ('timestamp', 'ts'),
+    'sent_ts': ('sent_ts',),
+}
+FIELD_DEFAULTS = {
+    'device': None,
+    'temperature': 0,
+    'humidity': 0,
+    'light_status': '未知',
+    'msg_id': None,
+    'timestamp': None,
+    'sent_ts': None,
+}
+
+
+def to_float(value):
+    """
+    將數值欄位轉換為 float（接受數字與數字字串）
+
+    Raises:
+        ValueError: None、布林值、無法解析的字串、NaN 或無限大
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"不是數值: {value!r}")
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"不是有限的數值: {value!r}")
+    return number
+
+
+def to_text(value):
+    """
+    將文字欄位轉換為 str（數字轉為文字，None 維持 None）
+
+    Raises:
+        ValueError: 布林值、陣列或物件
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"不是文字: {value!r}")
+    return str(value)
+
+
+# 需要轉換型別的欄位（轉換失敗時整筆訊息解碼失敗，不會把字串或 null 帶進接收流程）
+FIELD_CONVERTERS = {
+    'device': to_text,
+    'temperature': to_float,
+    'humidity': to_float,
+    'light_status': to_text,
+}
+
+# struct 格式（little-endian，共 18 bytes）：
+#   版本 u8、電燈 u8（0 未知 / 1 開 / 2 關）、訊息編號 u32（0 表示沒有）、
+#   溫度 i16（0.01°C）、濕度 u16（0.01%）、時間戳記 i64（epoch 毫秒，0 表示沒有）
+STRUCT_FORMAT = '<BBIhHq'
+STRUCT_VERSION = 1
+STRUCT_SIZE = struct.calcsize(STRUCT_FORMAT)
+STRUCT_LIGHT = ('未知', '開', '關')
+
+# 不解析 JSON、直接從原始 payload 取出裝置名稱（接收管線依裝置分配工作執行緒用）
+JSON_DEVICE_PATTERN = re.compile(
+    rb'"(?:' + b'|'.join(re.escape(name.encode('utf-8')) for name in FIELD_ALIASES['device']) + rb')"\s*:\s*"([^"]*)"')
+
+
+def compile_mapping(aliases=None, defaults=None, converters=None):
+    """
+    將欄位對應表編譯成轉換函式（dict → 統一格式 dict）
+
+    每個欄位的候選名稱事先整理成 tuple，轉換時只做最少次數的查詢
+
+    Returns:
+        function: mapping(data_dict) -> dict，欄位數值不合法時拋出 ValueError
+    """
+    aliases = aliases or FIELD_ALIASES
+    defaults = defaults or FIELD_DEFAULTS
+    converters = FIELD_CONVERTERS if converters is None else converters
+    plan = tuple((field, tuple(names), defaults.get(field), converters.get(field))
+                 for field, names in aliases.items())
+
+    def mapping(data):
+        if not isinstance(data, dict):
+            raise ValueError(f"payload 必須是物件: {type(data).__name__}")
+        result = {}
+        for field, names, default, convert in plan:
+            value = default
+            for name in names:
+                if name in data:
+                    value = data[name]
+                    break
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except ValueError as e:
+                    raise ValueError(f"欄位 {field} 不合法: {e}") from None
+            result[field] = value
+        return result
+
+    return mapping
+
+
+class JsonCodec:
+    """JSON 編碼（有 orjson 時使用 orjson）"""
+
+    name = 'json'
+
+    def __init__(self, mapping=None):
+        self.mapping = mapping or compile_mapping()
+
+    def decode(self, payload):
+        data = orjson.loads(payload) if HAS_ORJSON else json.loads(payload)
+        return self.mapping(data)
+
+    def partition_key(self, payload, topic):
+        """裝置名稱的原始 bytes（找不到時使用主題）"""
+        match = JSON_DEVICE_PATTERN.search(payload)
+        return match.group(1) if match else topic
+
+    def encode(self, data):
+        if HAS_ORJSON:
+            return orjson.dumps(data)
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+class CborCodec:
+    """CBOR 編碼（需要 cbor2）"""
+
+    name = 'cbor'
+
+    def __init__(self, mapping=None):
+        if not HAS_CBOR2:
+            raise RuntimeError("CBOR 編碼需要安裝 cbor2")
+        self.mapping = mapping or compile_mapping()
+
+    def decode(self, payload):
+        return self.mapping(cbor2.loads(payload))
+
+    def partition_key(self, payload, topic):
+        """CBOR 需要解碼才能取得裝置名稱，依主題分配"""
+        return topic
+
+    def encode(self, data):
+        return cbor2.dumps(data)
+
+
+class StructCodec:
+    """
+    固定長度二進位編碼
+
+    payload 不含裝置名稱，裝置名稱取自主題的最後一層（例如 客廳/感測器/bin/pico1）
+    """
+
+    name = 'struct'
+
+    def decode(self, payload, topic=''):
+        if len(payload) != STRUCT_SIZE:
+            raise ValueError(f"struct payload 長度錯誤: {len(payload)}")
+        version, light, msg_id, temperature, humidity, timestamp = struct.unpack(STRUCT_FORMAT, payload)
+        if version != STRUCT_VERSION:
+            raise ValueError(f"不支援的 struct 版本: {version}")
+        return {
+            'device': topic.rsplit('/', 1)[-1] or None,
+            'temperature': temperature / 100,
+            'humidity': humidity / 100,
+            'light_status': STRUCT_LIGHT[light] if light < len(STRUCT_LIGHT) else '未知',
+            'msg_id': msg_id or None,
+            'timestamp': timestamp or None,
+            'sent_ts': None,
+        }
+
+    def partition_key(self, payload, topic):
+        """裝置名稱就是主題的最後一層"""
+        return topic
+
+    def encode(self, data):
+        light = {'開': 1, 'on': 1, '關': 2, 'off': 2}.get(data.get('light_status'), 0)
+        return struct.pack(
+            STRUCT_FORMAT,
+            STRUCT_VERSION,
+            light,
+            int(data.get('msg_id') or 0) & 0xFFFFFFFF,
+            int(round(float(data.get('temperature') or 0) * 100)),
+            int(round(float(data.get('humidity') or 0) * 100)),
+            int(data.get('timestamp') or 0)
+        )
+
+
+CODECS = {
+    'json': JsonCodec,
+    'cbor': CborCodec,
+    'struct': StructCodec,
+}
+
+
+def get_codec(name):
+    """依名稱建立 codec"""
+    if name not in CODECS:
+        raise ValueError(f"未知的 payload 編碼: {name}")
+    return CODECS[name]()
+
+
+class CodecRegistry:
+    """
+    主題 → codec 的對應表（支援 MQTT 萬用字元 + 與 #）
+
+    每個主題第一次出現時比對一次，之後直接從快取取得
+    """
+
+    def __init__(self, topic_codecs):
+        """
+        Args:
+            topic_codecs: {主題過濾字串: codec 名稱}，依順序比對
+        """
+        self.rules = []
+        for topic_filter, name in topic_codecs.items():
+            try:
+                self.rules.append((topic_filter, get_codec(name)))
+            except RuntimeError as e:
+                print(f"⚠️  主題 {topic_filter} 的編碼 {name} 無法使用: {e}")
+        self._cache = {}
+
+    def topics(self):
+        """回傳需要訂閱的主題過濾字串"""
+        return [topic_filter for topic_filter, _ in self.rules]
+
+    def codec_for(self, topic):
+        """取得主題對應的 codec（沒有符合的規則時使用 JSON）"""
+        codec = self._cache.get(topic)
+        if codec is None:
+            codec = next((c for f, c in self.rules if topic_matches_sub(f, topic)), None)
+            if codec is None:
+                codec = get_codec('json')
+            self._cache[topic] = codec
+        return codec
+
+    def decode(self, topic, payload):
+        """
+        解碼 payload
+
+        Returns:
+            dict: 統一格式的數據（device、temperature、humidity、light_status、msg_id、timestamp、sent_ts）
+        """
+        codec = self.codec_for(topic)
+        if isinstance(codec, StructCodec):
+            return codec.decode(payload, topic)
+        return codec.decode(payload)
+
+    def partition_key(self, topic, payload):
+        """
+        接收管線分配工作執行緒用的 key（不完整解碼）
+
+        同一個裝置的訊息一定得到相同的 key，依接收順序處理；
+        同一個主題上的多個裝置可分散到不同的工作執行緒
+
+        Returns:
+            str 或 bytes: JSON 為 payload 中的裝置名稱，其餘（或找不到裝置名稱時）為主題
+        """
+        return self.codec_for(topic).partition_key(payload, topic)
+
+
+# 數值小於此值的時間戳記視為秒（epoch 毫秒要到 1973 年之後才會超過）
+EPOCH_MS_THRESHOLD = 100_000_000_000
+
+
+def parse_timestamp_ms(value):
+    """
+    將裝置送來的時間戳記轉換為 epoch 毫秒
+
+    接受 epoch 秒 / 毫秒（數字或數字字串）與 ISO 8601 字串（沒有時區時視為本地時間）
+
+    Returns:
+        int: epoch 毫秒，無法解析時回傳 None
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = value
+    elif isinstance(value, str):
+        text = value.strip()
+        try:
+            number = float(text)
+        except ValueError:
+            if text.endswith('Z'):
+                text = text[:-1] + '+00:00'
+            try:
+                return int(datetime.fromisoformat(text).timestamp() * 1000)
+            except ValueError:
+                return None
+    else:
+        return None
+    if number != number or number <= 0:
+        return None
+    return int(number if number >= EPOCH_MS_THRESHOLD else number * 1000)
+
+
+def parse_topic_codecs(text):
+    """
+    解析主題編碼設定字串，格式：主題=編碼;主題=編碼
+
+    Returns:
+        dict: {主題過濾字串: codec 名稱}
+    """
+    result = {}
+    for part in text.split(';'):
+        if '=' in part:
+            topic_filter, name = part.rsplit('=', 1)
+            result[topic_filter.strip()] = name.strip()
+    return result
@@ -11,6 +11,7 @@ import time
 import machine
 import json
 import random
+import struct
 import wifi_connect
 from secrets import MQTT_BROKER, MQTT_PORT
 
@@ -30,6 +31,12 @@ except ImportError:
 TOPIC = "客廳/感測器"
 CLIENT_ID = "pico_temp_sensor"
 
+# 傳送格式: "json" 或 "struct"
+# struct 為 18 bytes 固定格式（與 app_flask.py 的 struct codec 相同），
+# 發送到 TOPIC + "/bin/" + CLIENT_ID，裝置名稱取自主題最後一層
+PAYLOAD_FORMAT = "json"
+STRUCT_FORMAT = "<BBIhHq"  # 版本, 電燈, 訊息編號, 溫度(0.01°C), 濕度(0.01%), 時間戳記(毫秒, 0=無)
+
 # 初始化內建溫度感測器 (ADC 4)
 sensor_temp = machine.ADC(4)
 conversion_factor = 3.3 / (65535)
@@ -60,7 +67,8 @@ def main():
     print("🚀 開始讀取溫度並回報...")
 
     # 3. 主迴圈
-    count = 0
+    # 訊息序號從 1 開始（struct 格式的 0 代表沒有序號）
+    count = 1
     try:
         while True:
             # 讀取溫度
@@ -70,20 +78,25 @@ def main():
             # 產生 50% ~ 70% 之間的隨機值
             humi = round(random.uniform(50, 70), 1)
 
-            # 準備傳送的資料
-            payload = {
-                "temperature": temp,
-                "humidity": humi,
-                "device": "Pico W (App 2)",
-                "msg_id": count
-            }
-
-            # 發送 MQTT 訊息
-            json_str = json.dumps(payload)
             print(f"發送: 溫度={temp}°C, 濕度={humi}%")
-            client.publish(TOPIC, json_str)
+            if PAYLOAD_FORMAT == "struct":
+                # 二進位格式（電燈狀態 0 = 未知）
+                payload = struct.pack(STRUCT_FORMAT, 1, 0, count, round(temp * 100), round(humi * 100), 0)
+                client.publish(TOPIC + "/bin/" + CLIENT_ID, payload)
+            else:
+                # 準備傳送的資料
+                payload = {
+                    "temperature": temp,
+                    "humidity": humi,
+                    "device": "Pico W (App 2)",
+                    "msg_id": count
+                }
+
+                # 發送 MQTT 訊息
+                json_str = json.dumps(payload)
+                client.publish(TOPIC, json_str)
 
-            count += 1
+            count = count % 0xFFFFFFFF + 1
             time.sleep(5)  # 每 5 秒更新一次
 
     except KeyboardInterrupt:
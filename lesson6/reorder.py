@@ -0,0 +1,98 @@
+"""
+每個裝置的重新排序緩衝區（依裝置時間戳記輸出）
+
+Pico 批次或延遲上傳、多個接收執行緒交錯處理時，同一個裝置的數據不一定依時間到達；
+環狀緩衝區與數據儲存都以二分搜尋依時間查詢，寫入時必須依時間排序。
+每筆數據先放入該裝置的 heap，在緩衝區停留 window_ms（以接收時間計算）後依時間戳記順序輸出；
+比已輸出的數據還舊的數據無法再插入正確位置，計為過晚（late）並丟棄。
+"""
+
+import heapq
+import itertools
+
+# 預設停留時間（毫秒）與每個裝置最多暫存的筆數
+REORDER_WINDOW_MS = 2000
+REORDER_MAX_ROWS = 1000
+
+
+class ReorderBuffer:
+    """
+    依裝置時間戳記重新排序
+
+    push() / release() 不是執行緒安全的，呼叫端需持有鎖（app_flask 在 ingest_lock 內呼叫）
+    """
+
+    def __init__(self, window_ms=REORDER_WINDOW_MS, max_rows=REORDER_MAX_ROWS):
+        self.window_ms = window_ms
+        self.max_rows = max_rows
+        # 裝置 → heap[(時間戳記, 到達順序, 接收時間, 數據)]
+        self._heaps = {}
+        # 裝置 → 最後輸出的時間戳記
+        self._emitted = {}
+        # 裝置 → 目前收到的最大時間戳記
+        self._newest = {}
+        self._order = itertools.count()
+        self.held = 0
+        self.reordered = 0
+        self.late = 0
+
+    def push(self, device, timestamp_ms, received_ms, row):
+        """
+        放入一筆數據，並回傳該裝置已到期的數據
+
+        Returns:
+            list: 依時間排序的數據；比已輸出的數據還舊時回傳 None（過晚）
+        """
+        last = self._emitted.get(device)
+        if last is not None and timestamp_ms < last:
+            self.late += 1
+            return None
+        heap = self._heaps.get(device)
+        if heap is None:
+            heap = self._heaps[device] = []
+        newest = self._newest.get(device)
+        if newest is not None and timestamp_ms < newest:
+            self.reordered += 1
+        else:
+            self._newest[device] = timestamp_ms
+        heapq.heappush(heap, (timestamp_ms, next(self._order), received_ms, row))
+        self.held += 1
+        return self._release_device(device, heap, received_ms)
+
+    def seed(self, device, timestamp_ms):
+        """
+        設定裝置已寫入的最新時間（啟動時以已載入的歷史數據呼叫）
+
+        重新啟動後比已儲存數據還舊的數據無法再依序寫入，和執行中一樣計為過晚
+        """
+        last = self._emitted.get(device)
+        if last is None or timestamp_ms > last:
+            self._emitted[device] = timestamp_ms
+            self._newest[device] = max(timestamp_ms, self._newest.get(device, timestamp_ms))
+
+    def release(self, now_ms):
+        """
+        輸出所有裝置已到期的數據（背景定期呼叫，處理停止傳送的裝置）
+
+        Returns:
+            list: 依各裝置時間排序的數據
+        """
+        released = []
+        for device, heap in self._heaps.items():
+            if heap:
+                released.extend(self._release_device(device, heap, now_ms))
+        return released
+
+    def drain(self):
+        """輸出所有暫存的數據（結束時呼叫）"""
+        return self.release(float('inf'))
+
+    def _release_device(self, device, heap, now_ms):
+        released = []
+        deadline = now_ms - self.window_ms
+        while heap and (heap[0][2] <= deadline or len(heap) > self.max_rows):
+            timestamp_ms, _, _, row = heapq.heappop(heap)
+            released.append(row)
+            self._emitted[device] = timestamp_ms
+        self.held -= len(released)
+        return released
@@ -0,0 +1,99 @@
+"""
+預先序列化的 API 回應
+數據只有在收到新訊息時才會改變，同一個版本的回應只序列化（及 gzip）一次，
+之後的請求直接送出同一份 bytes；用戶端帶 If-None-Match 時可直接回應 304
+
+版本（接收序號）在重新啟動後（沒有檢查點時）會從頭開始，不同的 API 行程也各自計算，
+ETag 因此加上每次啟動隨機產生的識別碼，其他啟動或行程的 ETag 不會被誤判為相同
+"""
+
+import gzip
+import secrets
+import threading
+from collections import OrderedDict
+
+# 小於此大小的回應不壓縮（壓縮的負擔大於節省的傳輸量）
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+class CachedResponse:
+    """一個版本的回應內容（原始與 gzip 壓縮的 bytes）"""
+
+    __slots__ = ('version', 'etag', 'body', 'gzipped', 'served')
+
+    def __init__(self, version, body, gzip_min_size=GZIP_MIN_SIZE, epoch=''):
+        self.version = version
+        # 這個版本被請求的次數（預先產生時只更新有人在輪詢的查詢）
+        self.served = 0
+        parts = version if isinstance(version, tuple) else (version,)
+        self.etag = '-'.join(str(part) for part in (epoch,) + parts if part != '')
+        self.body = body
+        self.gzipped = gzip.compress(body, GZIP_LEVEL) if len(body) >= gzip_min_size else None
+
+
+class ResponseCache:
+    """
+    依查詢鍵值保存最新版本的回應（LRU，超過上限時移除最久未使用的）
+
+    版本由呼叫端決定（例如接收序號），版本改變時才重新序列化
+    """
+
+    def __init__(self, encode, max_entries=64, gzip_min_size=GZIP_MIN_SIZE, epoch=None):
+        """
+        Args:
+            encode: 序列化函式 encode(payload) -> bytes
+            max_entries: 最多保存的查詢數
+            gzip_min_size: 大於此大小的回應預先 gzip 壓縮
+            epoch: ETag 前綴（省略時每次啟動隨機產生）
+        """
+        self.encode = encode
+        self.epoch = secrets.token_hex(4) if epoch is None else epoch
+        self.max_entries = max_entries
+        self.gzip_min_size = gzip_min_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """
+        取得指定版本的回應，沒有時呼叫 build() 產生內容並序列化
+
+        Returns:
+            CachedResponse
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+                entry.served += 1
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = self.put(key, version, build)
+        entry.served += 1
+        return entry
+
+    def put(self, key, version, build):
+        """產生並保存指定版本的回應（接收端可在數據改變後預先呼叫）"""
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.version == version:
+                return current
+        # 序列化不持有鎖（同時有多個請求時可能重複產生，結果相同）
+        entry = CachedResponse(version, self.encode(build()), self.gzip_min_size, self.epoch)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.version == version:
+                return current
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def polled(self):
+        """回傳目前版本有被請求過的查詢鍵值（表示有用戶端在輪詢）"""
+        with self._lock:
+            return [key for key, entry in self._entries.items() if entry.served]
@@ -0,0 +1,358 @@
+"""
+以 NumPy 固定長度陣列實作的環狀緩衝區
+每個裝置一個緩衝區，取代原本 list + pop(0) 的歷史數據儲存方式
+
+讀取端不加鎖：寫入前後各遞增一次版本號（seqlock），讀取端複製數據後確認版本號沒有改變，
+改變時重新讀取；裝置對應表以複製後替換（copy-on-write）的方式新增裝置，讀取端迭代時不會改變
+"""
+
+import time
+import numpy as np
+
+# 讀取時版本號改變（寫入端剛好在寫入）的重試次數上限，超過後讓出執行緒再重試
+SEQLOCK_SPIN = 100
+
+
+def seqlock_read(owner, function, *args):
+    """
+    不加鎖讀取：讀取前後 owner.version 相同且為偶數（沒有寫入中）時，結果是一致的
+
+    讀到寫入中途的狀態而拋出例外時，版本號已改變就重新讀取；function 必須複製數據
+    """
+    attempts = 0
+    while True:
+        version = owner.version
+        if not version & 1:
+            try:
+                result = function(*args)
+            except Exception:
+                if owner.version == version:
+                    raise
+            else:
+                if owner.version == version:
+                    return result
+        attempts += 1
+        if attempts % SEQLOCK_SPIN == 0:
+            time.sleep(0)
+
+
+# 電燈狀態與數值代碼的對應（以 uint8 儲存）
+LIGHT_LABELS = ['未知', '開', '關']
+LIGHT_CODES = {
+    '未知': 0,
+    '開': 1,
+    'on': 1,
+    'ON': 1,
+    '關': 2,
+    'off': 2,
+    'OFF': 2,
+}
+
+
+def encode_light(light_status):
+    """將電燈狀態文字轉換為代碼（無法辨識時為 0 = 未知）"""
+    return LIGHT_CODES.get(light_status, 0)
+
+
+def decode_light(codes):
+    """將電燈狀態代碼陣列轉換為文字列表"""
+    labels = np.asarray(LIGHT_LABELS)
+    return labels[np.asarray(codes, dtype=np.intp)].tolist()
+
+
+def format_timestamps(timestamps_ms):
+    """
+    將 epoch 毫秒陣列轉換為本地時間字串（YYYY-MM-DD HH:MM:SS）
+
+    只在 API 輸出時才做字串格式化，並以向量化方式一次處理整個陣列
+    """
+    offset_ms = time.localtime().tm_gmtoff * 1000
+    local = (np.asarray(timestamps_ms, dtype=np.int64) + offset_ms).astype('datetime64[ms]')
+    strings = np.datetime_as_string(local.astype('datetime64[s]'))
+    return np.char.replace(strings, 'T', ' ').tolist()
+
+
+def format_timestamp(timestamp_ms):
+    """將單一 epoch 毫秒轉換為本地時間字串（None 與已格式化的字串原樣回傳）"""
+    if timestamp_ms is None or isinstance(timestamp_ms, str):
+        return timestamp_ms
+    return format_timestamps([timestamp_ms])[0]
+
+
+class RingBuffer:
+    """
+    單一裝置的環狀緩衝區
+
+    以固定長度的陣列儲存時間戳記（epoch 毫秒）、溫度、濕度、電燈狀態代碼
+    與接收序號，寫入為 O(1)，超過容量時自動覆蓋最舊的數據。
+    """
+
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity: 最多保留的數據筆數
+        """
+        if capacity <= 0:
+            raise ValueError("capacity 必須大於 0")
+        self.capacity = capacity
+        self.timestamp = np.zeros(capacity, dtype=np.int64)
+        self.temperature = np.zeros(capacity, dtype=np.float32)
+        self.humidity = np.zeros(capacity, dtype=np.float32)
+        self.light = np.zeros(capacity, dtype=np.uint8)
+        # 全域遞增的接收序號（供增量查詢使用）
+        self.seq = np.zeros(capacity, dtype=np.int64)
+        # 累計寫入筆數（用來計算寫入位置與目前長度）
+        self.written = 0
+        # seqlock 版本號：寫入中為奇數
+        self.version = 0
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def append(self, timestamp_ms, temperature, humidity, light_code, seq=0):
+        """寫入一筆數據（O(1)，同一個緩衝區只能有一個寫入端）"""
+        self.version += 1
+        i = self.written % self.capacity
+        self.timestamp[i] = timestamp_ms
+        self.temperature[i] = temperature
+        self.humidity[i] = humidity
+        self.light[i] = light_code
+        self.seq[i] = seq
+        self.written += 1
+        self.version += 1
+
+    def extend(self, timestamp, temperature, humidity, light, seq):
+        """一次寫入多筆數據（向量化，用於啟動時載入歷史數據）"""
+        self.version += 1
+        try:
+            self._extend(timestamp, temperature, humidity, light, seq)
+        finally:
+            self.version += 1
+
+    def _extend(self, timestamp, temperature, humidity, light, seq):
+        n = len(timestamp)
+        if n > self.capacity:
+            # 只需保留最後 capacity 筆
+            skip = n - self.capacity
+            timestamp, temperature, humidity, light, seq = (
+                timestamp[skip:], temperature[skip:], humidity[skip:], light[skip:], seq[skip:])
+            self.written += skip
+            n = self.capacity
+        index = (self.written + np.arange(n)) % self.capacity
+        self.timestamp[index] = timestamp
+        self.temperature[index] = temperature
+        self.humidity[index] = humidity
+        self.light[index] = light
+        self.seq[index] = seq
+        self.written += n
+
+    def _read(self, function, *args):
+        """
+        不加鎖讀取：讀取前後的版本號相同且為偶數時，結果是一致的
+
+        function 必須複製數據（回傳的陣列不能是緩衝區的切片，否則之後仍會被覆寫）
+        """
+        return seqlock_read(self, function, *args)
+
+    def _take(self, array, lo, hi):
+        """複製依時間順序（舊 → 新）第 lo ~ hi 筆（不含 hi）"""
+        start = (self.written - len(self) + lo) % self.capacity
+        end = start + (hi - lo)
+        if end <= self.capacity:
+            return array[start:end].copy()
+        return np.concatenate((array[start:], array[:end - self.capacity]))
+
+    def _count_until(self, seq):
+        """接收序號小於等於 seq 的筆數（序號在緩衝區內遞增，分別在兩段實體陣列上二分搜尋）"""
+        size = len(self)
+        start = (self.written - size) % self.capacity
+        first = self.seq[start:min(start + size, self.capacity)]
+        count = int(np.searchsorted(first, seq, 'right'))
+        if count == len(first):
+            count += int(np.searchsorted(self.seq[:size - len(first)], seq, 'right'))
+        return count
+
+    def _columns(self, lo, hi):
+        return {
+            'timestamp': self._take(self.timestamp, lo, hi),
+            'temperature': self._take(self.temperature, lo, hi),
+            'humidity': self._take(self.humidity, lo, hi),
+            'light': self._take(self.light, lo, hi),
+            'seq': self._take(self.seq, lo, hi),
+        }
+
+    def _recent(self, n, until_seq):
+        hi = len(self) if until_seq is None else self._count_until(until_seq)
+        lo = 0 if n is None else max(0, hi - n)
+        return self._columns(lo, hi)
+
+    def _since(self, seq, until_seq):
+        hi = len(self) if until_seq is None else self._count_until(until_seq)
+        lo = min(self._count_until(seq), hi)
+        return self._columns(lo, hi)
+
+    def recent(self, n=None, until_seq=None):
+        """
+        取得最近 n 筆數據（複製，之後的寫入不會影響回傳的陣列）
+
+        Args:
+            n: 要取得的筆數，None 表示全部
+            until_seq: 只取接收序號小於等於此值的數據（對應某個快照的版本）
+
+        Returns:
+            dict: 欄位名稱對應 NumPy 陣列（依時間由舊到新）
+        """
+        return self._read(self._recent, n, until_seq)
+
+    def since(self, seq, until_seq=None):
+        """
+        取得接收序號大於 seq 的數據（依時間由舊到新）
+
+        序號在緩衝區內遞增，以二分搜尋找到起點，只取出新增的部分
+        """
+        return self._read(self._since, seq, until_seq)
+
+    def last(self):
+        """取得最新一筆數據的索引，沒有數據時回傳 None"""
+        if self.written == 0:
+            return None
+        return (self.written - 1) % self.capacity
+
+
+class RingStore:
+    """以裝置名稱區分的環狀緩衝區集合"""
+
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity: 每個裝置保留的數據筆數
+        """
+        self.capacity = capacity
+        # 裝置 → 緩衝區；新增裝置時複製後整個替換，讀取端迭代時不需加鎖
+        self.buffers = {}
+        # 所有裝置合計的筆數（append 時增量維護，extend 後以 recount() 重新計算）
+        self.size = 0
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def devices(self):
+        """回傳目前所有裝置名稱"""
+        return list(self.buffers)
+
+    def buffer(self, device):
+        """取得（必要時建立）指定裝置的緩衝區"""
+        buffer = self.buffers.get(device)
+        if buffer is None:
+            buffer = RingBuffer(self.capacity)
+            self.buffers = {**self.buffers, device: buffer}
+        return buffer
+
+    def append(self, device, timestamp_ms, temperature, humidity, light_code, seq=0):
+        """寫入一筆數據到指定裝置的緩衝區"""
+        buffer = self.buffer(device)
+        if buffer.written < buffer.capacity:
+            self.size += 1
+        buffer.append(timestamp_ms, temperature, humidity, light_code, seq)
+
+    def recount(self):
+        """重新計算合計筆數（直接對緩衝區 extend 之後呼叫）"""
+        self.size = len(self)
+        return self.size
+
+    def since(self, seq, device=None, until_seq=None):
+        """
+        取得接收序號大於 seq 的數據（增量查詢）
+
+        Args:
+            until_seq: 只取接收序號小於等於此值的數據（對應某個快照的版本）
+
+        Returns:
+            dict: 欄位名稱對應 NumPy 陣列（依接收序號排序），另含 'device' 欄位
+        """
+        buffers = self.buffers
+        names = [device] if device is not None else list(buffers)
+        parts = []
+        for name in names:
+            buffer = buffers.get(name)
+            if buffer is None:
+                continue
+            columns = buffer.since(seq, until_seq)
+            columns['device'] = np.full(len(columns['timestamp']), name, dtype=object)
+            parts.append(columns)
+        if not parts:
+            return empty_columns()
+        if len(parts) == 1:
+            return parts[0]
+        merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+        order = np.argsort(merged['seq'], kind='stable')
+        return {key: values[order] for key, values in merged.items()}
+
+    def last_seq(self):
+        """回傳目前最大的接收序號（沒有數據時為 0）"""
+        return max((int(b.seq[b.last()]) for b in self.buffers.values() if b.last() is not None), default=0)
+
+    def recent(self, n=None, device=None, until_seq=None):
+        """
+        取得最近 n 筆數據
+
+        Args:
+            n: 要取得的筆數，None 表示全部
+            device: 裝置名稱，None 表示合併所有裝置（依時間排序）
+            until_seq: 只取接收序號小於等於此值的數據（對應某個快照的版本）
+
+        Returns:
+            dict: 欄位名稱對應 NumPy 陣列，另含 'device' 欄位
+        """
+        buffers = self.buffers
+        if device is not None:
+            buffer = buffers.get(device)
+            if buffer is None:
+                return empty_columns()
+            columns = buffer.recent(n, until_seq)
+            columns['device'] = np.full(len(columns['timestamp']), device, dtype=object)
+            return columns
+
+        parts = []
+        for name, buffer in buffers.items():
+            columns = buffer.recent(n, until_seq)
+            columns['device'] = np.full(len(columns['timestamp']), name, dtype=object)
+            parts.append(columns)
+        if not parts:
+            return empty_columns()
+        if len(parts) == 1:
+            return parts[0]
+
+        merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+        order = np.argsort(merged['timestamp'], kind='stable')
+        if n is not None:
+            order = order[-n:] if n > 0 else order[:0]
+        return {key: values[order] for key, values in merged.items()}
+
+
+def empty_columns():
+    """回傳沒有任何數據的欄位集合"""
+    return {
+        'timestamp': np.zeros(0, dtype=np.int64),
+        'temperature': np.zeros(0, dtype=np.float32),
+        'humidity': np.zeros(0, dtype=np.float32),
+        'light': np.zeros(0, dtype=np.uint8),
+        'seq': np.zeros(0, dtype=np.int64),
+        'device': np.zeros(0, dtype=object),
+    }
+
+
+def columns_to_json(columns):
+    """
+    將欄位集合轉換為可 JSON 序列化的欄位格式（不為每一筆建立 dict）
+
+    Returns:
+        dict: {'timestamp': [...], 'temperature': [...], ...}
+    """
+    return {
+        'timestamp': format_timestamps(columns['timestamp']),
+        'temperature': np.round(columns['temperature'].astype(np.float64), 2).tolist(),
+        'humidity': np.round(columns['humidity'].astype(np.float64), 2).tolist(),
+        'light_status': decode_light(columns['light']),
+        'device': columns['device'].tolist(),
+    }
@@ -0,0 +1,566 @@
+"""
+二進位欄位式時間序列儲存（segment store）
+取代 sensor_data.csv 作為正式的數據儲存
+
+目錄結構：
+    data/<裝置>/<YYYYMMDD>-<序號>/
+        timestamp.i64    int64 epoch 毫秒
+        temperature.f32  float32 溫度
+        humidity.f32     float32 濕度
+        light.u8         uint8 電燈狀態代碼
+
+    data/<裝置>/manifest.json  已關閉區段的筆數、最小 / 最大時間與壓縮格式
+
+每個欄位為固定寬度的二進位檔案，只做附加寫入；
+區段（segment）依日期（UTC）或筆數上限切換，讀取時使用 numpy.memmap，
+範圍查詢只是陣列切片，不需要逐列解析文字。
+
+已過了當天（UTC）的區段不會再寫入，由 compact() 在背景壓縮（gzip 或 zstd）
+並記錄到 manifest；範圍查詢依 manifest 的時間範圍只開啟重疊的區段。
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+import numpy as np
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+from ring_buffer import empty_columns
+
+# 欄位名稱、檔名與資料型別
+COLUMNS = (
+    ('timestamp', 'timestamp.i64', np.int64),
+    ('temperature', 'temperature.f32', np.float32),
+    ('humidity', 'humidity.f32', np.float32),
+    ('light', 'light.u8', np.uint8),
+)
+
+DAY_MS = 86400 * 1000
+
+MANIFEST_FILE = 'manifest.json'
+# 壓縮格式 → 副檔名
+CODEC_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# 解壓縮後的區段最多保留幾個在記憶體（連續的範圍查詢常落在同一個區段）
+DECOMPRESSED_CACHE_SIZE = 4
+
+
+def day_key(timestamp_ms):
+    """取得 epoch 毫秒所屬的日期字串（UTC，YYYYMMDD）"""
+    day = np.datetime64(int(timestamp_ms) // DAY_MS, 'D')
+    return str(day).replace('-', '')
+
+
+def day_start_ms(key):
+    """日期字串（YYYYMMDD）對應的起始 epoch 毫秒"""
+    day = np.datetime64(f"{key[:4]}-{key[4:6]}-{key[6:8]}", 'D')
+    return int(day.astype(np.int64)) * DAY_MS
+
+
+def compress_bytes(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress_bytes(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class Segment:
+    """單一區段（一個目錄，內含每個欄位一個檔案）"""
+
+    def __init__(self, path, info=None):
+        """
+        Args:
+            path: 區段目錄
+            info: manifest 中的資訊（rows、min_ts、max_ts、codec），尚未關閉的區段為 None
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.day = self.name.split('-')[0]
+        self.info = info
+
+    @property
+    def codec(self):
+        """壓縮格式（未壓縮時為 None；以磁碟上的檔案為準）"""
+        if os.path.exists(os.path.join(self.path, COLUMNS[0][1])):
+            return None
+        for codec, extension in CODEC_EXTENSIONS.items():
+            if os.path.exists(os.path.join(self.path, COLUMNS[0][1] + extension)):
+                return codec
+        return None
+
+    def bounds(self):
+        """區段涵蓋的時間範圍 [start, end)（有 manifest 時為實際的最小 / 最大時間）"""
+        if self.info is not None:
+            return self.info['min_ts'], self.info['max_ts'] + 1
+        start = day_start_ms(self.day)
+        return start, start + DAY_MS
+
+    def rows(self):
+        """目前完整寫入的筆數（以最短的欄位為準，忽略寫到一半的列）"""
+        if self.info is not None:
+            return self.info['rows']
+        codec = self.codec
+        if codec is not None:
+            columns = self.columns()
+            return 0 if columns is None else len(columns['timestamp'])
+        counts = []
+        for _, filename, dtype in COLUMNS:
+            file_path = os.path.join(self.path, filename)
+            size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            counts.append(size // np.dtype(dtype).itemsize)
+        return min(counts)
+
+    def columns(self):
+        """以 memmap 開啟所有欄位（唯讀，不複製）；已壓縮的區段解壓縮到記憶體"""
+        codec = self.codec
+        if codec is not None:
+            columns = {}
+            for name, filename, dtype in COLUMNS:
+                with open(os.path.join(self.path, filename + CODEC_EXTENSIONS[codec]), 'rb') as f:
+                    columns[name] = np.frombuffer(decompress_bytes(f.read(), codec), dtype=dtype)
+            return columns if len(columns['timestamp']) else None
+        rows = self.rows()
+        if rows == 0:
+            return None
+        return {
+            name: np.memmap(os.path.join(self.path, filename), dtype=dtype, mode='r', shape=(rows,))
+            for name, filename, dtype in COLUMNS
+        }
+
+
+class SegmentStore:
+    """
+    每個裝置一組區段的欄位式儲存
+
+    寫入端可作為 batch_writer.BatchedWriter 的寫入目標（sink），
+    每筆數據為 (device, timestamp_ms, temperature, humidity, light_code)。
+    """
+
+    def __init__(self, root, max_segment_rows=1_000_000):
+        """
+        Args:
+            root: 儲存根目錄
+            max_segment_rows: 每個區段最多筆數，超過時切換新區段
+        """
+        self.root = root
+        self.max_segment_rows = max_segment_rows
+        # 目前寫入中的區段：device -> (Segment, 已寫入筆數, {欄位: 檔案})
+        self._active = {}
+        # 寫入端與背景壓縮共用的鎖（避免壓縮寫入中的區段）
+        self._lock = threading.Lock()
+        self._compacting = set()
+        # 解壓縮後的區段：路徑 → 欄位
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    # ---------- 路徑 ----------
+
+    def _device_dir(self, device):
+        return os.path.join(self.root, quote(device, safe=''))
+
+    def devices(self):
+        """回傳所有有數據的裝置名稱"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def segments(self, device):
+        """依時間順序回傳指定裝置的所有區段"""
+        device_dir = self._device_dir(device)
+        if not os.path.isdir(device_dir):
+            return []
+        manifest = self.load_manifest(device)
+        return [Segment(os.path.join(device_dir, name), manifest.get(name))
+                for name in sorted(os.listdir(device_dir))
+                if os.path.isdir(os.path.join(device_dir, name))]
+
+    # ---------- manifest ----------
+
+    def load_manifest(self, device):
+        """讀取裝置的 manifest（區段名稱 → rows、min_ts、max_ts、codec）"""
+        try:
+            with open(os.path.join(self._device_dir(device), MANIFEST_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, device, manifest):
+        path = os.path.join(self._device_dir(device), MANIFEST_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    # ---------- 寫入（sink 介面）----------
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    def _open_segment(self, device, day):
+        """開啟（必要時建立）指定裝置當日可寫入的區段"""
+        active = self._active.get(device)
+        if active is not None:
+            segment, rows, _ = active
+            if segment.day == day and rows < self.max_segment_rows:
+                return active
+            self._close_segment(device)
+
+        existing = [s for s in self.segments(device) if s.day == day]
+        # 已關閉（記錄在 manifest）或壓縮中的區段不再附加，遲到的數據寫入新的區段
+        if (existing and existing[-1].info is None and existing[-1].path not in self._compacting
+                and existing[-1].rows() < self.max_segment_rows):
+            segment = existing[-1]
+        else:
+            segment = Segment(os.path.join(self._device_dir(device), f"{day}-{len(existing):03d}"))
+            os.makedirs(segment.path, exist_ok=True)
+
+        rows = segment.rows()
+        files = {}
+        for name, filename, dtype in COLUMNS:
+            file_path = os.path.join(segment.path, filename)
+            f = open(file_path, 'ab')
+            # 上次異常結束時可能留下寫到一半的列，截斷到完整筆數
+            f.truncate(rows * np.dtype(dtype).itemsize)
+            files[name] = f
+        active = self._active[device] = (segment, rows, files)
+        return active
+
+    def _close_segment(self, device):
+        _, _, files = self._active.pop(device)
+        for f in files.values():
+            try:
+                f.close()
+            except OSError:
+                # 關閉時寫出緩衝失敗（例如磁碟已滿）：留下的殘列由下次開啟時截斷
+                pass
+
+    def _append(self, device, arrays, start, end):
+        """
+        把 arrays 的 [start, end) 附加到裝置目前的區段
+
+        每個欄位各自一個檔案，逐一寫入；若寫到一半失敗（例如磁碟已滿），
+        先寫入的欄位會多出幾列，因此關閉並移除這個區段，
+        下次 _open_segment 會把所有欄位截斷到最短欄位的筆數，欄位保持對齊。
+        """
+        segment, written, files = self._active[device]
+        try:
+            for name, _, _ in COLUMNS:
+                files[name].write(arrays[name][start:end].tobytes())
+                # 立即寫出緩衝，讓磁碟已滿等錯誤在這裡出現，而不是延後到 flush() 才發現
+                files[name].flush()
+        except BaseException:
+            self._close_segment(device)
+            raise
+        self._active[device] = (segment, written + end - start, files)
+
+    def write_batch(self, batch):
+        """寫入一批數據，依裝置與日期分組後一次寫入每個欄位"""
+        with self._lock:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        by_device = {}
+        for device, timestamp_ms, temperature, humidity, light in batch:
+            by_device.setdefault(device, []).append((timestamp_ms, temperature, humidity, light))
+
+        # 先把整批轉成欄位陣列（型別錯誤在這裡就會拋出），全部成功後才開始寫檔，
+        # 避免前面的欄位已寫入、後面的欄位轉換失敗而造成欄位錯位
+        columns = {
+            device: {name: np.fromiter((row[i] for row in rows), dtype=dtype, count=len(rows))
+                     for i, (name, _, dtype) in enumerate(COLUMNS)}
+            for device, rows in by_device.items()
+        }
+
+        for device, arrays in columns.items():
+            days = [day_key(ts) for ts in arrays['timestamp']]
+            start = 0
+            while start < len(days):
+                day = days[start]
+                _, written, _ = self._open_segment(device, day)
+                # 同一區段可寫入的連續筆數（同一天且不超過上限）
+                end = start
+                limit = start + (self.max_segment_rows - written)
+                while end < len(days) and end < limit and days[end] == day:
+                    end += 1
+                self._append(device, arrays, start, end)
+                start = end
+
+    def write_columns(self, device, columns):
+        """
+        以欄位陣列寫入一個裝置的數據（大量匯入用，不需逐筆處理）
+
+        Args:
+            device: 裝置名稱
+            columns: dict，timestamp / temperature / humidity / light 陣列，需依時間排序
+        """
+        with self._lock:
+            self._write_columns(device, columns)
+
+    def _write_columns(self, device, columns):
+        # 先轉換所有欄位（同 _write_batch），長度不一致時不寫入任何欄位
+        arrays = {name: np.ascontiguousarray(columns[name], dtype=dtype) for name, _, dtype in COLUMNS}
+        timestamps = arrays['timestamp']
+        if any(len(array) != len(timestamps) for array in arrays.values()):
+            raise ValueError("欄位長度不一致")
+        start = 0
+        while start < len(timestamps):
+            day = day_key(timestamps[start])
+            _, written, _ = self._open_segment(device, day)
+            # 同一區段可寫入的連續筆數（同一天且不超過上限）
+            day_end = int(np.searchsorted(timestamps, day_start_ms(day) + DAY_MS, 'left'))
+            end = min(day_end, start + self.max_segment_rows - written)
+            self._append(device, arrays, start, end)
+            start = end
+
+    def flush(self, fsync=False):
+        with self._lock:
+            for _, _, files in self._active.values():
+                for f in files.values():
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            for device in list(self._active):
+                self._close_segment(device)
+
+    # ---------- 背景壓縮 ----------
+
+    def compact(self, codec='gzip', now_ms=None):
+        """
+        壓縮已關閉的區段並記錄到 manifest
+
+        當天（UTC）以前、目前沒有在寫入的區段視為已關閉；
+        codec 為 None 時只記錄 manifest（範圍查詢仍可依時間範圍略過區段）
+
+        Returns:
+            int: 處理的區段數
+        """
+        if codec is not None and codec not in CODEC_EXTENSIONS:
+            raise ValueError(f"不支援的壓縮格式: {codec}")
+        if codec == 'zstd' and not HAS_ZSTD:
+            raise RuntimeError("zstd 壓縮需要安裝 zstandard 套件")
+        today = day_key(now_ms if now_ms is not None else int(time.time() * 1000))
+        with self._lock:
+            # 停止傳送的裝置可能一直開著前幾天的區段，先關閉
+            for device, (segment, _, _) in list(self._active.items()):
+                if segment.day < today:
+                    self._close_segment(device)
+        done = 0
+        for device in self.devices():
+            for segment in self.segments(device):
+                if segment.info is not None or segment.day >= today:
+                    continue
+                with self._lock:
+                    active = self._active.get(device)
+                    if active is not None and active[0].path == segment.path:
+                        continue
+                    self._compacting.add(segment.path)
+                try:
+                    if self._compact_segment(device, segment, codec):
+                        done += 1
+                finally:
+                    with self._lock:
+                        self._compacting.discard(segment.path)
+        return done
+
+    def _compact_segment(self, device, segment, codec):
+        columns = segment.columns()
+        if columns is None:
+            return False
+        if codec is not None and segment.codec is None:
+            # 先寫入壓縮檔，記錄 manifest 後才刪除原始檔（中途中斷時原始檔仍在）
+            for name, filename, _ in COLUMNS:
+                path = os.path.join(segment.path, filename + CODEC_EXTENSIONS[codec])
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(compress_bytes(np.ascontiguousarray(columns[name]).tobytes(), codec))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + '.tmp', path)
+        timestamps = columns['timestamp']
+        info = {
+            'rows': len(timestamps),
+            'min_ts': int(timestamps.min()),
+            'max_ts': int(timestamps.max()),
+            'codec': codec or segment.codec,
+        }
+        with self._lock:
+            manifest = self.load_manifest(device)
+            manifest[segment.name] = info
+            self._save_manifest(device, manifest)
+        if codec is not None:
+            for _, filename, _ in COLUMNS:
+                path = os.path.join(segment.path, filename)
+                if os.path.exists(path):
+                    os.remove(path)
+        return True
+
+    def _columns(self, segment):
+        """開啟區段的欄位（解壓縮的結果保留在快取中）"""
+        if segment.info is None or segment.info.get('codec') is None:
+            return segment.columns()
+        with self._cache_lock:
+            columns = self._cache.get(segment.path)
+            if columns is not None:
+                self._cache.move_to_end(segment.path)
+                return columns
+        columns = segment.columns()
+        with self._cache_lock:
+            self._cache[segment.path] = columns
+            while len(self._cache) > DECOMPRESSED_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return columns
+
+    # ---------- 讀取 ----------
+
+    def read(self, device, start_ms=None, end_ms=None):
+        """
+        讀取指定裝置在 [start_ms, end_ms) 範圍內的數據
+
+        只有一個區段符合時回傳 memmap 切片（不複製）；跨區段時才合併。
+
+        Returns:
+            dict: 欄位名稱對應陣列，另含 'device' 欄位
+        """
+        parts = []
+        for segment in self.segments(device):
+            # 依區段的時間範圍（manifest 或日期）先行排除不在範圍內的區段
+            first, last = segment.bounds()
+            if end_ms is not None and first >= end_ms:
+                continue
+            if start_ms is not None and last <= start_ms:
+                continue
+            columns = self._columns(segment)
+            if columns is None:
+                continue
+            timestamps = columns['timestamp']
+            lo = 0 if start_ms is None else int(np.searchsorted(timestamps, start_ms, 'left'))
+            hi = len(timestamps) if end_ms is None else int(np.searchsorted(timestamps, end_ms, 'left'))
+            if hi > lo:
+                parts.append({name: values[lo:hi] for name, values in columns.items()})
+        return _with_device(_concat(parts), device)
+
+    def tail(self, device, n):
+        """讀取指定裝置最近 n 筆數據（從最新的區段往前找）"""
+        parts = []
+        remaining = n
+        for segment in reversed(self.segments(device)):
+            if remaining <= 0:
+                break
+            columns = self._columns(segment)
+            if columns is None:
+                continue
+            take = min(remaining, len(columns['timestamp']))
+            parts.append({name: values[-take:] for name, values in columns.items()})
+            remaining -= take
+        parts.reverse()
+        return _with_device(_concat(parts), device)
+
+    def first_timestamp(self, device=None):
+        """回傳最早一筆數據的時間（epoch 毫秒，沒有數據時回傳 None）"""
+        devices = self.devices() if device is None else [device]
+        firsts = []
+        for name in devices:
+            for segment in self.segments(name):
+                if segment.info is not None:
+                    firsts.append(segment.info['min_ts'])
+                    break
+                columns = segment.columns()
+                if columns is not None and len(columns['timestamp']):
+                    firsts.append(int(columns['timestamp'][0]))
+                    break
+        return min(firsts) if firsts else None
+
+    def count(self, device=None):
+        """回傳數據總筆數（可指定裝置）"""
+        devices = self.devices() if device is None else [device]
+        return sum(segment.rows() for name in devices for segment in self.segments(name))
+
+    def read_all(self, start_ms=None, end_ms=None, devices=None):
+        """讀取多個裝置的數據並依時間排序合併"""
+        parts = [self.read(device, start_ms, end_ms) for device in (devices or self.devices())]
+        return merge_columns(parts)
+
+
+def _concat(parts):
+    if not parts:
+        columns = empty_columns()
+        del columns['device'], columns['seq']
+        return columns
+    if len(parts) == 1:
+        return parts[0]
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def _with_device(columns, device):
+    columns['device'] = np.full(len(columns['timestamp']), device, dtype=object)
+    return columns
+
+
+def merge_columns(parts):
+    """合併多個裝置的欄位集合，依時間排序"""
+    parts = [part for part in parts if len(part['timestamp'])]
+    if not parts:
+        return empty_columns()
+    if len(parts) == 1:
+        return parts[0]
+    # 只合併所有來源都有的欄位（例如只有記憶體數據才有接收序號）
+    names = [name for name in parts[0] if all(name in part for part in parts)]
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in names}
+    order = np.argsort(merged['timestamp'], kind='stable')
+    return {name: values[order] for name, values in merged.items()}
+
+
+def import_csv(csv_path, store, device='default'):
+    """
+    將舊的 sensor_data.csv 匯入儲存（一次性轉換用）
+
+    CSV 有「裝置」欄位時依該欄位分開儲存，否則全部存為 device
+
+    Returns:
+        int: 匯入筆數
+    """
+    import csv
+    from datetime import datetime
+    from ring_buffer import encode_light
+
+    batch = []
+    with open(csv_path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            timestamp_ms = int(datetime.strptime(row['時間戳記'], '%Y-%m-%d %H:%M:%S').timestamp() * 1000)
+            batch.append((row.get('裝置') or device, timestamp_ms, float(row['溫度']), float(row['濕度']),
+                          encode_light(row['電燈狀態'])))
+    batch.sort(key=lambda row: row[1])
+    store.open()
+    store.write_batch(batch)
+    store.flush(fsync=True)
+    store.close()
+    return len(batch)
+
+
+if __name__ == '__main__':
+    # 用法: python segment_store.py sensor_data.csv [data 目錄] [裝置名稱]
+    if len(sys.argv) < 2:
+        print("用法: python segment_store.py <CSV 檔案> [儲存目錄] [裝置名稱]")
+        sys.exit(1)
+    csv_path = sys.argv[1]
+    root = sys.argv[2] if len(sys.argv) > 2 else 'data'
+    device = sys.argv[3] if len(sys.argv) > 3 else 'default'
+    count = import_csv(csv_path, SegmentStore(root), device)
+    print(f"✅ 已匯入 {count} 筆數據到 {root}/")
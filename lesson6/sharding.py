@@ -0,0 +1,111 @@
+"""
+多個接收行程的儲存分片（每個接收行程一個 SegmentStore 目錄）
+
+- ShardedStore：合併讀取多個分片，介面和 SegmentStore 的讀取部分相同（唯讀）
+- ShardTail：追蹤各分片新寫入的數據，API 行程用來更新記憶體中的緩衝區、彙總與推送
+
+分片由其他行程寫入：正在寫入的區段以最短的欄位決定筆數（寫到一半的列不會被讀到）；
+背景壓縮可能在列出區段後刪除原始檔，讀取時遇到檔案不存在就重讀一次
+"""
+
+import os
+import numpy as np
+from segment_store import SegmentStore, merge_columns
+
+# 讀取時檔案被壓縮移除的重試次數
+READ_RETRIES = 3
+
+
+def shard_dirs(root, count):
+    """各分片的目錄（root/00、root/01 ...）"""
+    return [os.path.join(root, f"{index:02d}") for index in range(count)]
+
+
+def _retry(function, *args):
+    for attempt in range(READ_RETRIES):
+        try:
+            return function(*args)
+        except FileNotFoundError:
+            if attempt == READ_RETRIES - 1:
+                raise
+
+
+class ShardedStore:
+    """多個分片的合併讀取介面（同一個裝置的數據可能分散在多個分片，讀取後依時間合併）"""
+
+    def __init__(self, stores):
+        """
+        Args:
+            stores: SegmentStore 列表（也可以是目錄路徑）
+        """
+        self.stores = [SegmentStore(store) if isinstance(store, str) else store for store in stores]
+
+    def devices(self):
+        return sorted(set().union(*(store.devices() for store in self.stores)))
+
+    def read(self, device, start_ms=None, end_ms=None):
+        """讀取指定裝置在 [start_ms, end_ms) 範圍內的數據（只有一個分片有數據時不複製）"""
+        return merge_columns([_retry(store.read, device, start_ms, end_ms) for store in self.stores])
+
+    def tail(self, device, n):
+        """讀取指定裝置最近 n 筆數據"""
+        columns = merge_columns([_retry(store.tail, device, n) for store in self.stores])
+        return {name: values[-n:] for name, values in columns.items()}
+
+    def first_timestamp(self, device=None):
+        firsts = [store.first_timestamp(device) for store in self.stores]
+        firsts = [first for first in firsts if first is not None]
+        return min(firsts) if firsts else None
+
+    def count(self, device=None):
+        return sum(store.count(device) for store in self.stores)
+
+    def read_all(self, start_ms=None, end_ms=None, devices=None):
+        parts = [self.read(device, start_ms, end_ms) for device in (devices or self.devices())]
+        return merge_columns(parts)
+
+
+class ShardTail:
+    """
+    追蹤各分片新寫入的數據
+
+    每個分片、每個裝置記錄已讀到的位置（時間戳記與該時間已讀的筆數）；
+    分片內同一裝置的數據依時間附加，因此只需從上次的時間開始讀取
+    """
+
+    def __init__(self, stores):
+        self.stores = list(stores)
+        # (分片編號, 裝置) → (時間戳記, 該時間已讀筆數)
+        self._cursors = {}
+        # 裝置 → 開始追蹤的時間（啟動時記憶體中已有的數據不再讀取）
+        self._start = {}
+
+    def start_after(self, device, timestamp_ms):
+        """從指定時間之後開始追蹤裝置"""
+        self._start[device] = int(timestamp_ms) + 1
+
+    def poll(self):
+        """
+        讀取上次之後新寫入的數據
+
+        Returns:
+            dict: 裝置 → 欄位 dict（各分片合併後依時間排序）
+        """
+        parts = {}
+        for index, store in enumerate(self.stores):
+            for device in store.devices():
+                key = (index, device)
+                start, skip = self._cursors.get(key, (self._start.get(device), 0))
+                columns = _retry(store.read, device, start)
+                timestamps = columns['timestamp']
+                if len(timestamps) <= skip:
+                    continue
+                columns = {name: values[skip:] for name, values in columns.items()}
+                timestamps = columns['timestamp']
+                last = int(timestamps[-1])
+                same = len(timestamps) - int(np.searchsorted(timestamps, last, 'left'))
+                if last == start:
+                    same += skip
+                self._cursors[key] = (last, same)
+                parts.setdefault(device, []).append(columns)
+        return {device: merge_columns(device_parts) for device, device_parts in parts.items()}
@@ -0,0 +1,108 @@
+"""
+啟動時快速載入歷史數據
+- 記憶體狀態檢查點（checkpoint）：重新啟動時直接載入，不需重新讀取儲存
+- CSV 尾端讀取：從檔案尾端往前分塊讀取，只解析最後 N 筆
+"""
+
+import csv
+import io
+import json
+import os
+import numpy as np
+
+# 每次往前讀取的區塊大小
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+def read_csv_tail(path, n, block_size=TAIL_BLOCK_SIZE):
+    """
+    讀取 CSV 檔案最後 n 筆數據（不讀取整個檔案）
+
+    從檔案尾端往前以區塊讀取，直到找到足夠的換行或到達檔案開頭，
+    讀取時間與記憶體只和 n 有關，與檔案大小無關。
+
+    Args:
+        path: CSV 檔案路徑（第一列為標題列）
+        n: 要讀取的筆數
+        block_size: 每次往前讀取的位元組數
+
+    Returns:
+        list: 每筆為 dict（欄位名稱 → 值），依檔案順序排列
+    """
+    with open(path, 'rb') as f:
+        header_line = f.readline()
+        header_end = f.tell()
+        fieldnames = next(csv.reader([header_line.decode('utf-8-sig')]), None)
+        if not fieldnames or n <= 0:
+            return []
+
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        # 需要 n 個完整的列，因此找到 n + 1 個換行即可（最後一列可能沒有換行）
+        while position > header_end and data.count(b'\n') <= n:
+            read_size = min(block_size, position - header_end)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+
+    lines = data.split(b'\n')
+    if position > header_end:
+        # 第一段可能是被截斷的列，捨棄
+        lines = lines[1:]
+    lines = [line for line in lines if line.strip()][-n:]
+    text = io.StringIO(b'\n'.join(lines).decode('utf-8'))
+    return list(csv.DictReader(text, fieldnames=fieldnames))
+
+
+def save_checkpoint(path, ring_store, latest, until_seq=None):
+    """
+    將環狀緩衝區與最新數據存成檢查點（寫入暫存檔後再替換，避免寫到一半）
+
+    環狀緩衝區以 seqlock 複製讀取，不需持有接收端的鎖；
+    寫檔（SD 卡上可能很慢）期間接收端可以繼續寫入。
+
+    Args:
+        path: 檢查點檔案路徑（.npz）
+        ring_store: ring_buffer.RingStore
+        latest: 最新數據 dict
+        until_seq: 只存接收序號小於等於此值的數據（與 latest 屬於同一個快照）
+    """
+    arrays = {}
+    devices = ring_store.devices()
+    for i, device in enumerate(devices):
+        for name, values in ring_store.buffer(device).recent(until_seq=until_seq).items():
+            arrays[f"{i}_{name}"] = np.ascontiguousarray(values)
+    meta = {'devices': devices, 'latest': latest}
+    arrays['meta'] = np.frombuffer(json.dumps(meta, ensure_ascii=False).encode('utf-8'), dtype=np.uint8)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, ring_store):
+    """
+    從檢查點還原環狀緩衝區
+
+    Args:
+        path: 檢查點檔案路徑
+        ring_store: 要還原到的 ring_buffer.RingStore
+
+    Returns:
+        dict: 檢查點中的最新數據；檢查點不存在時回傳 None
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as checkpoint:
+        meta = json.loads(checkpoint['meta'].tobytes().decode('utf-8'))
+        for i, device in enumerate(meta['devices']):
+            ring_store.buffer(device).extend(
+                checkpoint[f"{i}_timestamp"],
+                checkpoint[f"{i}_temperature"],
+                checkpoint[f"{i}_humidity"],
+                checkpoint[f"{i}_light"],
+                checkpoint[f"{i}_seq"]
+            )
+    return meta['latest']
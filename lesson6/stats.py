@@ -0,0 +1,342 @@
+"""
+每個裝置的串流統計（每筆數據 O(1) 更新，不需掃描歷史數據）
+- RunningStats：Welford 演算法計算平均與變異數，另記錄最小 / 最大值
+- Ewma：指數加權移動平均（近期趨勢）
+- P2Quantile：P² 演算法估計分位數（只保存 5 個標記，不保存樣本）
+- WindowedQuantiles：以固定筆數的視窗輪替 P² 估計器，反映近期的分位數
+
+讀取端不加鎖：每個裝置的統計更新前後各遞增一次版本號（seqlock，與 ring_buffer 相同），
+裝置對應表以複製後替換的方式新增裝置
+"""
+
+import math
+import numpy as np
+from ring_buffer import seqlock_read
+
+STATS_FIELDS = ('temperature', 'humidity')
+# EWMA 平滑係數（越大越貼近最新數值）
+EWMA_ALPHA = 0.1
+# 分位數視窗筆數（每個裝置最近約這麼多筆）
+QUANTILE_WINDOW = 1000
+QUANTILES = (0.5, 0.95)
+
+
+class RunningStats:
+    """Welford 線上平均與變異數"""
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    def update_many(self, values):
+        """一次加入一批數值（Chan 等人的平行合併公式，向量化計算）"""
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    @property
+    def variance(self):
+        """樣本變異數"""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class Ewma:
+    """指數加權移動平均"""
+
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, x):
+        self.value = x if self.value is None else self.value + self.alpha * (x - self.value)
+
+    def update_many(self, values):
+        """一次加入一批數值（以權重向量計算，等同逐筆更新）"""
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+        if self.value is None:
+            self.value = float(values[0])
+            values = values[1:]
+            n -= 1
+        # 第 i 筆的權重為 alpha × (1 - alpha)^(n-1-i)，原本的值為 (1 - alpha)^n
+        decay = (1 - self.alpha) ** np.arange(n - 1, -1, -1, dtype=np.float64)
+        self.value = float(self.value * (1 - self.alpha) ** n + self.alpha * (decay * values).sum())
+
+
+class P2Quantile:
+    """
+    P² 分位數估計（Jain & Chlamtac, 1985）
+
+    以 5 個標記的高度與位置近似累積分佈，每筆數據只調整標記，記憶體固定
+    """
+
+    __slots__ = ('p', 'q', 'n', 'desired', 'increments', 'initial')
+
+    def __init__(self, p):
+        self.p = p
+        self.q = []
+        self.n = [0, 1, 2, 3, 4]
+        self.desired = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self.increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+        # 前 5 筆直接保存
+        self.initial = []
+
+    @property
+    def count(self):
+        return len(self.initial) if self.initial is not None else self.n[4] + 1
+
+    def update(self, x):
+        if self.initial is not None:
+            self.initial.append(x)
+            if len(self.initial) == 5:
+                self.q = sorted(self.initial)
+                self.initial = None
+            return
+
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self.desired
+        for i in range(5):
+            desired[i] += self.increments[i]
+
+        # 調整中間三個標記的位置與高度
+        for i in (1, 2, 3):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # 拋物線（P²）內插，超出相鄰標記時改用線性內插
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def update_many(self, values):
+        """以一批樣本初始化（樣本夠多時直接取排序後的分位點作為標記，不逐筆更新）"""
+        values = np.asarray(values, dtype=np.float64)
+        if self.count or len(values) < 10:
+            for x in values.tolist():
+                self.update(x)
+            return
+        ordered = np.sort(values)
+        last = len(ordered) - 1
+        p = self.p
+        self.desired = [0.0, last * p / 2, last * p, last * (1 + p) / 2, float(last)]
+        positions = [int(round(value)) for value in self.desired]
+        # 標記位置必須嚴格遞增
+        for i in range(1, 4):
+            positions[i] = min(max(positions[i], positions[i - 1] + 1), last - (4 - i))
+        self.n = positions
+        self.q = [float(ordered[i]) for i in positions]
+        self.initial = None
+
+    def value(self):
+        """目前的估計值（沒有數據時為 None）"""
+        if self.initial is not None:
+            if not self.initial:
+                return None
+            return float(np.percentile(self.initial, self.p * 100))
+        return self.q[2]
+
+
+class WindowedQuantiles:
+    """
+    近期分位數：每 window 筆換一組新的 P² 估計器
+
+    目前的估計器筆數不到半個視窗時，回報上一個視窗的結果（避免剛換視窗時不穩定）
+    """
+
+    __slots__ = ('quantiles', 'window', 'current', 'previous', 'seen')
+
+    def __init__(self, quantiles=QUANTILES, window=QUANTILE_WINDOW):
+        self.quantiles = quantiles
+        self.window = window
+        self.current = [P2Quantile(p) for p in quantiles]
+        self.previous = None
+        self.seen = 0
+
+    def update(self, x):
+        if self.seen >= self.window:
+            self.previous = self.current
+            self.current = [P2Quantile(p) for p in self.quantiles]
+            self.seen = 0
+        self.seen += 1
+        for estimator in self.current:
+            estimator.update(x)
+
+    def update_many(self, values):
+        """以最近一個視窗的數據初始化"""
+        values = np.asarray(values, dtype=np.float64)[-self.window:]
+        for estimator in self.current:
+            estimator.update_many(values)
+        self.seen += len(values)
+
+    def values(self):
+        source = self.current
+        if self.previous is not None and self.seen < self.window // 2:
+            source = self.previous
+        return [estimator.value() for estimator in source]
+
+
+class FieldStats:
+    """單一欄位的所有統計"""
+
+    __slots__ = ('running', 'ewma', 'quantiles')
+
+    def __init__(self, alpha=EWMA_ALPHA, window=QUANTILE_WINDOW):
+        self.running = RunningStats()
+        self.ewma = Ewma(alpha)
+        self.quantiles = WindowedQuantiles(window=window)
+
+    def update(self, x):
+        self.running.update(x)
+        self.ewma.update(x)
+        self.quantiles.update(x)
+
+    def update_many(self, values):
+        self.running.update_many(values)
+        self.ewma.update_many(values)
+        self.quantiles.update_many(values)
+
+    def to_json(self):
+        running = self.running
+        if not running.count:
+            return None
+        result = {
+            'count': running.count,
+            'mean': round(running.mean, 3),
+            'std': round(running.std, 3),
+            'min': round(running.min, 2),
+            'max': round(running.max, 2),
+            'ewma': round(self.ewma.value, 3),
+        }
+        for p, value in zip(self.quantiles.quantiles, self.quantiles.values()):
+            result[f'p{round(p * 100)}'] = None if value is None else round(value, 2)
+        return result
+
+
+class DeviceStats:
+    """單一裝置所有欄位的統計（version 為 seqlock 版本號，更新中為奇數）"""
+
+    __slots__ = ('fields', 'updated', 'version')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.updated = None
+        self.version = 0
+
+    def to_json(self, format_timestamp=None):
+        entry = {field: field_stats.to_json() for field, field_stats in self.fields.items()}
+        updated = self.updated
+        entry['updated'] = format_timestamp(updated) if format_timestamp and updated is not None else updated
+        return entry
+
+
+class StatsEngine:
+    """
+    每個裝置的串流統計
+
+    update() 在接收路徑中逐筆呼叫（只能有一個寫入端，呼叫端負責加鎖）；to_json() 不需要加鎖。
+    啟動時可用 seed() 以記憶體中的歷史數據初始化（向量化計算）
+    """
+
+    def __init__(self, fields=STATS_FIELDS, alpha=EWMA_ALPHA, window=QUANTILE_WINDOW):
+        self.fields = fields
+        self.alpha = alpha
+        self.window = window
+        self.devices = {}
+
+    def _device(self, device):
+        stats = self.devices.get(device)
+        if stats is None:
+            stats = DeviceStats({field: FieldStats(self.alpha, self.window) for field in self.fields})
+            # 複製後替換，讀取端迭代中的對應表不會改變
+            self.devices = {**self.devices, device: stats}
+        return stats
+
+    def update(self, device, timestamp_ms, values):
+        """
+        Args:
+            values: 各欄位的數值（順序同 fields）
+        """
+        stats = self._device(device)
+        stats.version += 1
+        try:
+            for field_stats, value in zip(stats.fields.values(), values):
+                field_stats.update(value)
+            stats.updated = timestamp_ms
+        finally:
+            stats.version += 1
+
+    def seed(self, device, columns):
+        """以一個裝置的欄位陣列初始化（依時間排序）"""
+        if not len(columns['timestamp']):
+            return
+        stats = self._device(device)
+        stats.version += 1
+        try:
+            for field in self.fields:
+                stats.fields[field].update_many(columns[field])
+            stats.updated = int(columns['timestamp'][-1])
+        finally:
+            stats.version += 1
+
+    def to_json(self, device=None, format_timestamp=None):
+        """
+        Returns:
+            dict: 裝置名稱 → {欄位: {count, mean, std, min, max, ewma, p50, p95}, 'updated': 時間}
+        """
+        devices = self.devices
+        names = [device] if device is not None else sorted(devices)
+        result = {}
+        for name in names:
+            stats = devices.get(name)
+            if stats is not None:
+                result[name] = seqlock_read(stats, stats.to_json, format_timestamp)
+        return result
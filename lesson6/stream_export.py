@@ -0,0 +1,88 @@
+"""
+串流匯出（CSV / NDJSON）
+數據依時間窗口分段讀取，每段格式化後立即送出，不會把整個結果放在記憶體中；
+可選擇即時 gzip 壓縮
+"""
+
+import csv
+import io
+import json
+import zlib
+import numpy as np
+from ring_buffer import LIGHT_LABELS, format_timestamps
+
+EXPORT_HEADERS = ['時間戳記', '裝置', '電燈狀態', '溫度', '濕度']
+# 每次讀取的時間窗口（記憶體用量只和一個窗口內的筆數有關）
+EXPORT_WINDOW_MS = 6 * 3600 * 1000
+# gzip 壓縮等級（1 最快，9 最小）
+GZIP_LEVEL = 6
+
+CSV_MIMETYPE = 'text/csv; charset=utf-8'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def iter_windows(read_range, start_ms, end_ms, device=None, window_ms=EXPORT_WINDOW_MS):
+    """
+    依時間窗口分段讀取數據
+
+    Args:
+        read_range: 讀取函式 read_range(start_ms, end_ms, device) -> 欄位 dict
+    Yields:
+        dict: 欄位名稱 → 陣列（依時間排序）
+    """
+    for window_start in range(start_ms, end_ms, window_ms):
+        columns = read_range(window_start, min(window_start + window_ms, end_ms), device)
+        if len(columns['timestamp']):
+            yield columns
+
+
+def format_rows(columns):
+    """
+    將一段欄位數據轉換為列（向量化格式化時間與電燈狀態）
+
+    Returns:
+        zip: (時間戳記, 裝置, 電燈狀態, 溫度, 濕度)
+    """
+    labels = np.array(LIGHT_LABELS, dtype=object)
+    return zip(
+        format_timestamps(columns['timestamp']),
+        columns['device'].tolist(),
+        labels[columns['light']].tolist(),
+        np.round(columns['temperature'].astype(np.float64), 2).tolist(),
+        np.round(columns['humidity'].astype(np.float64), 2).tolist(),
+    )
+
+
+def iter_csv(chunks):
+    """CSV 串流（每段一個 bytes 區塊，第一段為標題列）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_HEADERS)
+    yield buffer.getvalue().encode('utf-8')
+    for columns in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(format_rows(columns))
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(chunks):
+    """NDJSON 串流（每列一個 JSON 物件，欄位名稱與 /api/history 相同）"""
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    for columns in chunks:
+        lines = [
+            dumps({'timestamp': timestamp, 'device': device, 'light_status': light,
+                   'temperature': temperature, 'humidity': humidity})
+            for timestamp, device, light, temperature, humidity in format_rows(columns)
+        ]
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def gzip_stream(blocks, level=GZIP_LEVEL):
+    """即時 gzip 壓縮串流（不等全部內容產生完畢）"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -1,6 +1,7 @@
 """
 MQTT 測試發布腳本
 用於測試 Streamlit 應用程式的 MQTT 接收功能
+（需要模擬大量裝置或高頻率發送時請使用 loadgen.py）
 """
 
 import paho.mqtt.client as mqtt
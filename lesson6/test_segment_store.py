@@ -0,0 +1,87 @@
+"""
+segment_store 測試：寫入失敗後各欄位仍保持對齊
+執行方式：在 lesson6 目錄下執行 python -m pytest test_segment_store.py
+"""
+
+import numpy as np
+import pytest
+
+from segment_store import SegmentStore
+
+DEVICE = 'pico_1'
+BASE_MS = 1_700_000_000_000
+
+
+def row(offset_ms, temperature, humidity=50.0, light=1):
+    return (DEVICE, BASE_MS + offset_ms, temperature, humidity, light)
+
+
+def read_all(store):
+    store.flush()
+    return store.read(DEVICE, BASE_MS, BASE_MS + 86400 * 1000)
+
+
+def test_bad_row_does_not_misalign_columns(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    store.open()
+    store.write_batch([row(1000, 20.0)])
+
+    # 第二欄（溫度）無法轉換：整批都不應寫入，時間欄也不能多出一列
+    with pytest.raises(ValueError):
+        store.write_batch([row(2000, 'x')])
+
+    store.write_batch([row(3000, 22.0)])
+    columns = read_all(store)
+    store.close()
+
+    assert columns['timestamp'].tolist() == [BASE_MS + 1000, BASE_MS + 3000]
+    assert columns['temperature'].tolist() == [20.0, 22.0]
+
+
+class FailingFile:
+    """包裝檔案物件，寫入時拋出 OSError（模擬磁碟已滿）"""
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, data):
+        raise OSError(28, 'No space left on device')
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def test_partial_write_failure_truncates_to_aligned_rows(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    store.open()
+    store.write_batch([row(1000, 20.0)])
+
+    # 時間欄寫入成功、濕度欄寫入失敗
+    _, _, files = store._active[DEVICE]
+    files['humidity'] = FailingFile(files['humidity'])
+    with pytest.raises(OSError):
+        store.write_batch([row(2000, 21.0)])
+    assert DEVICE not in store._active
+
+    # 重新開啟區段時截斷多出的列，之後的數據與原本的列對齊
+    store.write_batch([row(3000, 22.0, humidity=60.0)])
+    columns = read_all(store)
+    store.close()
+
+    assert columns['timestamp'].tolist() == [BASE_MS + 1000, BASE_MS + 3000]
+    assert columns['temperature'].tolist() == [20.0, 22.0]
+    assert columns['humidity'].tolist() == [50.0, 60.0]
+
+
+def test_write_columns_rejects_mismatched_lengths(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    store.open()
+    with pytest.raises(ValueError):
+        store.write_columns(DEVICE, {
+            'timestamp': np.array([BASE_MS + 1000, BASE_MS + 2000]),
+            'temperature': np.array([20.0]),
+            'humidity': np.array([50.0, 51.0]),
+            'light': np.array([1, 1]),
+        })
+    store.close()
+    assert store.segments(DEVICE) == []
@@ -0,0 +1,217 @@
+"""
+以 openpyxl 唯寫模式（write_only）串流輸出 Excel
+- 數據依時間窗口分段讀取，逐列寫入，記憶體用量與筆數無關
+- 超過 Excel 單一工作表的列數上限時自動換到新的工作表
+- ExcelMirror：定期把新數據鏡像到每日一個的 xlsx 檔案（只重寫有新數據的日期，包含收到遲到數據的日期）
+"""
+
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from stream_export import EXPORT_HEADERS, iter_windows, format_rows
+
+EXCEL_HEADERS = EXPORT_HEADERS
+EXCEL_COLUMN_WIDTHS = [20, 14, 12, 10, 10]
+# Excel 單一工作表最多 1,048,576 列（含標題列）
+EXCEL_MAX_ROWS = 1_048_576
+# 回應時每次送出的位元組數
+STREAM_CHUNK_SIZE = 64 * 1024
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+DAY_MS = 86400 * 1000
+
+
+def _new_sheet(workbook, index):
+    sheet = workbook.create_sheet('感測器數據' if index == 0 else f'感測器數據 ({index + 1})')
+    for letter, width in zip('ABCDE', EXCEL_COLUMN_WIDTHS):
+        sheet.column_dimensions[letter].width = width
+    header = []
+    for name in EXCEL_HEADERS:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = Font(color="FFFFFF", bold=True)
+        cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        header.append(cell)
+    sheet.append(header)
+    return sheet
+
+
+def write_workbook(fileobj, chunks):
+    """
+    以唯寫模式將分段的數據寫入 xlsx
+
+    Args:
+        fileobj: 可寫入的檔案物件或路徑
+        chunks: 欄位 dict 的迭代器（timestamp、device、light、temperature、humidity）
+
+    Returns:
+        int: 寫入筆數
+    """
+    workbook = Workbook(write_only=True)
+    sheets = 0
+    sheet = _new_sheet(workbook, sheets)
+    rows_in_sheet = 1
+    total = 0
+    for columns in chunks:
+        for row in format_rows(columns):
+            if rows_in_sheet >= EXCEL_MAX_ROWS:
+                sheets += 1
+                sheet = _new_sheet(workbook, sheets)
+                rows_in_sheet = 1
+            sheet.append(row)
+            rows_in_sheet += 1
+            total += 1
+    workbook.save(fileobj)
+    return total
+
+
+def export_to_tempfile(read_range, start_ms, end_ms, device=None, directory=None):
+    """
+    將時間範圍內的數據寫入暫存的 xlsx 檔案
+
+    Returns:
+        tuple: (已回到開頭的暫存檔, 筆數)
+    """
+    tmp = tempfile.TemporaryFile(dir=directory)
+    try:
+        total = write_workbook(tmp, iter_windows(read_range, start_ms, end_ms, device))
+    except Exception:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp, total
+
+
+def stream_file(fileobj, chunk_size=STREAM_CHUNK_SIZE):
+    """分段讀出檔案內容（讀完後關閉檔案）"""
+    try:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                return
+            yield data
+    finally:
+        fileobj.close()
+
+
+def local_day_start(timestamp_ms):
+    """timestamp_ms 所在的本地日期的開始時間（epoch 毫秒）"""
+    offset_ms = time.localtime(timestamp_ms / 1000).tm_gmtoff * 1000
+    return (timestamp_ms + offset_ms) // DAY_MS * DAY_MS - offset_ms
+
+
+class ExcelMirror:
+    """
+    定期把數據鏡像到每日一個的 xlsx 檔案（<目錄>/sensor_data_YYYY-MM-DD.xlsx）
+
+    xlsx 是壓縮檔，無法在原檔尾端附加；因此只重寫有新數據的日期（通常只有今天），
+    較舊的檔案不再變動。新數據依接收順序判斷：以 read_since 取得上次鏡像之後
+    才接收的數據，依裝置時間找出所屬的日期，遲到的數據也會重寫它所屬的日期。
+    另以水位（watermark）檔案記錄上次鏡像的時間，重新啟動後第一次鏡像從水位開始
+    """
+
+    def __init__(self, read_range, directory, interval=600.0, changed=None, read_since=None):
+        """
+        Args:
+            read_range: 讀取函式 read_range(start_ms, end_ms, device) -> 欄位 dict
+            directory: 輸出目錄
+            interval: 鏡像間隔（秒）
+            changed: 回傳目前版本（接收序號）的函式，版本沒變時略過
+            read_since: 讀取函式 read_since(seq, until_seq) -> 接收序號在 (seq, until_seq] 的欄位 dict
+        """
+        self.read_range = read_range
+        self.directory = directory
+        self.interval = interval
+        self.changed = changed
+        self.read_since = read_since
+        self.watermark_path = os.path.join(directory, '.watermark')
+        self._last_version = None
+        self._thread = None
+        self.files_written = 0
+
+    def path_for(self, day_start_ms):
+        day = time.strftime('%Y-%m-%d', time.localtime(day_start_ms / 1000))
+        return os.path.join(self.directory, f'sensor_data_{day}.xlsx')
+
+    def load_watermark(self):
+        try:
+            with open(self.watermark_path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def save_watermark(self, timestamp_ms):
+        tmp_path = self.watermark_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(timestamp_ms))
+        os.replace(tmp_path, self.watermark_path)
+
+    def _received_days(self, version):
+        """上次鏡像之後接收的數據所屬的日期（依裝置時間，包含遲到的數據）"""
+        if self.read_since is None or self._last_version is None or version is None:
+            return set()
+        timestamps = self.read_since(self._last_version, version)['timestamp']
+        # 先以小時去重，再換算成本地日期（時區偏移以小時為單位）
+        hours = np.unique(np.asarray(timestamps, dtype=np.int64) // 3600_000)
+        return {local_day_start(int(hour) * 3600_000) for hour in hours}
+
+    def _write_day(self, day_start):
+        day_end = local_day_start(day_start + DAY_MS + 3600 * 1000)
+        path = self.path_for(day_start)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write_workbook(f, iter_windows(self.read_range, day_start, day_end))
+        os.replace(tmp_path, path)
+
+    def run_once(self, now_ms=None):
+        """
+        鏡像一次（重寫水位之後的日期，以及上次鏡像之後收到遲到數據的日期）
+
+        Returns:
+            int: 重寫的檔案數
+        """
+        now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        version = self.changed() if self.changed is not None else None
+        if version is not None and version == self._last_version:
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+
+        watermark = self.load_watermark()
+        if watermark is None:
+            # 第一次執行：從今天開始（較舊的數據可用 /api/export.xlsx 匯出）
+            watermark = local_day_start(now_ms)
+
+        days = self._received_days(version)
+        day_start = local_day_start(watermark)
+        while day_start < now_ms:
+            day_end = local_day_start(day_start + DAY_MS + 3600 * 1000)
+            # 水位之後沒有新數據的日期不必重寫
+            if len(self.read_range(max(watermark, day_start), min(day_end, now_ms), None)['timestamp']):
+                days.add(day_start)
+            day_start = day_end
+
+        for day_start in sorted(days):
+            self._write_day(day_start)
+
+        self.save_watermark(now_ms)
+        self._last_version = version
+        self.files_written += len(days)
+        return len(days)
+
+    def start(self):
+        """啟動背景鏡像執行緒"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='excel-mirror', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"⚠️  Excel 鏡像時發生錯誤: {e}")
@@ -10,6 +10,7 @@ import network
 import time
 from umqtt.simple import MQTTClient
 import json
+import struct
 from machine import Pin, ADC
 # ==================== 設定區域 ====================
 # WiFi 設定
@@ -21,6 +22,10 @@ MQTT_PORT = 1883
 MQTT_TOPIC = "客廳/感測器" # 與 app_flask.py 中的主題一致
 MQTT_CLIENT_ID = "pico_sensor_001"
 MQTT_KEEPALIVE = 60  # 新增：保持連線時間（秒）
+# 傳送格式："json" 或 "struct"
+# struct 為 18 bytes 固定格式，發送到 MQTT_TOPIC + "/bin/" + MQTT_CLIENT_ID
+PAYLOAD_FORMAT = "json"
+STRUCT_FORMAT = "<BBIhHq"  # 版本, 電燈, 訊息編號, 溫度(0.01°C), 濕度(0.01%), 時間戳記(毫秒, 0=無)
 # 感測器設定
 # 使用 Pico 2 內建溫度感應器（ADC channel 4）
 TEMPERATURE_SENSOR = ADC(4) # 內建溫度感應器固定在 ADC channel 4
@@ -112,21 +117,31 @@ def check_mqtt_connection(client):
     except:
         # 其他錯誤，假設連接仍然有效
         return True
-def publish_data(client, temperature):
+def publish_data(client, temperature, msg_id):
     """發布溫度數據到 MQTT Broker（使用更穩定的方式）"""
     # 構建 JSON 數據（與 app_flask.py 期望的格式一致）
     # 注意：Pico 2 沒有濕度感測器，設為 0
+    # msg_id：每筆讀數一個編號（從 1 開始，重試時不變），伺服器以此去除重送的訊息
     data = {
         "temperature": temperature,
         "humidity": 0, # Pico 2 沒有濕度感測器
-        "light_status": "未知" # 如果沒有光感測器，設為未知
+        "light_status": "未知", # 如果沒有光感測器，設為未知
+        "msg_id": msg_id
     }
    
     # MicroPython 的 json.dumps 不支持 ensure_ascii 參數
     # 直接使用 json.dumps，然後編碼為 UTF-8 bytes
     # umqtt.simple 的 publish 方法需要 bytes 類型的消息
-    payload_str = json.dumps(data)
-    payload_bytes = payload_str.encode('utf-8')
+    topic = MQTT_TOPIC
+    if PAYLOAD_FORMAT == "struct":
+        # 二進位格式：payload 從約 60 bytes 縮小為 18 bytes
+        # 電燈 0 = 未知；訊息編號 0 保留給「沒有編號」
+        payload_bytes = struct.pack(STRUCT_FORMAT, 1, 0, msg_id, round(temperature * 100), 0, 0)
+        payload_str = f"<struct {len(payload_bytes)} bytes>"
+        topic = MQTT_TOPIC + "/bin/" + MQTT_CLIENT_ID
+    else:
+        payload_str = json.dumps(data)
+        payload_bytes = payload_str.encode('utf-8')
    
     # 嘗試發布，最多重試 2 次
     for attempt in range(2):
@@ -134,7 +149,7 @@ def publish_data(client, temperature):
             # 發布數據到 MQTT
             # umqtt.simple 的 publish 方法：publish(topic, msg)
             # topic 可以是字符串，msg 應該是 bytes
-            client.publish(MQTT_TOPIC, payload_bytes)
+            client.publish(topic, payload_bytes)
            
             # 發布後立即處理消息，確保協議層完成
             try:
@@ -147,7 +162,7 @@ def publish_data(client, temperature):
            
             # 顯示發布的詳細信息（用於調試）
             print(f"📤 已發布: 溫度={temperature}°C")
-            print(f"   主題: {MQTT_TOPIC}")
+            print(f"   主題: {topic}")
             print(f"   數據: {payload_str}")
             return True
            
@@ -245,6 +260,7 @@ def main():
    
     # 主循環
     publish_count = 0
+    msg_id = 0 # 訊息編號（每次讀取溫度加 1）
     consecutive_failures = 0 # 連續失敗計數
     max_consecutive_failures = 3 # 連續失敗 3 次後強制重連
    
@@ -256,6 +272,7 @@ def main():
             print(f"🔍 讀取到的溫度: {temperature}°C" if temperature is not None else "⚠️ 溫度讀取失敗")
            
             if temperature is not None:
+                msg_id = msg_id % 0xFFFFFFFF + 1 # 1 ~ 0xFFFFFFFF（struct 為 32 位元）
                 # 如果啟用了"發布後斷開"策略，需要先連接
                 if USE_DISCONNECT_AFTER_PUBLISH:
                     try:
@@ -279,7 +296,7 @@ def main():
                
                 for publish_attempt in range(max_publish_attempts):
                     # 嘗試發布
-                    if publish_data(mqtt_client, temperature):
+                    if publish_data(mqtt_client, temperature, msg_id):
                         publish_count += 1
                         consecutive_failures = 0 # 重置失敗計數
                         print(f"📊 總共已發布 {publish_count} 次")